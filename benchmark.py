@@ -0,0 +1,145 @@
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from datetime import datetime
+
+from chart.chart import Candle
+from gmo.gmo import GMO, Position
+
+POSITION_NUM = 10000
+CANDLE_NUM = 100000
+
+def _raw_position(i):
+    return {
+        'positionId': 1000000 + i,
+        'symbol': 'BTC_JPY',
+        'side': 'BUY',
+        'size': '0.01',
+        'orderdSize': '0',
+        'price': '5000000',
+        'lossGain': '0',
+        'leverage': '4',
+        'losscutPrice': '0',
+        'timestamp': '2021-03-19T02:15:06.059Z'
+    }
+
+class _DictPosition:
+    """
+    変更前の Position 相当（__dict__ + 生データ + datetime）
+    """
+    def __init__(self, raw_data):
+        self.raw = raw_data
+        self.id = raw_data['positionId']
+        self.symbol = raw_data['symbol']
+        self.side = raw_data['side']
+        self.size = float(raw_data['size'])
+        self.orderdSize = float(raw_data['orderdSize'])
+        self.price = float(raw_data['price'])
+        self.lossGain = float(raw_data['lossGain'])
+        self.leverage = int(raw_data['leverage'])
+        self.timestamp = datetime.fromisoformat(raw_data['timestamp'].replace('Z', '+00:00'))
+
+class _DictCandle:
+    """
+    変更前の Candle 相当（__dict__）
+    """
+    def __init__(self, open_price):
+        price = int(open_price)
+        self.open = price
+        self.high = price
+        self.low = price
+        self.close = price
+
+def _measure(factory, num):
+    tracemalloc.start()
+    objs = [factory(i) for i in range(num)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return size
+
+def bench_memory():
+    print("Position x{}".format(POSITION_NUM))
+    before = _measure(lambda i: _DictPosition(_raw_position(i)), POSITION_NUM)
+    after = _measure(lambda i: Position(_raw_position(i)), POSITION_NUM)
+    print("  before: {:,} bytes  after: {:,} bytes  ({:.1%})".format(before, after, after / before))
+
+    print("Candle x{}".format(CANDLE_NUM))
+    before = _measure(lambda i: _DictCandle(5000000 + i), CANDLE_NUM)
+    after = _measure(lambda i: Candle(5000000 + i), CANDLE_NUM)
+    print("  before: {:,} bytes  after: {:,} bytes  ({:.1%})".format(before, after, after / before))
+
+SIGN_NUM = 100000
+
+def bench_sign():
+    secret_key = 'x' * 64
+    path = '/v1/order'
+    req_body = {"symbol": "BTC_JPY", "side": "BUY", "executionType": "LIMIT", "size": "0.01", "price": "5000000"}
+
+    def before():
+        # 変更前の署名処理（毎回 HMAC を生成、ボディを2回シリアライズ）
+        timestamp = '{0}000'.format(int(time.mktime(datetime.now().timetuple())))
+        text = timestamp + 'POST' + path + json.dumps(req_body)
+        sign = hmac.new(bytes(secret_key.encode('ascii')), bytes(text.encode('ascii')), hashlib.sha256).hexdigest()
+        return sign, json.dumps(req_body)
+
+    api = GMO('key', secret_key)
+    after = lambda: api._build_private_request('POST', path, req_body)
+
+    print("sign x{}".format(SIGN_NUM))
+    t_before = timeit.timeit(before, number=SIGN_NUM) / SIGN_NUM * 1e6
+    t_after = timeit.timeit(after, number=SIGN_NUM) / SIGN_NUM * 1e6
+    print("  before: {:.2f}us  after: {:.2f}us".format(t_before, t_after))
+
+IMPORT_TARGETS = ['chart.chart', 'gmo.gmo', 'gmocoin_bot.bot', 'gmocoin_bot.ws', 'main', 'tsumitate']
+IMPORT_TOP = 5
+
+def _import_times(module):
+    """
+    python -X importtime の出力を {モジュール名: (self, cumulative)}（マイクロ秒）にする
+    """
+    # リポジトリのルートで実行する（どこから呼んでも同じモジュールを読み込む）
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+def bench_importtime():
+    for module in IMPORT_TARGETS:
+        try:
+            times = _import_times(module)
+        except RuntimeError as e:
+            print("{}: FAILED ({})".format(module, e))
+            continue
+
+        print("{}: {:.1f}ms".format(module, times[module][1] / 1000))
+        slowest = sorted(times.items(), key=lambda kv: kv[1][0], reverse=True)[:IMPORT_TOP]
+        for name, (self_us, _) in slowest:
+            print("  {:<40} {:>8.1f}ms".format(name, self_us / 1000))
+
+BENCHMARKS = {
+    'memory': bench_memory,
+    'sign': bench_sign,
+    'importtime': bench_importtime,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("usage: python benchmark.py <{}>".format("|".join(BENCHMARKS)))
+        exit(-1)
+
+    BENCHMARKS[sys.argv[1]]()
@@ -1,4 +1,4 @@
-from chart.chart import *
+from chart.chart import TechnicalChart, RSI, Candle, AverageCandle, heikin_ashi
 from enum import Enum
 
 
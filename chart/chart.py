@@ -1,50 +1,112 @@
 import itertools
 import json
-import pandas as pd
+import re
 
-import websocket
+from gmo.gmo import to_epoch_ms
+
+_PERIOD_UNITS_MS = {
+    'S': 1000, 's': 1000,
+    'T': 60 * 1000, 'min': 60 * 1000,
+    'H': 60 * 60 * 1000, 'h': 60 * 60 * 1000,
+    'D': 24 * 60 * 60 * 1000,
+}
+_PERIOD_PATTERN = re.compile(r'^(\d*)([A-Za-z]+)$')
+
+def parse_period(period) -> int:
+    """
+    ローソク足の期間（pandas のオフセット表記 'T', '5min', '1H' など、またはミリ秒）をミリ秒に変換
+    """
+    if isinstance(period, int):
+        return period
+    m = _PERIOD_PATTERN.match(period)
+    if m is None or m.group(2) not in _PERIOD_UNITS_MS:
+        raise ValueError("unknown candle period '{}'".format(period))
+    return int(m.group(1) or 1) * _PERIOD_UNITS_MS[m.group(2)]
+
+def round_time(epoch_ms, period_ms) -> int:
+    """
+    エポックミリ秒を period_ms 単位の最も近い時刻に丸める（pandas の round と同じく偶数丸め）
+    """
+    q, r = divmod(epoch_ms, period_ms)
+    if r * 2 > period_ms or (r * 2 == period_ms and q % 2):
+        q += 1
+    return q * period_ms
+
+# 平均足の計算を始めるまでの普通のローソク足の本数
+HA_WARMUP = 2
+
+def heikin_ashi(opens, highs, lows, closes, warmup=HA_WARMUP) -> tuple:
+    """
+    普通のローソク足の四本値の配列から平均足の (open, high, low, close) を計算する（過去データ用）
+    TechnicalChart の平均足と同じ値になる。先頭 warmup 本は普通のローソク足のまま
+    """
+    length = len(closes)
+    ha_open, ha_high, ha_low, ha_close = [0.0] * length, [0.0] * length, [0.0] * length, [0.0] * length
+    for i in range(length):
+        o, h, l, c = opens[i], highs[i], lows[i], closes[i]
+        if i < warmup:
+            ha_open[i], ha_high[i], ha_low[i], ha_close[i] = o, h, l, c
+            continue
+        ho = (ha_open[i - 1] + ha_close[i - 1]) / 2
+        hc = (o + h + l + c) / 4
+        ha_open[i] = ho
+        ha_close[i] = hc
+        ha_high[i] = max(h, ho)
+        ha_low[i] = min(l, ho)
+    return ha_open, ha_high, ha_low, ha_close
 
 class TechnicalChart:
+    """
+    ローソク足は丸めた時刻（エポックミリ秒）をキーに保持する
+    """
     RSI_PERIOD = 14
     def __init__(self, candle_period='T', max_length=60):
         self.avg_candles = {}
         self.basic_candles = {}
-        self.__period = candle_period
+        self.__period = parse_period(candle_period)
         self._max_length = max_length
         self.rsi = RSI(self.RSI_PERIOD)
+        # ローソク足が変化するたびに増える。トレンド判定のメモ化に使う
+        self.version = 0
+        self.signal_cache = {}
 
     def update(self, trade_data):
-        self.__update_avg_candles(trade_data)
-        self.__update_basic_candles(trade_data)
+        now_minute = round_time(to_epoch_ms(trade_data['timestamp']), self.__period)
+        # 平均足は同じ時刻の普通のローソク足から計算するので先に更新する
+        basic_changed = self.__update_basic_candles(now_minute, trade_data)
+        avg_changed = self.__update_avg_candles(now_minute, trade_data)
         self.__update_rsi()
+        if avg_changed or basic_changed:
+            self.version += 1
 
-    def __update_avg_candles(self, trade_data):
-        now = pd.to_datetime(trade_data['timestamp'])
-        now_minute = now.round(self.__period)
-
+    def __update_avg_candles(self, now_minute, trade_data):
+        changed = True
         if self.avg_candles.get(now_minute):
-            self.avg_candles.get(now_minute).update(trade_data)
+            changed = self.avg_candles.get(now_minute).update(trade_data)
         else:
-            if len(self.avg_candles) <= 1:  # 始値のずれを修正するため 2分まで普通のローソク足
+            raw = self.basic_candles[now_minute]
+            if len(self.avg_candles) < HA_WARMUP:  # 始値のずれを修正するため 2分まで普通のローソク足
                 self.avg_candles[now_minute] = Candle(trade_data['price'])
             else:
                 prev_candle = self.avg_candles[list(self.avg_candles)[-1]]
-                self.avg_candles[now_minute] = AverageCandle(prev_candle)
+                self.avg_candles[now_minute] = AverageCandle(prev_candle, raw)
 
         if len(self.avg_candles) > self._max_length:
-            self.avg_candles.pop(list(self.avg_candles)[0])
+            self.avg_candles.pop(next(iter(self.avg_candles)))
 
-    def __update_basic_candles(self, trade_data):
-        now = pd.to_datetime(trade_data['timestamp'])
-        now_minute = now.round(self.__period)
+        return changed
 
+    def __update_basic_candles(self, now_minute, trade_data):
+        changed = True
         if self.basic_candles.get(now_minute):
-            self.basic_candles.get(now_minute).update(trade_data)
+            changed = self.basic_candles.get(now_minute).update(trade_data)
         else:
             self.basic_candles[now_minute] = Candle(trade_data['price'])
 
         if len(self.basic_candles) > self._max_length:
-            self.basic_candles.pop(list(self.basic_candles)[0])
+            self.basic_candles.pop(next(iter(self.basic_candles)))
+
+        return changed
 
     def __update_rsi(self):
         self.rsi.update(self.basic_candles)
@@ -67,8 +129,8 @@ class TechnicalChart:
         return self.avg_candles[list(self.avg_candles)[-1]]
 
     def get_candles(self, from_time, to_time):
-        f = pd.to_datetime(from_time).round(self.__period)
-        t = pd.to_datetime(to_time).round(self.__period)
+        f = round_time(to_epoch_ms(from_time), self.__period)
+        t = round_time(to_epoch_ms(to_time), self.__period)
         f_i = list(self.avg_candles).index(f)
         t_i = list(self.avg_candles).index(t)
         ret = {}
@@ -78,7 +140,20 @@ class TechnicalChart:
         return ret
 
     def get_candles_by_index(self, from_index, to_index=-1):
-        return self.get_candles(list(self.avg_candles)[from_index], list(self.avg_candles)[to_index])
+        stop = to_index + 1 if to_index != -1 else None
+        return dict(list(self.avg_candles.items())[from_index:stop])
+
+    def get_columns(self, length):
+        """
+        直近 length 本の平均足を (open, high, low, close, rsi) の配列で返す
+        rsi は最新足のみ有効
+        """
+        candles = list(self.avg_candles.values())[-length:]
+        rsi = [None] * len(candles)
+        if rsi:
+            rsi[-1] = self.rsi.value
+        return ([c.open for c in candles], [c.high for c in candles], [c.low for c in candles],
+                [c.close for c in candles], rsi)
 
     def getRSI(self, period=14):
         return self.rsi
@@ -139,6 +214,8 @@ class RSI:
         return str(self.value)
 
 class Candle:
+    __slots__ = ('open', 'high', 'low', 'close')
+
     def __init__(self, open_price):
         price = int(open_price)
         self.open = price
@@ -146,11 +223,18 @@ class Candle:
         self.low = price
         self.close = price
 
-    def update(self, tick):
+    def update(self, tick) -> bool:
+        """
+        :return: 四本値が変化したか
+        """
         price = int(tick['price'])
+        if price == self.close and self.low <= price <= self.high:
+            return False
+
         self.high = max(self.high, price)
         self.low = min(self.low, price)
         self.close = price
+        return True
 
     def __str__(self):
         # return "O[{}] H[{}] L[{}] C[{}]".format(self.open, self.high, self.low, self.close)
@@ -176,19 +260,33 @@ class Candle:
 class AverageCandle(Candle):
     """
     平均足
+
+    始値は前の平均足の (始値 + 終値) / 2 で足の開始時に決まり、終値・高値・安値は同じ時刻の
+    普通のローソク足（raw）の四本値から計算する。約定の件数や順序によらず raw の四本値だけで決まる
     """
+    __slots__ = ('_raw',)
 
-    def __init__(self, prev_candle: Candle):
-        super().__init__((prev_candle.open + prev_candle.close) / 2)
+    def __init__(self, prev_candle: Candle, raw: Candle):
+        self._raw = raw
+        self.open = (prev_candle.open + prev_candle.close) / 2
+        self.high = self.low = self.close = self.open
+        self.update(None)
 
-    def update(self, tick):
-        price = int(tick['price'])
-        self.high = max(self.high, price)
-        self.low = min(self.low, price)
-        self.close = (self.high + self.low + self.open + self.close) / 4
+    def update(self, tick) -> bool:
+        """
+        raw は更新済みであること（tick は使わない）
+        """
+        raw = self._raw
+        prev = (self.high, self.low, self.close)
+        self.close = (raw.open + raw.high + raw.low + raw.close) / 4
+        self.high = max(raw.high, self.open)
+        self.low = min(raw.low, self.open)
+        return prev != (self.high, self.low, self.close)
 
 
 if __name__ == '__main__':
+    import websocket
+
     chart = TechnicalChart('T')
 
     def on_message(ws, message):
@@ -0,0 +1,120 @@
+import time
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+
+class OrderBook:
+    """
+    板情報（orderbooks チャンネル）のメモリ上の写し
+
+    GMO は毎回板全体を送ってくるため、スナップショットを価格・数量・累積数量の配列に変換して差し替える。
+    最良気配は O(1)、指定幅内の厚み・指定数量の VWAP は二分探索で求める。
+    買い注文は売り板(asks)、売り注文は買い板(bids)を消費する。
+    """
+
+    def __init__(self, symbol=None):
+        self.symbol = symbol
+        self.timestamp = None
+        self.updated_at = None
+        # (価格, 数量, 累積数量)。買い板は二分探索のため価格の符号を反転して昇順で持つ
+        self._asks = ([], [], [])
+        self._bids = ([], [], [])
+
+    def apply_snapshot(self, data):
+        self._asks = self._build(data['asks'], 1)
+        self._bids = self._build(data['bids'], -1)
+        self.timestamp = data.get('timestamp')
+        self.updated_at = time.monotonic()
+
+    @staticmethod
+    def _build(levels, sign):
+        prices = [sign * float(lv['price']) for lv in levels]
+        sizes = [float(lv['size']) for lv in levels]
+        if any(prices[i] > prices[i + 1] for i in range(len(prices) - 1)):
+            order = sorted(range(len(prices)), key=prices.__getitem__)
+            prices = [prices[i] for i in order]
+            sizes = [sizes[i] for i in order]
+        return prices, sizes, list(accumulate(sizes))
+
+    def _side(self, side):
+        """
+        :param side: 注文の売買区分 BUY|SELL
+        :return: (消費する板, 価格の符号)
+        """
+        if side == 'BUY':
+            return self._asks, 1
+        return self._bids, -1
+
+    def is_fresh(self, max_age=5.0):
+        return self.updated_at is not None and time.monotonic() - self.updated_at <= max_age
+
+    def best_ask(self):
+        prices = self._asks[0]
+        return prices[0] if prices else None
+
+    def best_bid(self):
+        prices = self._bids[0]
+        return -prices[0] if prices else None
+
+    def spread(self):
+        ask, bid = self.best_ask(), self.best_bid()
+        if ask is None or bid is None:
+            return None
+        return ask - bid
+
+    def depth(self, side, within):
+        """
+        side の注文が消費する板のうち、最良気配から within 円以内にある数量
+
+        :param side: 注文の売買区分 BUY|SELL
+        """
+        (prices, _, cum), _ = self._side(side)
+        if not prices:
+            return 0.0
+        idx = bisect_right(prices, prices[0] + within)
+        return cum[idx - 1]
+
+    def price_for_size(self, side, size):
+        """
+        size を一度に約定させるのに必要な最も不利な価格。板が足りなければ None
+        """
+        (prices, _, cum), sign = self._side(side)
+        idx = bisect_left(cum, size)
+        if idx >= len(prices):
+            return None
+        return sign * prices[idx]
+
+    def levels(self, side):
+        """
+        side の注文が消費する板を有利な順に [(価格, 数量)] で返す
+        """
+        (prices, sizes, _), sign = self._side(side)
+        return [(sign * p, s) for p, s in zip(prices, sizes)]
+
+    def resting_size(self, side, price):
+        """
+        side の注文と同じ側の板で price に並んでいる数量
+        """
+        if side == 'BUY':
+            prices, sizes, _ = self._bids
+            key = -price
+        else:
+            prices, sizes, _ = self._asks
+            key = price
+        idx = bisect_left(prices, key)
+        if idx < len(prices) and prices[idx] == key:
+            return sizes[idx]
+        return 0.0
+
+    def vwap(self, side, size):
+        """
+        size を板から約定させた場合の平均約定価格。板が足りなければ None
+        """
+        (prices, sizes, cum), sign = self._side(side)
+        idx = bisect_left(cum, size)
+        if idx >= len(prices) or size <= 0:
+            return None
+
+        filled = cum[idx - 1] if idx > 0 else 0.0
+        notional = sum(p * s for p, s in zip(prices[:idx], sizes[:idx])) + prices[idx] * (size - filled)
+        return sign * notional / size
@@ -0,0 +1,178 @@
+"""
+設定ファイルで定義するトレンド判定ルール
+
+ルールは起動時に一度だけ指標配列上の判定関数へコンパイルされ、ティック毎の解釈は行わない。
+同じ関数を過去データ全体に適用すればバックテストにも使える。
+
+例::
+
+    {
+        "type": "Rule",
+        "up": {"all": [{"pattern": "up", "length": 3}, {"left": "rsi", "op": ">=", "right": 40}]},
+        "down": {"any": [{"left": "change_rate[-2]", "op": "<", "right": -0.001},
+                         {"pattern": "down", "length": 3}]}
+    }
+
+オペランドは数値、または指標名（``close`` / ``close[-2]`` のように末尾から何本目かを指定できる、省略時は最新足）。
+指標は open, high, low, close, change(close - open), change_rate((close - open) / open), rsi。
+"""
+import operator
+import re
+
+OPEN = 0
+HIGH = 1
+LOW = 2
+CLOSE = 3
+RSI = 4
+COLUMN_NAMES = ('open', 'high', 'low', 'close', 'rsi')
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+_OPERAND_PATTERN = re.compile(r'^(\w+)(?:\[-(\d+)\])?$')
+
+
+class CompiledRule:
+    """
+    コンパイル済みのルール
+
+    :ivar lookback: 判定に必要な足の本数
+    """
+    def __init__(self, predicate, lookback):
+        self._predicate = predicate
+        self.lookback = lookback
+
+    def evaluate(self, columns, index) -> bool:
+        """
+        :param columns: (open, high, low, close, rsi) の配列のタプル
+        :param index: 最新足とみなすインデックス
+        """
+        if index + 1 < self.lookback:
+            return False
+        return self._predicate(columns, index)
+
+    def evaluate_history(self, columns) -> list:
+        """
+        全インデックスについて判定する（バックテスト用）
+        """
+        predicate = self._predicate
+        length = len(columns[CLOSE])
+        result = [False] * length
+        for i in range(self.lookback - 1, length):
+            result[i] = predicate(columns, i)
+        return result
+
+
+def compile_rule(rule) -> CompiledRule:
+    predicate, lookback = _compile_node(rule)
+    return CompiledRule(predicate, lookback)
+
+
+def _compile_node(node):
+    if 'all' in node or 'any' in node:
+        combine = 'all' if 'all' in node else 'any'
+        children = [_compile_node(n) for n in node[combine]]
+        if not children:
+            raise ValueError("empty '{}' in rule".format(combine))
+        predicates = tuple(c[0] for c in children)
+        lookback = max(c[1] for c in children)
+        if len(predicates) == 1:
+            return predicates[0], lookback
+        if combine == 'all':
+            def all_of(columns, i):
+                for p in predicates:
+                    if not p(columns, i):
+                        return False
+                return True
+            return all_of, lookback
+        else:
+            def any_of(columns, i):
+                for p in predicates:
+                    if p(columns, i):
+                        return True
+                return False
+            return any_of, lookback
+
+    if 'pattern' in node:
+        return _compile_pattern(node['pattern'], int(node.get('length', 1)))
+
+    if 'op' in node:
+        op = OPERATORS.get(node['op'])
+        if op is None:
+            raise ValueError("unknown operator '{}'".format(node['op']))
+        left, left_lookback = _compile_operand(node['left'])
+        right, right_lookback = _compile_operand(node['right'])
+
+        def compare(columns, i):
+            lv = left(columns, i)
+            rv = right(columns, i)
+            if lv is None or rv is None:
+                return False
+            return op(lv, rv)
+        return compare, max(left_lookback, right_lookback)
+
+    raise ValueError("invalid rule node: {}".format(node))
+
+
+def _compile_pattern(pattern, length):
+    if length < 1:
+        raise ValueError("pattern length must be positive")
+
+    if pattern == 'up':
+        def up(columns, i):
+            opens = columns[OPEN]
+            closes = columns[CLOSE]
+            for j in range(i - length + 1, i + 1):
+                if not closes[j] > opens[j]:
+                    return False
+            return True
+        return up, length
+    elif pattern == 'down':
+        def down(columns, i):
+            opens = columns[OPEN]
+            closes = columns[CLOSE]
+            for j in range(i - length + 1, i + 1):
+                if not closes[j] < opens[j]:
+                    return False
+            return True
+        return down, length
+
+    raise ValueError("unknown pattern '{}'".format(pattern))
+
+
+def _compile_operand(operand):
+    if isinstance(operand, (int, float)):
+        value = operand
+        return (lambda columns, i: value), 1
+
+    match = _OPERAND_PATTERN.match(str(operand))
+    if not match:
+        raise ValueError("invalid operand '{}'".format(operand))
+    name = match.group(1)
+    if match.group(2) is not None and int(match.group(2)) < 1:
+        raise ValueError("invalid offset in operand '{}' (use [-1] for the latest candle)".format(operand))
+    offset = int(match.group(2) or 1) - 1
+
+    if name in COLUMN_NAMES:
+        column = COLUMN_NAMES.index(name)
+        if column == RSI:
+            def rsi(columns, i):
+                v = columns[RSI][i - offset]
+                return None if v is None or v < 0 else v
+            return rsi, offset + 1
+        return (lambda columns, i: columns[column][i - offset]), offset + 1
+    elif name == 'change':
+        return (lambda columns, i: columns[CLOSE][i - offset] - columns[OPEN][i - offset]), offset + 1
+    elif name == 'change_rate':
+        def change_rate(columns, i):
+            o = columns[OPEN][i - offset]
+            return (columns[CLOSE][i - offset] - o) / o
+        return change_rate, offset + 1
+
+    raise ValueError("unknown indicator '{}'".format(name))
@@ -1,12 +1,36 @@
+import json
 from abc import abstractmethod
 
 from chart import ETrendType
 from chart.chart import TechnicalChart
+from chart.rule import compile_rule
 
 
 class TrendChecker:
-    @abstractmethod
+    """
+    トレンド判定の基底クラス
+
+    判定結果はチャートのバージョン毎にチャート側へキャッシュされるため、
+    ローソク足が変化しない限り再計算されず、同じチャート・同じ設定の判定器を持つボット間で共有される
+    """
     def check_trend(self, chart: TechnicalChart) -> ETrendType:
+        key = self.cache_key()
+        cached = chart.signal_cache.get(key)
+        if cached is not None and cached[0] == chart.version:
+            return cached[1]
+
+        trend = self._check_trend(chart)
+        chart.signal_cache[key] = (chart.version, trend)
+        return trend
+
+    def cache_key(self):
+        """
+        判定結果を共有してよい判定器同士で等しくなるキー
+        """
+        return (type(self),)
+
+    @abstractmethod
+    def _check_trend(self, chart: TechnicalChart) -> ETrendType:
         pass
 
 class SimpleTrendChecker2(TrendChecker):
@@ -14,7 +38,7 @@ class SimpleTrendChecker2(TrendChecker):
     START_COOL_TIME = 5
     THRESHOLD = 0.001
 
-    def check_trend(self, chart: TechnicalChart) -> ETrendType:
+    def _check_trend(self, chart: TechnicalChart) -> ETrendType:
         if len(chart.avg_candles) < self.START_COOL_TIME:
             return ETrendType.NONE
 
@@ -48,7 +72,7 @@ class SimpleTrendChecker2(TrendChecker):
 class SimpleTrendChecker(TrendChecker):
     CHECK_LENGTH = 3
     START_COOL_TIME = 5
-    def check_trend(self, chart: TechnicalChart) -> ETrendType:
+    def _check_trend(self, chart: TechnicalChart) -> ETrendType:
         if len(chart.avg_candles) < self.START_COOL_TIME:
             return ETrendType.NONE
 
@@ -77,14 +101,17 @@ class RSITrendChecker(SimpleTrendChecker):
         self._th1 = th1
         self._th2 = th2
 
-    def check_trend(self, chart: TechnicalChart) -> ETrendType:
-        rsi = chart.getRSI(self._period)
+    def cache_key(self):
+        return type(self), self._period, self._th1, self._th2
+
+    def _check_trend(self, chart: TechnicalChart) -> ETrendType:
+        rsi = chart.getRSI(self._period).value
 
         if rsi == -1:
-            # return super().check_trend(chart)
+            # return super()._check_trend(chart)
             return ETrendType.NONE
         else:
-            simple_trend = super().check_trend(chart)
+            simple_trend = super()._check_trend(chart)
             if simple_trend == ETrendType.UP:
                 if rsi < self._th1:
                     return ETrendType.NONE
@@ -97,3 +124,62 @@ class RSITrendChecker(SimpleTrendChecker):
                     return ETrendType.DOWN
 
         return ETrendType.NONE
+
+
+class RuleTrendChecker(TrendChecker):
+    """
+    設定ファイルのルール（chart.rule 参照）で判定する
+    """
+    def __init__(self, config):
+        self._key = json.dumps({k: config.get(k) for k in ('up', 'down', 'min_candles')}, sort_keys=True)
+        self._up = compile_rule(config['up']) if 'up' in config else None
+        self._down = compile_rule(config['down']) if 'down' in config else None
+        rules = [r for r in (self._up, self._down) if r]
+        self._lookback = max([r.lookback for r in rules] + [1])
+        self._min_candles = max(int(config.get('min_candles', 0)), self._lookback)
+
+    def cache_key(self):
+        return type(self), self._key
+
+    def _check_trend(self, chart: TechnicalChart) -> ETrendType:
+        if len(chart.avg_candles) < self._min_candles:
+            return ETrendType.NONE
+
+        columns = chart.get_columns(self._lookback)
+        index = len(columns[0]) - 1
+        if self._up and self._up.evaluate(columns, index):
+            return ETrendType.UP
+        if self._down and self._down.evaluate(columns, index):
+            return ETrendType.DOWN
+        return ETrendType.NONE
+
+    def evaluate_history(self, columns) -> list:
+        """
+        過去データ全体のトレンドを判定する（バックテスト用）
+
+        :param columns: (open, high, low, close, rsi) の配列のタプル
+        """
+        length = len(columns[0])
+        up = self._up.evaluate_history(columns) if self._up else [False] * length
+        down = self._down.evaluate_history(columns) if self._down else [False] * length
+        return [ETrendType.NONE if i + 1 < self._min_candles else
+                ETrendType.UP if up[i] else ETrendType.DOWN if down[i] else ETrendType.NONE
+                for i in range(length)]
+
+
+def create_trend_checker(config) -> TrendChecker:
+    """
+    bot_configs の trend_checker 設定から判定器を生成する
+    """
+    checker_type = config['type']
+    if checker_type == 'Simple1':
+        return SimpleTrendChecker()
+    elif checker_type == 'Simple2':
+        return SimpleTrendChecker2()
+    elif checker_type == 'RSI':
+        params = config['params']
+        return RSITrendChecker(params[0], params[1], params[2])
+    elif checker_type == 'Rule':
+        return RuleTrendChecker(config)
+
+    raise ValueError("unknown trend checker type '{}'".format(checker_type))
@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+
+class ExchangeClock:
+    """
+    ローカル時計と取引所時計のずれ（offset = 取引所時刻 - ローカル時刻）の推定
+
+    REST の往復（送信時刻・受信時刻・レスポンスの responsetime）から NTP と同じ要領で offset を求め、
+    直近 window 件のうち往復時間が最小のサンプルを採用する。
+    Webソケットのメッセージ（取引所タイムスタンプと受信時刻）からは片道遅延を推定する。
+    REST のサンプルがまだ無い間は、Webソケットの最小遅延を 0 とみなして offset を仮置きする。
+    """
+    WINDOW = 64
+
+    def __init__(self, window=WINDOW):
+        self.offset_ms = 0.0
+        self.rtt_ms = None
+        self.latency_ms = None
+        self._rest_samples = deque(maxlen=window)
+        self._ws_delays = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def local_ms() -> float:
+        return time.time_ns() / 1000000
+
+    def exchange_now_ms(self) -> int:
+        return int(time.time_ns() / 1000000 + self.offset_ms)
+
+    def exchange_now(self) -> datetime:
+        return datetime.fromtimestamp(self.exchange_now_ms() / 1000, tz=timezone.utc)
+
+    def observe_rest(self, send_ms, recv_ms, server_ms):
+        rtt = recv_ms - send_ms
+        offset = server_ms - (send_ms + recv_ms) / 2
+        with self._lock:
+            self._rest_samples.append((rtt, offset))
+            self.rtt_ms, self.offset_ms = min(self._rest_samples)
+            self._update_latency()
+
+    def observe_message(self, exchange_ms, recv_ms=None):
+        if recv_ms is None:
+            recv_ms = self.local_ms()
+        with self._lock:
+            self._ws_delays.append(recv_ms - exchange_ms)
+            if not self._rest_samples:
+                self.offset_ms = -min(self._ws_delays)
+            self._update_latency()
+
+    def _update_latency(self):
+        if self._ws_delays:
+            self.latency_ms = max(min(self._ws_delays) + self.offset_ms, 0.0)
+        elif self.rtt_ms is not None:
+            self.latency_ms = self.rtt_ms / 2
+
+
+default_clock = ExchangeClock()
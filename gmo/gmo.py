@@ -3,19 +3,43 @@ import hashlib
 import hmac
 import json
 import sys
+import threading
 from datetime import datetime, timedelta
 import time
 from json import JSONEncoder
 
-import pandas as pd
-import requests
-import websocket
+from gmo.clock import ExchangeClock, default_clock
+
+# requests・websocket-client は読み込みに時間がかかるため、最初に使う時に読み込む
+# （Position や to_epoch_ms だけを使うモジュールの起動を遅くしない）
+def _requests():
+    import requests
+    return requests
+
+def _websocket():
+    import websocket
+    websocket.enableTrace(False)
+    return websocket
 
 class CallLimiter:
     def __init__(self, limit=3):
         self.prev_call_time = datetime.now()
         self.call_times = 0
         self.max_call_times = limit
+        self._lock = threading.Lock()
+
+    def wait(self) -> float:
+        """
+        呼び出し枠が空くまで待ってから1回分を消費する（スレッドセーフ）
+        :return: 待った秒数
+        """
+        started = time.monotonic()
+        with self._lock:
+            if not self.enabled_call():
+                time.sleep(1)
+                self.reset()
+            self.increase_call()
+        return time.monotonic() - started
 
     def enabled_call(self):
         if self.call_times < self.max_call_times:
@@ -35,24 +59,91 @@ class CallLimiter:
         self.call_times = 0
         self.prev_call_time = None
 
+REST_URL = 'https://api.coin.z.com'
+WS_URL = 'wss://api.coin.z.com/ws'
+
 class GMO:
-    def __init__(self, api_key=None, secret_key=None):
-        self._public = 'https://api.coin.z.com/public'
+    def __init__(self, api_key=None, secret_key=None, clock: ExchangeClock = None, rest_url=None, ws_url=None,
+                 call_limit=3, limiters=None):
+        """
+        :param rest_url: REST API のベースURL（省略時は本番。ローカルの模擬取引所を使う場合に指定）
+        :param ws_url: WebソケットのベースURL
+        :param call_limit: プライベートAPIの GET・POST それぞれの1秒あたりの呼び出し上限
+        :param limiters: (GET 用, POST 用) の呼び出し制限（wait() を持つもの）。
+                         プロセス間で上限を共有する場合に指定する（省略時は call_limit の CallLimiter）
+        """
+        rest_url = (rest_url or REST_URL).rstrip('/')
+        self._public = rest_url + '/public'
+        self._private = rest_url + '/private'
+        self._ws_url = (ws_url or WS_URL).rstrip('/')
+        self.clock = clock or default_clock
         self.__api_key = api_key
         self.__secret_key = secret_key
-        self.__get_limiter = CallLimiter()
-        self.__post_limiter = CallLimiter()
-        websocket.enableTrace(False)
+        # 鍵設定済みの HMAC を使い回し、リクエスト毎には copy するだけにする
+        self.__hmac = hmac.new(secret_key.encode('ascii'), digestmod=hashlib.sha256) if secret_key else None
+        self.__timestamp_lock = threading.Lock()
+        self.__last_timestamp = 0
+        self.__get_limiter, self.__post_limiter = limiters or (CallLimiter(call_limit), CallLimiter(call_limit))
+        self.__session = None
+        # on_request(メソッド, パス, 応答までの秒数, 呼び出し制限で待った秒数)。メトリクスの記録用
+        self.on_request = None
+
+    def _session(self):
+        """
+        クライアント毎の HTTP セッション。接続を使い回して TLS ハンドシェイクを省く
+        """
+        if self.__session is None:
+            self.__session = _requests().Session()
+        return self.__session
+
+    def _request(self, method, url, throttle_wait=0.0, **kwargs):
+        """
+        HTTP リクエストを送り、レスポンスの responsetime で時計のずれを更新する
+        """
+        send_ms = self.clock.local_ms()
+        res = self._session().request(method, url, **kwargs).json()
+        recv_ms = self.clock.local_ms()
+        if 'responsetime' in res:
+            self.clock.observe_rest(send_ms, recv_ms, to_epoch_ms(res['responsetime']))
+        if self.on_request is not None:
+            path = url[len(self._private):] if url.startswith(self._private) else url[len(self._public):]
+            # クエリ文字列（page・symbol など）はラベルに含めない
+            path = path.split('?', 1)[0]
+            self.on_request(method, path, (recv_ms - send_ms) / 1000, throttle_wait)
+        return res
 
     def _send_public(self, path):
-        response = requests.get(self._public + path).json()
+        response = self._request('GET', self._public + path)
         if response['status'] == 0:
             return response['data']
         else:
             raise Exception("Request Failed")
 
     def _create_sign(self, text):
-        return hmac.new(bytes(self.__secret_key.encode('ascii')), bytes(text.encode('ascii')), hashlib.sha256).hexdigest()
+        h = self.__hmac.copy()
+        h.update(text if isinstance(text, bytes) else text.encode('ascii'))
+        return h.hexdigest()
+
+    def _next_timestamp(self) -> str:
+        """
+        ミリ秒単位のタイムスタンプ。連続したリクエストでも重複しないよう単調増加させる
+        """
+        with self.__timestamp_lock:
+            timestamp = max(time.time_ns() // 1000000, self.__last_timestamp + 1)
+            self.__last_timestamp = timestamp
+        return str(timestamp)
+
+    def _build_private_request(self, method, path, req_body=None, sign_body=True):
+        """
+        プライベートAPIのヘッダーと送信データを作る。ボディのシリアライズは1回だけで、署名もそのバイト列に対して行う
+        :return: (headers, data)
+        """
+        timestamp = self._next_timestamp()
+        data = json.dumps(req_body).encode('ascii') if req_body is not None else None
+        message = (timestamp + method + path).encode('ascii')
+        if sign_body and data is not None:
+            message += data
+        return self._headers_for_private(timestamp, self._create_sign(message)), data
 
     def _headers_for_private(self, timestamp, sign):
         return {
@@ -62,47 +153,27 @@ class GMO:
         }
 
     def _send_private_get(self, path, parameters={}):
-        if not self.__get_limiter.enabled_call():
-            time.sleep(1)
-            self.__get_limiter.reset()
+        waited = self.__get_limiter.wait()
 
-        timestamp = '{0}000'.format(int(time.mktime(datetime.now().timetuple())))
-        method = 'GET'
-        end_point = 'https://api.coin.z.com/private'
-
-        text = timestamp + method + path
-        sign = self._create_sign(text)
-        headers = self._headers_for_private(timestamp, sign)
-
-        res = requests.get(end_point + path, headers=headers, params=parameters).json()
-        self.__get_limiter.increase_call()
+        headers, _ = self._build_private_request('GET', path)
+        res = self._request('GET', self._private + path, waited, headers=headers, params=parameters)
         if res['status'] == 0:
             return res['data']
         else:
             raise Exception('Request Failed with status {}'.format(res['status']))
 
     def _send_private_post(self, path, req_body={}):
-        if not self.__post_limiter.enabled_call():
-            time.sleep(1)
-            self.__post_limiter.reset()
-
-        timestamp = '{0}000'.format(int(time.mktime(datetime.now().timetuple())))
-        method = 'POST'
-        end_point = 'https://api.coin.z.com/private'
+        waited = self.__post_limiter.wait()
 
-        text = timestamp + method + path + json.dumps(req_body)
-        sign = self._create_sign(text)
-        headers = self._headers_for_private(timestamp, sign)
-
-        res = requests.post(end_point + path, headers=headers, data=json.dumps(req_body)).json()
-        self.__post_limiter.increase_call()
+        headers, data = self._build_private_request('POST', path, req_body)
+        res = self._request('POST', self._private + path, waited, headers=headers, data=data)
         if res['status'] == 0:
             if 'data' in res:
                 return res['data']
             else:
                 return True
         else:
-            print(res['message']['message_code'], res['message']['message_string'])
+            print(res['messages'][0]['message_code'], res['messages'][0]['message_string'])
             return False
 
     def account_margin(self):
@@ -178,38 +249,26 @@ class GMO:
         return self._send_private_post('/v1/ws-auth')
 
     def extend_ws_access_token(self, token):
-        timestamp = '{0}000'.format(int(time.mktime(datetime.now().timetuple())))
-        method = 'PUT'
-        end_point = 'https://api.coin.z.com/private'
         path = '/v1/ws-auth'
         req_body = {
             "token": token
         }
 
-        text = timestamp + method + path
-        sign = self._create_sign(text)
-        headers = self._headers_for_private(timestamp, sign)
-
-        res = requests.put(end_point + path, headers=headers, data=json.dumps(req_body)).json()
+        headers, data = self._build_private_request('PUT', path, req_body, sign_body=False)
+        res = self._request('PUT', self._private + path, headers=headers, data=data)
         if res['status'] == 0:
             return True
         else:
             raise Exception('Request Failed with status {}'.format(res['status']))
 
     def delete_ws_access_token(self, token):
-        timestamp = '{0}000'.format(int(time.mktime(datetime.now().timetuple())))
-        method = 'DELETE'
-        end_point = 'https://api.coin.z.com/private'
         path = '/v1/ws-auth'
         req_body = {
             "token": token
         }
 
-        text = timestamp + method + path
-        sign = self._create_sign(text)
-        headers = self._headers_for_private(timestamp, sign)
-
-        res = requests.delete(end_point + path, headers=headers, data=json.dumps(req_body)).json()
+        headers, data = self._build_private_request('DELETE', path, req_body, sign_body=False)
+        res = self._request('DELETE', self._private + path, headers=headers, data=data)
         if res['status'] == 0:
             return True
         else:
@@ -282,6 +341,13 @@ class GMO:
     def tickcer(self, symbol):
         return self._send_public('/v1/ticker?symbol={}'.format(symbol))
 
+    def tickers(self):
+        """
+        全銘柄の最新レート
+        :return: {symbol: ticker}
+        """
+        return {t['symbol']: t for t in self._send_public('/v1/ticker')}
+
     def orderbooks(self, symbol):
         """
 
@@ -294,7 +360,7 @@ class GMO:
         return self._send_public('/v1/trades?symbol={}&page={}&count={}'.format(symbol, page, count))
 
     def status(self):
-        response = requests.get(self._public + '/v1/status').json()
+        response = self._request('GET', self._public + '/v1/status')
         if response['status'] == 0:
             return response['data']
         elif response['status'] == 5 and response['messages'][0]['message_code'] == 'ERR-5201':
@@ -305,37 +371,68 @@ class GMO:
 
     # endregion public api
     # region websockets
-    def subscribe_public_ws(self, channel, symbol, on_message):
-        entry_point = 'wss://api.coin.z.com/ws/public/v1'
-        ws = websocket.WebSocketApp(entry_point,
+    def subscribe_public_ws(self, channel, symbol, on_message, on_close=None):
+        """
+        :param on_close: 切断時に呼ばれるコールバック（引数は WebSocketApp）
+        """
+        entry_point = self._ws_url + '/public/v1'
+        ws = _websocket().WebSocketApp(entry_point,
                                     on_open=lambda wws: wws.send(json.dumps({
                                         "command": "subscribe",
                                         "channel": channel,
                                         "symbol": symbol})
                                     ),
-                                    on_message=on_message
+                                    on_message=on_message,
+                                    on_error=lambda wws, e: print(e, file=sys.stderr),
+                                    on_close=lambda wws, *args: on_close(wws) if on_close else None
                                     )
         _thread.start_new_thread(lambda: ws.run_forever(), ())
         return ws
 
-    def subscribe_private_ws(self, token, channel, on_message) -> websocket.WebSocketApp:
-        entry_point = 'wss://api.coin.z.com/ws/private/v1/' + token
-        ws = websocket.WebSocketApp(entry_point,
+    def subscribe_private_ws(self, token, channel, on_message, on_close=None):
+        """
+        :param on_close: 切断時に呼ばれるコールバック（引数は WebSocketApp）
+        """
+        entry_point = self._ws_url + '/private/v1/' + token
+        ws = _websocket().WebSocketApp(entry_point,
                                     on_open=lambda wws: wws.send(json.dumps({
                                         "command": "subscribe",
                                         "channel": channel})
                                     ),
                                     on_message=on_message,
                                     on_error=lambda wws, e: print(e, file=sys.stderr),
-                                    on_close=lambda wws: print("WEBSOCKET [{}] CLOSED".format(wws.url), file=sys.stderr)
+                                    on_close=lambda wws, *args: self._on_private_ws_closed(wws, on_close)
                                     )
         _thread.start_new_thread(lambda: ws.run_forever(), ())
         return ws
 
+    @staticmethod
+    def _on_private_ws_closed(ws, on_close):
+        print("WEBSOCKET [{}] CLOSED".format(ws.url), file=sys.stderr)
+        if on_close:
+            on_close(ws)
+
+    # endregion websockets
+
+def to_epoch_ms(value) -> int:
+    """
+    GMOのタイムスタンプ（ISO8601文字列）、datetime、エポックミリ秒をエポックミリ秒に変換
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        return int(value.timestamp() * 1000)
+    return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+
 class Position:
+    """
+    建玉。メモリ節約のため __slots__ で保持し、生データは残さない
+    timestamp はエポックミリ秒
+    """
+    __slots__ = ('id', 'symbol', 'side', 'size', 'orderdSize', 'price', 'lossGain', 'leverage', 'timestamp')
+
     def __init__(self, raw_data):
-        self.raw = raw_data
-        self.id = raw_data['positionId']
+        self.id = int(raw_data['positionId'])
         self.symbol = raw_data['symbol']
         self.side = raw_data['side']
         self.size = float(raw_data['size'])
@@ -343,10 +440,12 @@ class Position:
         self.price = float(raw_data['price'])
         self.lossGain = float(raw_data['lossGain'])
         self.leverage = int(raw_data['leverage'])
-        self.timestamp = pd.to_datetime(raw_data['timestamp'])
+        self.timestamp = to_epoch_ms(raw_data['timestamp'])
 
 class PositionJSONEncoder(JSONEncoder):
     def default(self, o):
+        if hasattr(o, '__slots__'):
+            return {k: getattr(o, k) for c in type(o).__mro__ for k in getattr(c, '__slots__', ()) if hasattr(o, k)}
         return o.__dict__
 
 
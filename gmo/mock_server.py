@@ -0,0 +1,848 @@
+"""
+ローカルで動く GMOコイン の模擬取引所（負荷・レイテンシ試験用）
+
+GMO クラスが使う REST API とパブリック/プライベートのWebソケットを1つのポートで提供する。
+約定の流れは合成（ランダムウォーク）か、記録した約定履歴（JSONL）の再生で、rate 件/秒で配信する。
+指値は配信した約定価格が指値に届いた時点で全量約定し、FOK・FAK・成行は受付時の直近価格で判定する。
+署名（API-SIGN）は検証しない。API-KEY ヘッダーをアカウント名として扱い、プライベートチャンネルのイベントは
+発注したアカウントのトークンで購読している接続にだけ配信する（残高・建玉・注文の一覧は全アカウントで共有）。
+
+    python -m gmo.mock_server --port 8080 --rate 100
+
+クライアント側は設定に "rest_url": "http://127.0.0.1:8080", "ws_url": "ws://127.0.0.1:8080/ws" を指定する。
+終了時（Ctrl-C）と GET /mock/stats で配信件数・スループット・注文の反応時間などを返す。
+"""
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import random
+import struct
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WS_OPCODE_TEXT = 0x1
+WS_OPCODE_CLOSE = 0x8
+WS_OPCODE_PING = 0x9
+WS_OPCODE_PONG = 0xA
+
+LEVERAGE_RATE = 4
+TRADE_HISTORY = 1000
+EXECUTION_HISTORY = 10000  # GET /private/v1/executions で返す約定の件数
+ORDER_HISTORY = 10000  # GET /private/v1/orders で返す終了済み注文の件数
+BOOK_DEPTH = 20
+PUBLIC_CHANNELS = ('ticker', 'trades', 'orderbooks')
+
+
+def _iso(ms):
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def _now_ms():
+    return time.time_ns() // 1000000
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1], 'count': len(values)}
+
+
+class ExchangeError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+# region websocket
+class WebsocketConnection:
+    """
+    RFC6455 の最小限のサーバー実装（テキストフレーム・ping/pong・close のみ、分割フレームは非対応）
+    """
+
+    def __init__(self, sock, rfile):
+        self._sock = sock
+        self._rfile = rfile
+        self._lock = threading.Lock()
+        self.closed = False
+
+    @staticmethod
+    def accept_key(key):
+        return base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+
+    def recv(self):
+        """
+        :return: 受信したテキスト。切断されたら None
+        """
+        while not self.closed:
+            header = self._rfile.read(2)
+            if len(header) < 2:
+                self.closed = True
+                return None
+
+            opcode = header[0] & 0x0F
+            masked = header[1] & 0x80
+            length = header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('>H', self._rfile.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('>Q', self._rfile.read(8))[0]
+            mask = self._rfile.read(4) if masked else None
+            payload = self._rfile.read(length)
+            if mask:
+                # 4バイトのマスクを payload の長さまで繰り返して整数の XOR でまとめて外す
+                key = (mask * (length // 4 + 1))[:length]
+                payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+            if opcode == WS_OPCODE_TEXT:
+                return payload.decode('utf-8')
+            if opcode == WS_OPCODE_PING:
+                self._send_frame(WS_OPCODE_PONG, payload)
+            elif opcode == WS_OPCODE_CLOSE:
+                self.close()
+                return None
+        return None
+
+    def send(self, text):
+        self._send_frame(WS_OPCODE_TEXT, text.encode('utf-8'))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._send_frame(WS_OPCODE_CLOSE, b'')
+        finally:
+            self.closed = True
+
+    def _send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self._sock.sendall(header + payload)
+            except OSError:
+                self.closed = True
+# endregion websocket
+
+
+class MockExchange:
+    """
+    模擬取引所の状態（レート・注文・建玉・残高）と購読者の管理
+
+    状態は1つのロックで守る。Webソケットへの配信はロックの外で行う。
+    """
+
+    def __init__(self, symbols=('BTC_JPY',), price=5000000, volatility=0.0002, spread=100, init_jpy=1000000,
+                 rate=10.0, replay_path=None):
+        self.symbols = list(symbols)
+        self.rate = rate
+        self._volatility = volatility
+        self._spread = spread
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+        self._last = {s: float(price) for s in self.symbols}
+        self._trades = {s: deque(maxlen=TRADE_HISTORY) for s in self.symbols}
+        self._replay = self._load_replay(replay_path) if replay_path else None
+
+        self.jpy = float(init_jpy)
+        self.assets = {}
+        self.orders = {}  # 注文ID -> 注文（有効な注文と、終了済みの注文を ORDER_HISTORY 件まで）
+        self._open_orders = {s: {} for s in self.symbols}  # 銘柄 -> {注文ID: 有効（ORDERED）な注文}
+        self._finished_orders = deque()  # 終了済みの注文ID（古い順）
+        self.positions = {}
+        self.executions = deque(maxlen=EXECUTION_HISTORY)
+        self.tokens = {}  # トークン -> アカウント（API-KEY）
+
+        self._public_subscribers = {}  # (channel, symbol) -> [WebsocketConnection]
+        self._private_subscribers = {}  # (account, channel) -> [WebsocketConnection]
+
+        # 計測
+        self.started_at = time.monotonic()
+        self.sent_messages = 0
+        self.sent_trades = 0
+        self.flow_lag_ms = 0.0
+        self._last_trade_sent = None
+        self.reaction_ms = deque(maxlen=100000)  # 直前の約定配信から注文受付までの時間
+        self.rest_ms = deque(maxlen=100000)  # REST の処理時間
+
+    @staticmethod
+    def _load_replay(path):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    # region market flow
+    def run_flow(self, stop_event: threading.Event):
+        """
+        rate 件/秒で約定を生成して配信する。処理が遅れた分は次の周期で詰めて送り、平均レートを保つ
+        """
+        replay = itertools.cycle(self._replay) if self._replay else None
+        interval = 1.0 / self.rate
+        deadline = time.monotonic()
+        while not stop_event.is_set():
+            now = time.monotonic()
+            if deadline > now:
+                stop_event.wait(deadline - now)
+                continue
+            self.flow_lag_ms = (now - deadline) * 1000
+            deadline += interval
+
+            if replay:
+                raw = next(replay)
+                symbol = raw.get('symbol', self.symbols[0])
+                price, size, side = float(raw['price']), float(raw['size']), raw['side']
+            else:
+                symbol = random.choice(self.symbols)
+                price = self._last[symbol] * (1 + random.gauss(0, self._volatility))
+                size = round(random.expovariate(1 / 0.01), 4) or 0.0001
+                side = random.choice(('BUY', 'SELL'))
+            self.publish_trade(symbol, round(price), size, side)
+
+    def publish_trade(self, symbol, price, size, side):
+        now = _now_ms()
+        trade = {'price': str(price), 'side': side, 'size': str(size), 'timestamp': _iso(now), 'symbol': symbol}
+        with self._lock:
+            self._last[symbol] = float(price)
+            self._trades[symbol].appendleft(trade)
+            events = self._match(symbol, float(price), now)
+
+        self._broadcast('trades', symbol, dict(trade, channel='trades'))
+        self._broadcast('ticker', symbol, dict(self.ticker(symbol), channel='ticker'))
+        self._broadcast('orderbooks', symbol, dict(self.orderbook(symbol), channel='orderbooks'))
+        self._publish_private(events)
+        self._last_trade_sent = time.monotonic()
+        self.sent_trades += 1
+
+    def ticker(self, symbol):
+        last = self._last[symbol]
+        return {
+            'ask': str(round(last + self._spread / 2)),
+            'bid': str(round(last - self._spread / 2)),
+            'high': str(round(last)),
+            'last': str(round(last)),
+            'low': str(round(last)),
+            'symbol': symbol,
+            'timestamp': _iso(_now_ms()),
+            'volume': '0',
+        }
+
+    def orderbook(self, symbol):
+        last = self._last[symbol]
+        half = self._spread / 2
+        return {
+            'asks': [{'price': str(round(last + half + i * self._spread)), 'size': '{:.4f}'.format(0.01 * (i + 1))}
+                     for i in range(BOOK_DEPTH)],
+            'bids': [{'price': str(round(last - half - i * self._spread)), 'size': '{:.4f}'.format(0.01 * (i + 1))}
+                     for i in range(BOOK_DEPTH)],
+            'symbol': symbol,
+            'timestamp': _iso(_now_ms()),
+        }
+
+    def trades(self, symbol, page, count):
+        history = list(self._trades[symbol])
+        return {
+            'pagination': {'currentPage': page, 'count': count},
+            'list': history[(page - 1) * count:page * count],
+        }
+    # endregion market flow
+
+    # region orders
+    def place_order(self, body, settle_type='OPEN', settle_position=None, account=''):
+        if self._last_trade_sent is not None:
+            self.reaction_ms.append((time.monotonic() - self._last_trade_sent) * 1000)
+
+        symbol = body['symbol']
+        if symbol not in self._last:
+            raise ExchangeError('ERR-5106', 'Invalid request parameter.')
+
+        now = _now_ms()
+        order = {
+            'rootOrderId': 0,
+            'orderId': 0,
+            'symbol': symbol,
+            'side': body['side'],
+            'orderType': 'NORMAL',
+            'executionType': body['executionType'],
+            'settleType': settle_type,
+            'size': body['size'],
+            'executedSize': '0',
+            'price': body.get('price', '0'),
+            'losscutPrice': body.get('losscutPrice', '0'),
+            'status': 'ORDERED',
+            'timeInForce': body.get('timeInForce', 'FAS'),
+            'timestamp': _iso(now),
+        }
+        with self._lock:
+            order['rootOrderId'] = order['orderId'] = next(self._ids)
+            if settle_type == 'OPEN' and not self._has_margin(order):
+                raise ExchangeError('ERR-201', 'Trading margin is insufficient.')
+            order['_settle'] = settle_position or []
+            order['_account'] = account
+            self.orders[order['orderId']] = order
+            events = [(account, 'orderEvents', self._order_event(order, 'NOR'))]
+            events += self._try_fill_on_arrival(order, now)
+            if order['status'] == 'ORDERED':
+                self._open_orders[symbol][order['orderId']] = order
+
+        self._publish_private(events)
+        return str(order['orderId'])
+
+    def close_bulk(self, body, account=''):
+        """
+        反対側の建玉を古い順に size 分だけ決済する
+        """
+        close_side = 'SELL' if body['side'] == 'BUY' else 'BUY'
+        remaining = float(body['size'])
+        settle = []
+        with self._lock:
+            for p in self.positions.values():
+                if remaining <= 0:
+                    break
+                if p['symbol'] == body['symbol'] and p['side'] == close_side:
+                    size = min(float(p['size']), remaining)
+                    settle.append({'positionId': p['positionId'], 'size': str(size)})
+                    remaining -= size
+        if not settle:
+            raise ExchangeError('ERR-422', 'There are no open positions.')
+        return self.place_order(body, 'CLOSE', settle, account)
+
+    def cancel(self, order_ids):
+        success, failed = [], []
+        with self._lock:
+            events = []
+            for order_id in order_ids:
+                order = self.orders.get(int(order_id))
+                if order is None or order['status'] not in ('WAITING', 'ORDERED'):
+                    failed.append({'message_code': 'ERR-5122', 'message_string': 'The request is invalid.',
+                                   'orderId': order_id})
+                    continue
+                order['status'] = 'CANCELED'
+                self._finish(order)
+                events.append((order['_account'], 'orderEvents', self._order_event(order, 'COR')))
+                success.append(int(order_id))
+        self._publish_private(events)
+        return {'success': success, 'failed': failed}
+
+    def _has_margin(self, order):
+        required = float(order['price'] or self._last[order['symbol']]) * float(order['size'])
+        if '_' in order['symbol']:
+            required /= LEVERAGE_RATE
+        return self.available_amount() >= required
+
+    def _try_fill_on_arrival(self, order, now):
+        last = self._last[order['symbol']]
+        if order['executionType'] == 'MARKET' or self._crosses(order, last):
+            price = last if order['executionType'] == 'MARKET' else float(order['price'])
+            return self._fill(order, price, now)
+        if order['timeInForce'] in ('FOK', 'FAK'):
+            order['status'] = 'CANCELED'
+            self._finish(order)
+            return [(order['_account'], 'orderEvents', self._order_event(order, 'COR'))]
+        return []
+
+    def _match(self, symbol, price, now):
+        events = []
+        for order in [o for o in self._open_orders[symbol].values() if self._crosses(o, price)]:
+            events += self._fill(order, float(order['price']), now)
+        return events
+
+    def _finish(self, order):
+        """
+        約定・取消した注文を有効な注文から外し、古い終了済み注文を忘れる
+        """
+        self._open_orders[order['symbol']].pop(order['orderId'], None)
+        self._finished_orders.append(order['orderId'])
+        while len(self._finished_orders) > ORDER_HISTORY:
+            self.orders.pop(self._finished_orders.popleft(), None)
+
+    def active_orders(self, symbol):
+        with self._lock:
+            return [self.public_order(o) for o in self._open_orders.get(symbol, {}).values()]
+
+    @staticmethod
+    def _crosses(order, price):
+        limit = float(order['price'])
+        return price <= limit if order['side'] == 'BUY' else price >= limit
+
+    def _fill(self, order, price, now):
+        size = float(order['size'])
+        order['status'] = 'EXECUTED'
+        order['executedSize'] = order['size']
+        self._finish(order)
+        execution = {
+            'executionId': next(self._ids),
+            'orderId': order['orderId'],
+            'symbol': order['symbol'],
+            'side': order['side'],
+            'settleType': order['settleType'],
+            'size': order['size'],
+            'price': str(round(price)),
+            'lossGain': '0',
+            'fee': '0',
+            'timestamp': _iso(now),
+            'positionId': 0,
+        }
+        events = []
+        if '_' not in order['symbol']:
+            # 現物
+            asset = order['symbol']
+            sign = 1 if order['side'] == 'BUY' else -1
+            self.assets[asset] = self.assets.get(asset, 0.0) + sign * size
+            self.jpy -= sign * price * size
+        elif order['settleType'] == 'OPEN':
+            position = {
+                'positionId': next(self._ids),
+                'symbol': order['symbol'],
+                'side': order['side'],
+                'size': order['size'],
+                'orderdSize': '0',
+                'price': str(round(price)),
+                'lossGain': '0',
+                'leverage': str(LEVERAGE_RATE),
+                'losscutPrice': '0',
+                'timestamp': _iso(now),
+            }
+            self.positions[position['positionId']] = position
+            execution['positionId'] = position['positionId']
+            events.append((order['_account'], 'positionEvents', dict(position, msgType='OPR')))
+        else:
+            loss_gain = 0.0
+            for settle in order['_settle']:
+                position = self.positions.pop(int(settle['positionId']), None)
+                if position is None:
+                    continue
+                entry = float(position['price'])
+                pnl = (price - entry) if position['side'] == 'BUY' else (entry - price)
+                loss_gain += pnl * float(position['size'])
+                execution['positionId'] = position['positionId']
+                events.append((order['_account'], 'positionEvents', dict(position, msgType='CPR')))
+            self.jpy += loss_gain
+            execution['lossGain'] = '{:.0f}'.format(loss_gain)
+
+        self.executions.append(execution)
+        events.insert(0, (order['_account'], 'executionEvents', self._execution_event(order, execution)))
+        return events
+
+    @staticmethod
+    def _order_event(order, msg_type):
+        return {
+            'orderId': order['orderId'],
+            'symbol': order['symbol'],
+            'settleType': order['settleType'],
+            'executionType': order['executionType'],
+            'side': order['side'],
+            'orderStatus': order['status'],
+            'orderTimestamp': order['timestamp'],
+            'orderPrice': order['price'],
+            'orderSize': order['size'],
+            'orderExecutedSize': order['executedSize'],
+            'losscutPrice': order['losscutPrice'],
+            'timeInForce': order['timeInForce'],
+            'msgType': msg_type,
+        }
+
+    @staticmethod
+    def _execution_event(order, execution):
+        return {
+            'executionId': execution['executionId'],
+            'orderId': order['orderId'],
+            'symbol': order['symbol'],
+            'settleType': order['settleType'],
+            'executionType': order['executionType'],
+            'side': order['side'],
+            'executionPrice': execution['price'],
+            'executionSize': execution['size'],
+            'positionId': execution['positionId'],
+            'orderTimestamp': order['timestamp'],
+            'executionTimestamp': execution['timestamp'],
+            'lossGain': execution['lossGain'],
+            'fee': execution['fee'],
+            'orderPrice': order['price'],
+            'orderSize': order['size'],
+            'orderExecutedSize': order['executedSize'],
+            'timeInForce': order['timeInForce'],
+            'msgType': 'ER',
+        }
+
+    def public_order(self, order):
+        return {k: v for k, v in order.items() if not k.startswith('_')}
+    # endregion orders
+
+    # region account
+    def unrealized(self):
+        total = 0.0
+        for p in self.positions.values():
+            last = self._last[p['symbol']]
+            entry = float(p['price'])
+            total += ((last - entry) if p['side'] == 'BUY' else (entry - last)) * float(p['size'])
+        return total
+
+    def used_margin(self):
+        return sum(float(p['price']) * float(p['size']) / LEVERAGE_RATE for p in self.positions.values())
+
+    def available_amount(self):
+        return self.jpy + self.unrealized() - self.used_margin()
+
+    def margin(self):
+        with self._lock:
+            unrealized = self.unrealized()
+            return {
+                'actualProfitLoss': '{:.0f}'.format(self.jpy + unrealized),
+                'availableAmount': '{:.0f}'.format(self.available_amount()),
+                'margin': '{:.0f}'.format(self.used_margin()),
+                'profitLoss': '{:.0f}'.format(unrealized),
+            }
+
+    def asset_list(self):
+        with self._lock:
+            assets = [{'symbol': 'JPY', 'amount': '{:.0f}'.format(self.jpy),
+                       'available': '{:.0f}'.format(self.available_amount()), 'conversionRate': '1'}]
+            for symbol, amount in self.assets.items():
+                assets.append({'symbol': symbol, 'amount': str(amount), 'available': str(amount),
+                               'conversionRate': str(self._last.get(symbol, 0))})
+            return assets
+    # endregion account
+
+    # region subscribers
+    def subscribe(self, conn, channel, symbol=None, account=None):
+        """
+        :param account: プライベートチャンネルの場合は購読したトークンのアカウント
+        """
+        with self._lock:
+            if account is not None:
+                self._private_subscribers.setdefault((account, channel), []).append(conn)
+            else:
+                self._public_subscribers.setdefault((channel, symbol), []).append(conn)
+
+    def unsubscribe(self, conn):
+        with self._lock:
+            for subscribers in itertools.chain(self._public_subscribers.values(), self._private_subscribers.values()):
+                if conn in subscribers:
+                    subscribers.remove(conn)
+
+    def _broadcast(self, channel, symbol, message):
+        subscribers = self._public_subscribers.get((channel, symbol))
+        if subscribers:
+            self._send_all(list(subscribers), json.dumps(message))
+
+    def _publish_private(self, events):
+        """
+        :param events: [(アカウント, チャンネル, メッセージ)]
+        """
+        for account, channel, message in events:
+            subscribers = self._private_subscribers.get((account, channel))
+            if subscribers:
+                self._send_all(list(subscribers), json.dumps(dict(message, channel=channel)))
+
+    def _send_all(self, subscribers, text):
+        for conn in subscribers:
+            conn.send(text)
+            if conn.closed:
+                self.unsubscribe(conn)
+            else:
+                self.sent_messages += 1
+    # endregion subscribers
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started_at
+        return {
+            'elapsed_sec': elapsed,
+            'sent_trades': self.sent_trades,
+            'sent_messages': self.sent_messages,
+            'messages_per_sec': self.sent_messages / elapsed if elapsed else 0.0,
+            'target_trades_per_sec': self.rate,
+            'flow_lag_ms': self.flow_lag_ms,
+            'orders': len(self.orders),
+            'open_orders': sum(len(orders) for orders in self._open_orders.values()),
+            'open_positions': len(self.positions),
+            'reaction_ms': _percentiles(list(self.reaction_ms)),
+            'rest_ms': _percentiles(list(self.rest_ms)),
+        }
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    exchange: MockExchange = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # region http
+    def do_GET(self):
+        if self.headers.get('Upgrade', '').lower() == 'websocket':
+            self._serve_websocket()
+        else:
+            self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        started = time.monotonic()
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+
+        route = ROUTES.get((method, url.path))
+        if url.path == '/mock/stats':
+            self._reply(200, self.exchange.stats())
+            return
+        if route is None:
+            self._reply(404, self._error('ERR-404', 'Not found.'))
+            return
+
+        try:
+            data = route(self.exchange, query, body, self.headers.get('API-KEY') or '')
+            res = {'status': 0, 'responsetime': _iso(_now_ms())}
+            if data is not None:
+                res['data'] = data
+        except ExchangeError as e:
+            res = self._error(e.code, str(e))
+        except (KeyError, ValueError, TypeError):
+            res = self._error('ERR-5106', 'Invalid request parameter.')
+        self._reply(200, res)
+        self.exchange.rest_ms.append((time.monotonic() - started) * 1000)
+
+    @staticmethod
+    def _error(code, message):
+        return {'status': 1, 'messages': [{'message_code': code, 'message_string': message}],
+                'responsetime': _iso(_now_ms())}
+
+    def _reply(self, code, obj):
+        payload = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+    # endregion http
+
+    def _serve_websocket(self):
+        path = urlparse(self.path).path
+        private = path.startswith('/ws/private/v1/')
+        account = self.exchange.tokens.get(path.rsplit('/', 1)[-1]) if private else None
+        if private and account is None:
+            self.send_error(401)
+            return
+        if not private and path != '/ws/public/v1':
+            self.send_error(404)
+            return
+
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', WebsocketConnection.accept_key(self.headers['Sec-WebSocket-Key']))
+        self.end_headers()
+        self.wfile.flush()
+
+        conn = WebsocketConnection(self.connection, self.rfile)
+        try:
+            while True:
+                text = conn.recv()
+                if text is None:
+                    break
+                command = json.loads(text)
+                if command.get('command') == 'subscribe':
+                    self.exchange.subscribe(conn, command['channel'], command.get('symbol'), account)
+                elif command.get('command') == 'unsubscribe':
+                    self.exchange.unsubscribe(conn)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.exchange.unsubscribe(conn)
+            conn.closed = True
+            self.close_connection = True
+
+
+# region routes
+def _route_status(ex, query, body, account):
+    return {'status': 'OPEN'}
+
+
+def _route_ticker(ex, query, body, account):
+    symbols = [query['symbol']] if 'symbol' in query else ex.symbols
+    return [ex.ticker(s) for s in symbols if s in ex.symbols]
+
+
+def _route_orderbooks(ex, query, body, account):
+    return ex.orderbook(query['symbol'])
+
+
+def _route_trades(ex, query, body, account):
+    return ex.trades(query['symbol'], int(query.get('page', 1)), int(query.get('count', 100)))
+
+
+def _route_order(ex, query, body, account):
+    return ex.place_order(body, account=account)
+
+
+def _route_close_order(ex, query, body, account):
+    size = sum(float(s['size']) for s in body['settlePosition'])
+    return ex.place_order(dict(body, size=str(size)), 'CLOSE', body['settlePosition'], account)
+
+
+def _route_close_bulk_order(ex, query, body, account):
+    return ex.close_bulk(body, account)
+
+
+def _route_cancel_order(ex, query, body, account):
+    if not ex.cancel([body['orderId']])['success']:
+        raise ExchangeError('ERR-5122', 'The request is invalid.')
+
+
+def _route_cancel_orders(ex, query, body, account):
+    return ex.cancel(body['orderIds'])
+
+
+def _paginate(items, query):
+    page, count = int(query.get('page', 1)), int(query.get('count', 100))
+    items = items[(page - 1) * count:page * count]
+    # GMO は該当が無い場合 data を空オブジェクトで返す
+    return {'pagination': {'currentPage': page, 'count': count}, 'list': items} if items else {}
+
+
+def _route_active_orders(ex, query, body, account):
+    return _paginate(ex.active_orders(query.get('symbol')), query)
+
+
+def _route_orders(ex, query, body, account):
+    ids = [int(i) for i in query.get('orderId', '').split(',') if i]
+    orders = [ex.orders.get(i) for i in ids]
+    return {'list': [ex.public_order(o) for o in orders if o is not None]}
+
+
+def _route_executions(ex, query, body, account):
+    if 'orderId' in query:
+        ids = {int(i) for i in query['orderId'].split(',')}
+        return {'list': [e for e in ex.executions if e['orderId'] in ids]}
+    execution_id = int(query.get('executionId', 0))
+    return {'list': [e for e in ex.executions if e['executionId'] == execution_id]}
+
+
+def _route_open_positions(ex, query, body, account):
+    return _paginate([p for p in list(ex.positions.values()) if p['symbol'] == query.get('symbol')], query)
+
+
+def _route_margin(ex, query, body, account):
+    return ex.margin()
+
+
+def _route_assets(ex, query, body, account):
+    return ex.asset_list()
+
+
+def _route_ws_auth(ex, query, body, account):
+    token = base64.urlsafe_b64encode(random.randbytes(24)).decode('ascii').rstrip('=')
+    ex.tokens[token] = account
+    return token
+
+
+def _route_ws_auth_extend(ex, query, body, account):
+    if body.get('token') not in ex.tokens:
+        raise ExchangeError('ERR-5130', 'Invalid token.')
+
+
+def _route_ws_auth_delete(ex, query, body, account):
+    ex.tokens.pop(body.get('token'), None)
+
+
+ROUTES = {
+    ('GET', '/public/v1/status'): _route_status,
+    ('GET', '/public/v1/ticker'): _route_ticker,
+    ('GET', '/public/v1/orderbooks'): _route_orderbooks,
+    ('GET', '/public/v1/trades'): _route_trades,
+    ('POST', '/private/v1/order'): _route_order,
+    ('POST', '/private/v1/closeOrder'): _route_close_order,
+    ('POST', '/private/v1/closeBulkOrder'): _route_close_bulk_order,
+    ('POST', '/private/v1/cancelOrder'): _route_cancel_order,
+    ('POST', '/private/v1/cancelOrders'): _route_cancel_orders,
+    ('GET', '/private/v1/activeOrders'): _route_active_orders,
+    ('GET', '/private/v1/orders'): _route_orders,
+    ('GET', '/private/v1/executions'): _route_executions,
+    ('GET', '/private/v1/openPositions'): _route_open_positions,
+    ('GET', '/private/v1/account/margin'): _route_margin,
+    ('GET', '/private/v1/account/assets'): _route_assets,
+    ('POST', '/private/v1/ws-auth'): _route_ws_auth,
+    ('PUT', '/private/v1/ws-auth'): _route_ws_auth_extend,
+    ('DELETE', '/private/v1/ws-auth'): _route_ws_auth_delete,
+}
+# endregion routes
+
+
+class MockServer:
+    """
+    模擬取引所の HTTP サーバーと約定配信スレッド
+    """
+
+    def __init__(self, exchange: MockExchange, host='127.0.0.1', port=8080):
+        self.exchange = exchange
+        handler = type('Handler', (MockRequestHandler,), {'exchange': exchange})
+        self._httpd = ThreadingHTTPServer((host, port), handler)
+        self._httpd.daemon_threads = True
+        self._stop = threading.Event()
+
+    @property
+    def rest_url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def ws_url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'ws://{}:{}/ws'.format(host, port)
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        threading.Thread(target=self.exchange.run_flow, args=(self._stop,), daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GMO coin mock exchange')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--symbols', default='BTC_JPY', help='カンマ区切り')
+    parser.add_argument('--rate', type=float, default=10.0, help='約定の配信件数/秒')
+    parser.add_argument('--price', type=float, default=5000000)
+    parser.add_argument('--volatility', type=float, default=0.0002)
+    parser.add_argument('--jpy', type=float, default=1000000)
+    parser.add_argument('--replay', help='再生する約定履歴（1行1件の JSON: price, size, side[, symbol]）')
+    args = parser.parse_args()
+
+    server = MockServer(MockExchange(args.symbols.split(','), args.price, args.volatility, init_jpy=args.jpy,
+                                     rate=args.rate, replay_path=args.replay), args.host, args.port)
+    server.start()
+    print("MOCK EXCHANGE: rest_url[{}] ws_url[{}] rate[{}/s]".format(server.rest_url, server.ws_url, args.rate))
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(server.exchange.stats()))
+    except KeyboardInterrupt:
+        server.stop()
+        print(json.dumps(server.exchange.stats(), indent=2))
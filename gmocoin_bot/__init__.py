@@ -1,2 +1,9 @@
-from . import bot
-from . import simulator
+import importlib
+
+# bot・simulator は依存が多いので、属性として参照された時に読み込む
+_SUBMODULES = ('bot', 'simulator')
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
@@ -0,0 +1,52 @@
+"""
+取引アカウントの設定
+
+    "accounts": [
+        {"name": "main", "access_key": "...", "secret_key": "...", "call_limit": 3},
+        {"name": "sub1", "access_key": "...", "secret_key": "..."}
+    ]
+
+bot_configs の "account" で使うアカウントを指定する（省略時は先頭のアカウント）。
+accounts が無い場合は従来どおりトップレベルの access_key / secret_key を1つのアカウントとして扱う。
+"""
+from gmo.gmo import GMO
+
+DEFAULT_ACCOUNT = 'default'
+
+
+def account_configs(config) -> list:
+    if 'accounts' in config:
+        return config['accounts']
+    return [{'name': DEFAULT_ACCOUNT, 'access_key': config['access_key'], 'secret_key': config['secret_key'],
+             'call_limit': config.get('call_limit', 3)}]
+
+
+def default_account(config) -> str:
+    return account_configs(config)[0]['name']
+
+
+def bot_account(config, bot_config) -> str:
+    """
+    ボットが使うアカウント名。存在しないアカウントなら ValueError
+    """
+    name = bot_config.get('account', default_account(config))
+    if name not in [a['name'] for a in account_configs(config)]:
+        raise ValueError("bot '{}': unknown account '{}'".format(bot_config['name'], name))
+    return name
+
+
+def create_accounts(config, limiters=None) -> dict:
+    """
+    アカウント毎の API クライアント（接続プール・呼び出し制限・Webソケットトークンはクライアント単位）
+
+    :param limiters: {アカウント名: (GET 用, POST 用)}。同じアカウントを複数プロセスで使う場合に、
+                     プロセス間で共有する呼び出し制限を渡す（呼び出し上限はアカウント単位のため）
+    :return: {アカウント名: GMO}
+    """
+    limiters = limiters or {}
+    accounts = {}
+    for account in account_configs(config):
+        accounts[account['name']] = GMO(account['access_key'], account['secret_key'],
+                                        rest_url=config.get('rest_url'), ws_url=config.get('ws_url'),
+                                        call_limit=account.get('call_limit', 3), limiters=limiters.get(account['name']))
+    return accounts
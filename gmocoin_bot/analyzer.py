@@ -0,0 +1,228 @@
+import math
+import time
+from array import array
+
+
+class Analyzer:
+    """
+    取引成績の集計
+
+    決済毎に O(1) で更新する。資産曲線は事前確保した配列に保持し（不足時は倍に拡張）、
+    ローリング Sharpe/Sortino は直近 window 件のリターンをリングバッファと累積和で計算する。
+    ライブのボットからは update、バックテストからは record を使う。
+    """
+    INITIAL_CAPACITY = 1024
+    ROLLING_WINDOW = 50
+
+    def __init__(self, init_jpy, window=ROLLING_WINDOW, capacity=INITIAL_CAPACITY):
+        self.init_jpy = init_jpy
+        self.trade_num = 0
+        self.win_num = 0
+        self.loss_gain = 0
+
+        # 資産曲線
+        self._capacity = max(capacity, 1)
+        self._equity = array('d', bytes(8 * self._capacity))
+        self._close_times = array('q', bytes(8 * self._capacity))
+        # 資産曲線・ローリング統計の先頭に当たる取引数（状態復元時に使う）
+        self._curve_offset = 0
+        self.peak_equity = init_jpy
+        self.max_drawdown = 0
+        self.max_drawdown_rate = 0.0
+
+        # ローリング統計（1取引あたりのリターン）
+        self._window = window
+        self._returns = array('d', bytes(8 * window))
+        self._return_sum = 0.0
+        self._return_sq_sum = 0.0
+        self._downside_sq_sum = 0.0
+
+        self.total_hold_ms = 0
+
+        # 時間帯別・売買別
+        self.hour_loss_gain = array('d', bytes(8 * 24))
+        self.hour_trade_num = array('l', bytes(array('l').itemsize * 24))
+        self.side_stats = {}
+
+    def expect_value(self):
+        if self.trade_num == 0:
+            return 0
+        return self.loss_gain / self.trade_num
+
+    def get_profit_rate(self):
+        if not self.init_jpy:
+            return 0
+        return self.loss_gain / self.init_jpy
+
+    def get_win_rate(self):
+        if self.trade_num == 0:
+            return 0
+        return self.win_num / self.trade_num
+
+    def update(self, execute_position):
+        self.record(int(execute_position.lossGain),
+                    side=execute_position.type,
+                    hold_ms=int(execute_position.get_keep_time().total_seconds() * 1000))
+
+    def record(self, loss_gain, side=None, hold_ms=0, close_time_ms=None):
+        """
+        決済1件を集計に加える
+
+        :param loss_gain: 確定損益
+        :param side: BUY|SELL
+        :param hold_ms: 保有時間（ミリ秒）
+        :param close_time_ms: 決済時刻（エポックミリ秒）。省略時は現在時刻
+        """
+        if close_time_ms is None:
+            close_time_ms = int(time.time() * 1000)
+
+        equity_before = self.init_jpy + self.loss_gain
+        if loss_gain >= 0:
+            self.win_num += 1
+        self.loss_gain += loss_gain
+        n = self.trade_num - self._curve_offset
+        self.trade_num += 1
+        self.total_hold_ms += hold_ms
+
+        # 資産曲線とドローダウン
+        equity = self.init_jpy + self.loss_gain
+        if n >= self._capacity:
+            self._grow()
+        self._equity[n] = equity
+        self._close_times[n] = close_time_ms
+        if equity > self.peak_equity:
+            self.peak_equity = equity
+        drawdown = self.peak_equity - equity
+        if drawdown > self.max_drawdown:
+            self.max_drawdown = drawdown
+            self.max_drawdown_rate = drawdown / self.peak_equity if self.peak_equity else 0.0
+
+        # ローリングリターン
+        r = loss_gain / equity_before if equity_before else 0.0
+        slot = n % self._window
+        if n >= self._window:
+            old = self._returns[slot]
+            self._return_sum -= old
+            self._return_sq_sum -= old * old
+            if old < 0:
+                self._downside_sq_sum -= old * old
+        self._returns[slot] = r
+        self._return_sum += r
+        self._return_sq_sum += r * r
+        if r < 0:
+            self._downside_sq_sum += r * r
+
+        # 時間帯別・売買別
+        hour = time.localtime(close_time_ms / 1000).tm_hour
+        self.hour_loss_gain[hour] += loss_gain
+        self.hour_trade_num[hour] += 1
+        if side is not None:
+            stats = self.side_stats.get(side)
+            if stats is None:
+                stats = self.side_stats[side] = [0, 0, 0]
+            stats[0] += 1
+            if loss_gain >= 0:
+                stats[1] += 1
+            stats[2] += loss_gain
+
+    def _grow(self):
+        self._equity.extend(array('d', bytes(8 * self._capacity)))
+        self._close_times.extend(array('q', bytes(8 * self._capacity)))
+        self._capacity *= 2
+
+    def _rolling_count(self):
+        return min(self.trade_num - self._curve_offset, self._window)
+
+    def rolling_sharpe(self):
+        n = self._rolling_count()
+        if n < 2:
+            return 0.0
+        mean = self._return_sum / n
+        var = max(self._return_sq_sum / n - mean * mean, 0.0)
+        return mean / math.sqrt(var) if var > 0 else 0.0
+
+    def rolling_sortino(self):
+        n = self._rolling_count()
+        if n < 2:
+            return 0.0
+        mean = self._return_sum / n
+        downside = math.sqrt(max(self._downside_sq_sum, 0.0) / n)
+        return mean / downside if downside > 0 else 0.0
+
+    def average_hold_time(self):
+        """
+        :return: 平均保有時間（秒）
+        """
+        if self.trade_num == 0:
+            return 0.0
+        return self.total_hold_ms / self.trade_num / 1000
+
+    def equity_curve(self):
+        """
+        :return: [(決済時刻(エポックミリ秒), 資産)]
+        """
+        n = self.trade_num - self._curve_offset
+        return list(zip(self._close_times[:n], self._equity[:n]))
+
+    def to_dict(self):
+        return {
+            'init_jpy': self.init_jpy,
+            'trade_num': self.trade_num,
+            'win_num': self.win_num,
+            'win_rate': self.get_win_rate(),
+            'loss_gain': self.loss_gain,
+            'expect_value': self.expect_value(),
+            'profit_rate': self.get_profit_rate(),
+            'max_drawdown': self.max_drawdown,
+            'max_drawdown_rate': self.max_drawdown_rate,
+            'rolling_sharpe': self.rolling_sharpe(),
+            'rolling_sortino': self.rolling_sortino(),
+            'average_hold_time': self.average_hold_time(),
+            'hour_loss_gain': list(self.hour_loss_gain),
+            'hour_trade_num': list(self.hour_trade_num),
+            'side_stats': {side: {'trade_num': s[0], 'win_num': s[1], 'loss_gain': s[2]}
+                           for side, s in self.side_stats.items()},
+        }
+
+    def get_state(self):
+        """
+        再起動時に引き継ぐ集計値（資産曲線とローリング統計は含まない）
+        """
+        return {
+            'init_jpy': self.init_jpy,
+            'trade_num': self.trade_num,
+            'win_num': self.win_num,
+            'loss_gain': self.loss_gain,
+            'peak_equity': self.peak_equity,
+            'max_drawdown': self.max_drawdown,
+            'max_drawdown_rate': self.max_drawdown_rate,
+            'total_hold_ms': self.total_hold_ms,
+            'hour_loss_gain': list(self.hour_loss_gain),
+            'hour_trade_num': list(self.hour_trade_num),
+            'side_stats': self.side_stats,
+        }
+
+    def load_state(self, state):
+        self.init_jpy = state['init_jpy']
+        self.trade_num = state['trade_num']
+        self.win_num = state['win_num']
+        self.loss_gain = state['loss_gain']
+        self.peak_equity = state['peak_equity']
+        self.max_drawdown = state['max_drawdown']
+        self.max_drawdown_rate = state['max_drawdown_rate']
+        self.total_hold_ms = state['total_hold_ms']
+        self.hour_loss_gain = array('d', state['hour_loss_gain'])
+        self.hour_trade_num = array('l', state['hour_trade_num'])
+        self.side_stats = {side: list(s) for side, s in state['side_stats'].items()}
+        self._equity = array('d', bytes(8 * self._capacity))
+        self._close_times = array('q', bytes(8 * self._capacity))
+        self._returns = array('d', bytes(8 * self._window))
+        self._return_sum = 0.0
+        self._return_sq_sum = 0.0
+        self._downside_sq_sum = 0.0
+        # 資産曲線とローリング統計は復元後の取引から記録し直す
+        self._curve_offset = self.trade_num
+
+    def report_str(self):
+        return "期待値[{:.0f}] 取引数[{}/{}] 利回り[{:+.0f} {:.2%}] 最大DD[{:.0f}]".format(
+            self.expect_value(), self.win_num, self.trade_num, self.loss_gain, self.get_profit_rate(), self.max_drawdown)
@@ -1,35 +1,45 @@
-import os
 from datetime import datetime, timedelta
 from enum import Enum
 from time import sleep
 from typing import List
 
-import schedule
-
 from chart import ETrendType
-from chart.trend import SimpleTrendChecker, RSITrendChecker, SimpleTrendChecker2
+from chart.orderbook import OrderBook
+from chart.trend import create_trend_checker
 from gmo import gmo
-from timeloop import Timeloop
-
-from chart.chart import *
+from gmo.clock import default_clock
+from gmocoin_bot.analyzer import Analyzer
+from gmocoin_bot.journal import StateJournal
+from gmocoin_bot.logger import Logger
+from gmocoin_bot.orders import ORDER_LIMIT_TIME, TICK_MS, OrderTracker
+from gmocoin_bot.risk import RiskEngine
+from gmocoin_bot import scheduler
+from chart.chart import TechnicalChart
 
 """
 1. 利確設定（profit_rate）に上回る時にbest ask/bid で指値決済
-2. 最大保有時間（max_keep_time）を上回る且つ損切り設定（loss_cut_rate）下回る時決済
+2. 損切り設定（loss_cut_rate）を下回る、または最大保有時間（max_keep_time）を上回る時決済
 3. 時間間隔毎に保有ポジションの数を確認し、最大保有数以下であればトレンドを判断し、best_ask で購入/best_bidで売り注文を出す
+   発注前にアカウント共通のリスクエンジン（gmocoin_bot.risk）で証拠金・建玉・注文頻度・日次損失を確認する
 """
 
 DEFAULT_INIT_JPY = 50000
 
-ORDER_LIMIT_TIME = 60
-
 POSITION_TYPE_BUY = 'BUY'
 POSITION_TYPE_SELL = 'SELL'
 LEVERAGE_RATE = 4
 
+JOURNAL_PATH_FORMAT = 'save/bot.{}.journal'
+
 class Position(gmo.Position):
-    def __init__(self, raw_data):
+    __slots__ = ('type', 'curr_price', 'profit_rate', '_clock')
+
+    def __init__(self, raw_data, clock=default_clock):
+        """
+        :param clock: 保有時間の計算に使う時計（アカウントの API の clock）
+        """
         super().__init__(raw_data)
+        self._clock = clock
         self.size = float(raw_data['size'])
         self.type = raw_data['side']
         self.curr_price = self.price
@@ -49,18 +59,16 @@ class Position(gmo.Position):
             self.lossGain = (self.price - self.curr_price) * self.size
 
     def get_keep_time(self) -> timedelta:
-        now = datetime.now(tz=self.timestamp.tzinfo)
-        entry_time = self.timestamp
-        return now - entry_time
+        return timedelta(milliseconds=self._clock.exchange_now_ms() - self.timestamp)
 
     def execute_report(self):
-        keep_time = self.get_keep_time()
+        keep_time = int(self.get_keep_time().total_seconds())
         if self.type == POSITION_TYPE_BUY:
             return str.format("[B({:.0f}) -> S({:.0f})][KEEP TIME: {}:{}] 損益：{:+.0f}",
-                              self.price, self.curr_price, int(keep_time.seconds / 60), keep_time.seconds % 60, self.lossGain)
+                              self.price, self.curr_price, keep_time // 60, keep_time % 60, self.lossGain)
         elif self.type == POSITION_TYPE_SELL:
             return str.format("[S({:.0f}) -> B({:.0f})][KEEP TIME: {}:{}] 損益：{:+.0f}",
-                              self.price, self.curr_price, int(keep_time.seconds / 60), keep_time.seconds % 60, self.lossGain)
+                              self.price, self.curr_price, keep_time // 60, keep_time % 60, self.lossGain)
 
     def entry_report(self):
         print("POSITION ENTRY： type[{}] price[{}] size[{}]".format(self.side, self.price, self.size))
@@ -75,6 +83,7 @@ class BotParams:
         self.gate_time = bot_config['gate_time']
         self.second_profit_rate = bot_config['second_profit_rate']
         self.entry_cool_time = bot_config['entry_cool_time']
+        self.order_limit_time = bot_config.get('order_limit_time', ORDER_LIMIT_TIME)
 
 class EBotState(Enum):
     Initializing = 0
@@ -84,46 +93,119 @@ class EBotState(Enum):
 
 class GMOCoinBot:
     _position_list: List[Position]
-    _prev_entry_time: datetime or None
+    _prev_entry_time: int or None  # 取引所時刻（エポックミリ秒）
     _entry_order_list: List[int]
     _state = EBotState
 
-    def __init__(self, bot_config, api: gmo.GMO, in_chart: TechnicalChart):
+    def __init__(self, bot_config, api: gmo.GMO, in_chart: TechnicalChart, order_book: OrderBook = None,
+                 risk: RiskEngine = None):
         self.__set_state(EBotState.Initializing)
 
         # メンバー初期化
+        self._config = bot_config
         self._api = api
         self.chart = in_chart
-        checker_type = bot_config['trend_checker']['type']
-        if checker_type == 'Simple1':
-            self.trend_checker = SimpleTrendChecker()
-        elif checker_type == 'Simple2':
-            self.trend_checker = SimpleTrendChecker2()
-        elif checker_type == 'RSI':
-            params = bot_config['trend_checker']['params']
-            self.trend_checker =  RSITrendChecker(params[0], params[1], params[2])
-
-        assert self.trend_checker
+        self._order_book = order_book
+        # 同じアカウントのボットで共有する。渡されなければこのボット専用
+        self._risk = risk if risk is not None else RiskEngine()
+        self.trend_checker = create_trend_checker(bot_config['trend_checker'])
 
         # パラメータ初期化
         self._symbol = bot_config['symbol']
+        self.account = bot_config.get('account')
         self.params = BotParams(bot_config)
 
         self._entry_order_list = []
         self._position_list = []
         self._prev_entry_time = None
+        # 直前のエントリーの拒否理由（変わった時だけログに出す）
+        self._last_reject = None
 
         # 分析用
-        self._analyzer = Analyzer(GMOCoinBot.get_balance(self))
-        log_path = "trade.{}.{}.log".format(bot_config['name'], datetime.now().strftime("%Y%m%d%H%M%S"))
+        self._name = bot_config['name']
+        self._orders = OrderTracker(api, self.params.order_limit_time, on_finish=self._on_order_finished, name=self._name)
+        self._balance = GMOCoinBot.get_balance(self)
+        self._analyzer = Analyzer(self._balance)
+        log_path = "trade.{}.{}.jsonl".format(self._name, datetime.now().strftime("%Y%m%d%H%M%S"))
 
         self.__logger = Logger(log_path)
+
+        # 状態の永続化
+        self._journal = self._open_journal(bot_config)
+        self._restore_state()
+
         self._setup_timer()
 
+    def _open_journal(self, bot_config) -> StateJournal or None:
+        return StateJournal(bot_config.get('journal_path', JOURNAL_PATH_FORMAT.format(self._name)))
+
+    def _restore_state(self):
+        if not self._journal:
+            return
+
+        self._prev_entry_time = self._journal.get('prev_entry_time_ms')
+        self._entry_order_list = list(self._journal.get('entry_order_list', []))
+        analyzer_state = self._journal.get('analyzer')
+        if analyzer_state:
+            self._analyzer.load_state(analyzer_state)
+
+    def _set_prev_entry_time(self, prev_entry_time: int or None):
+        self._prev_entry_time = prev_entry_time
+        if self._journal:
+            self._journal.set('prev_entry_time_ms', prev_entry_time)
+
+    def _save_entry_orders(self):
+        if self._journal:
+            self._journal.set('entry_order_list', self._entry_order_list)
+
+    def _save_analyzer(self):
+        if self._journal:
+            self._journal.set('analyzer', self._analyzer.get_state(), sync=True)
+
     def _setup_timer(self):
-        schedule.every(1).minutes.do(self.cancel_order_check)
-        schedule.every(3).minutes.do(self.update_positions)
-        schedule.every(5).minutes.do(self.__init_order_list)
+        self._jobs = [
+            scheduler.every(TICK_MS / 1000, self._orders.expire, name="{}.expire_orders".format(self._name), jitter=0),
+            scheduler.every(3 * 60, self.update_positions, name="{}.update_positions".format(self._name)),
+            scheduler.every(5 * 60, self.__init_order_list, name="{}.init_order_list".format(self._name)),
+        ]
+
+    @property
+    def name(self):
+        return self._name
+
+    def apply_config(self, bot_config) -> bool:
+        """
+        実行中のまま設定を反映する（チャート・ポジション・分析結果はそのまま）
+        :return: 反映できなかった（ボットを作り直す必要がある）場合 False
+        """
+        for key in ('name', 'symbol', 'account', 'journal_path'):
+            if bot_config.get(key) != self._config.get(key):
+                return False
+
+        params = BotParams(bot_config)
+        if bot_config['trend_checker'] != self._config['trend_checker']:
+            self.trend_checker = create_trend_checker(bot_config['trend_checker'])
+        self._orders.set_order_limit_time(params.order_limit_time)
+        self.params = params
+        self._config = bot_config
+        print("[{}] CONFIG APPLIED".format(self._name))
+        return True
+
+    def stop(self):
+        """
+        定期処理を止めてファイルを閉じる。建玉と注文はそのまま残る
+        """
+        for job in self._jobs:
+            scheduler.default_scheduler.cancel(job)
+        self._jobs = []
+        self.__set_state(EBotState.Paused)
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+        self.__logger.close()
+        if self._position_list or self._entry_order_list:
+            print("[{}] STOPPED with {} positions and {} orders left".format(
+                self._name, len(self._position_list), len(self._entry_order_list)))
 
     def run(self):
         # ポジション、注文の初期状態を取得
@@ -137,17 +219,26 @@ class GMOCoinBot:
         positions = self._api.get_positions(self._symbol)
         if positions:
             for p in positions['list']:
-                self._position_list.append(Position(p))
+                self._position_list.append(Position(p, self._api.clock))
+            self._risk.sync_positions(positions['list'])
 
     def __init_order_list(self):
-        self._entry_order_list.clear()
         orders = self._api.activeOrders(self._symbol)
-        if orders:
-            self._entry_order_list = [int(o['orderId']) for o in orders if o['settleType'] == 'OPEN']
-            o_close = [int(o['orderId']) for o in orders if o['settleType'] == 'CLOSE']
-            if o_close:
-                self._api.cancel_orders(o_close)
-                sleep(1) # キャンセルまで時間かかるかもしれない、一応
+        active = orders['list'] if orders else []
+
+        # 自分の新規注文（ジャーナルに残っている・管理中のもの）だけを引き継ぐ
+        known = set(self._entry_order_list) | set(self._orders.ids('OPEN'))
+        for o in active:
+            if o['settleType'] == 'OPEN' and int(o['orderId']) in known:
+                self._orders.track(o['orderId'], 'OPEN', o['size'], gmo.to_epoch_ms(o['timestamp']))
+        self._orders.sync(active)
+        self._entry_order_list = self._orders.ids('OPEN')
+
+        o_close = [int(o['orderId']) for o in active if o['settleType'] == 'CLOSE']
+        if o_close:
+            self._api.cancel_orders(o_close)
+            sleep(1) # キャンセルまで時間かかるかもしれない、一応
+        self._save_entry_orders()
 
     def get_state(self) -> EBotState:
         return self._state
@@ -158,6 +249,7 @@ class GMOCoinBot:
 
     def update_positions(self):
         self._init_position_list()
+        self._balance = self.get_balance()
 
     def get_server_status(self):
         return self._api.status()['status']
@@ -166,49 +258,71 @@ class GMOCoinBot:
         self.__set_state(EBotState.Paused)
 
     def on_execution_events(self, execution_data):
-        settle_type = execution_data['settleType']
-        order_id = int(execution_data['orderId'])
-        if settle_type == 'OPEN':
-            if order_id in self._entry_order_list:
-                self._entry_order_list.remove(order_id)
-        elif settle_type == 'CLOSE':
+        self._risk.on_execution(execution_data)
+        self._orders.on_execution(execution_data)
+        if execution_data['settleType'] == 'CLOSE':
             lossGain = int(execution_data['lossGain'])
             close_pos = self.get_position(execution_data['positionId'])
             if close_pos:
                 self._position_list.remove(close_pos)
                 close_pos.lossGain = lossGain
                 self._analyzer.update(close_pos)
+                self._save_analyzer()
                 self.report(close_pos)
 
-            self._prev_entry_time = None
+            self._set_prev_entry_time(None)
 
     def on_order_events(self, order_data):
-        order_id = int(order_data['orderId'])
-        message_type = order_data['msgType']
-        if message_type == 'NOR': # 新規注文　
-            if order_data['settleType'] == 'OPEN':
-                self._entry_order_list.append(order_id)
-        else: # キャンセル等
-            if order_data['settleType'] == 'OPEN':
-                self._entry_order_list.remove(order_id)
+        self._risk.on_order_event(order_data)
+        self._orders.on_order_event(order_data)
+
+    def _track_order(self, order_id, settle_type, size):
+        """
+        発注した注文を管理に加える（order_limit_time 秒で取り消される）
+        """
+        if not order_id or self._orders.track(order_id, settle_type, size) is None:
+            return
+        if settle_type == 'OPEN':
+            self._entry_order_list.append(int(order_id))
+            self._save_entry_orders()
+
+    def _on_order_finished(self, order):
+        # イベントで完了した注文はリスクエンジンが先に処理しているので、取りこぼした注文だけが対象になる
+        self._risk.release(order.id)
+        if order.id in self._entry_order_list:
+            self._entry_order_list.remove(order.id)
+            self._save_entry_orders()
 
     def on_position_events(self, position_data):
         msg_type = position_data['msgType']
         if msg_type == 'OPR': # ポジションオープン
-            self._position_list.append(Position(position_data))
+            self._position_list.append(Position(position_data, self._api.clock))
             # self._position_list[-1].entry_report()
-            self._prev_entry_time = datetime.now()
+            self._set_prev_entry_time(self._api.clock.exchange_now_ms())
         elif msg_type == 'UPR': # 部分決済
             update_pos = self.get_position(position_data['positionId'])
             if update_pos:
                 update_pos.size = int(position_data['size'])
 
     def get_position(self, p_id):
-        return next(p for p in self._position_list if p.id == int(p_id))
+        return next((p for p in self._position_list if p.id == int(p_id)), None)
+
+    def on_trade(self, trade):
+        """
+        約定履歴（trades チャンネル）。実際のボットでは使わない
+        """
+        pass
+
+    def on_orderbooks(self, data):
+        """
+        板情報（orderbooks チャンネル）。板は共有の OrderBook に反映済みなので何もしない
+        """
+        pass
 
     def update_ticker(self, ticker):
         # ここでポジションの決済、エントリを決める
         # ポジションの更新
+        self._risk.on_ticker(ticker['last'])
         for p in self._position_list:
             p.update(ticker)
             if self.should_exit(p):
@@ -217,13 +331,25 @@ class GMOCoinBot:
         trend = self.trend_checker.check_trend(self.chart)
         if trend == ETrendType.UP:
             if self.can_entry():
-                self.entry_position(POSITION_TYPE_BUY, ticker['ask'], self.params.position_unit)
+                size = self.params.position_unit
+                self.entry_position(POSITION_TYPE_BUY, self.get_order_price(POSITION_TYPE_BUY, size, ticker['ask']), size)
             self.close_positions(POSITION_TYPE_SELL)
         elif trend == ETrendType.DOWN:
             if self.can_entry():
-                self.entry_position(POSITION_TYPE_SELL, ticker['bid'], self.params.position_unit)
+                size = self.params.position_unit
+                self.entry_position(POSITION_TYPE_SELL, self.get_order_price(POSITION_TYPE_SELL, size, ticker['bid']), size)
             self.close_positions(POSITION_TYPE_BUY)
 
+    def get_order_price(self, side, size, default_price):
+        """
+        板情報があれば size 全量が約定する価格、なければ default_price
+        """
+        if self._order_book is not None and self._order_book.is_fresh():
+            price = self._order_book.price_for_size(side, float(size))
+            if price is not None:
+                return price
+        return default_price
+
     def is_position_timeout(self, position: Position):
         keep_time_sec = abs(position.get_keep_time().total_seconds())
         return keep_time_sec > self.params.max_keep_time
@@ -232,6 +358,9 @@ class GMOCoinBot:
         if position.profit_rate > self.params.profit_rate:
             return True
 
+        if position.profit_rate < -self.params.loss_cut_rate:
+            return True
+
         if (position.type == POSITION_TYPE_BUY and self.chart.get_last_candle().is_down()) or \
             (position.type == POSITION_TYPE_SELL and self.chart.get_last_candle().is_up()):
             return position.profit_rate > self.params.second_profit_rate
@@ -242,19 +371,35 @@ class GMOCoinBot:
         return False
 
     def entry_position(self, side, price, size):
-        self._prev_entry_time = datetime.now()
-
-        margin = int(self._api.account_margin()['availableAmount'])
-        if margin < float(price) * size / float(LEVERAGE_RATE):
+        self._set_prev_entry_time(self._api.clock.exchange_now_ms())
+
+        ticket, reason = self._risk.approve_entry(self._name, side, price, size)
+        if reason != self._last_reject:
+            if reason is not None:
+                print("[{}] ENTRY REJECTED: {} {} {}@{}".format(self._name, reason, side, size, price))
+            elif self._last_reject is not None:
+                print("[{}] ENTRY APPROVED again after {}".format(self._name, self._last_reject))
+            self._last_reject = reason
+        if ticket is None:
             return
 
-        self._api.order(self._symbol, side, 'LIMIT', size, int(price))
+        order_id = self._api.order(self._symbol, side, 'LIMIT', size, int(price))
+        if order_id:
+            self._risk.confirm(ticket, order_id)
+            self._track_order(order_id, 'OPEN', size)
+        else:
+            self._risk.cancel(ticket)
 
     def close_position(self, position:Position):
         if position.type == POSITION_TYPE_BUY:
-            self._api.close_order(self._symbol, POSITION_TYPE_SELL, 'LIMIT', position.id, position.size, position.curr_price, time_in_force='FOK')
+            price = self.get_order_price(POSITION_TYPE_SELL, position.size, position.curr_price)
+            order_id = self._api.close_order(self._symbol, POSITION_TYPE_SELL, 'LIMIT', position.id, position.size, int(price), time_in_force='FOK')
         elif position.type == POSITION_TYPE_SELL:
-            self._api.close_order(self._symbol, POSITION_TYPE_BUY, 'LIMIT', position.id, position.size, position.curr_price, time_in_force='FOK')
+            price = self.get_order_price(POSITION_TYPE_BUY, position.size, position.curr_price)
+            order_id = self._api.close_order(self._symbol, POSITION_TYPE_BUY, 'LIMIT', position.id, position.size, int(price), time_in_force='FOK')
+        else:
+            return
+        self._track_order(order_id, 'CLOSE', position.size)
 
     def close_positions(self, p_type):
         p_list = [p for p in self._position_list if p.type == p_type]
@@ -262,47 +407,19 @@ class GMOCoinBot:
             p_size = sum([p.size for p in p_list])
             price = p_list[0].curr_price
             if p_type == POSITION_TYPE_BUY:
-                self._api.close_bulk_order(self._symbol, POSITION_TYPE_SELL, 'LIMIT', p_size, price, time_in_force='FOK')
+                price = self.get_order_price(POSITION_TYPE_SELL, p_size, price)
+                order_id = self._api.close_bulk_order(self._symbol, POSITION_TYPE_SELL, 'LIMIT', p_size, int(price), time_in_force='FOK')
             elif p_type == POSITION_TYPE_SELL:
-                self._api.close_bulk_order(self._symbol, POSITION_TYPE_BUY, 'LIMIT', p_size, price, time_in_force='FOK')
-
-    def cancel_order_check(self):
-        cancel_ids = []
-        active_orders = self._api.activeOrders('BTC_JPY')
-        if active_orders:
-            # 決済中の注文をキャンセル
-            executing_orders = [o for o in active_orders['list'] if o['settleType'] == 'CLOSE']
-            for o in executing_orders:
-                order_time = pd.to_datetime(o['timestamp'])
-                now = datetime.now(tz=order_time.tzinfo)
-                if abs((now - order_time).total_seconds()) > ORDER_LIMIT_TIME:
-                    cancel_ids.append(o['orderId'])
-
-        if self._entry_order_list:
-            # 発注中の注文をキャンセル
-            order_ids = [str(ID) for ID in self._entry_order_list][0:10]
-            orders = self._api.orders(order_ids)
-            if not orders:
+                price = self.get_order_price(POSITION_TYPE_BUY, p_size, price)
+                order_id = self._api.close_bulk_order(self._symbol, POSITION_TYPE_BUY, 'LIMIT', p_size, int(price), time_in_force='FOK')
+            else:
                 return
-
-            for o in orders['list']:
-                # 有効以外の場合はスルー
-                if o['status'] != 'ORDERED':
-                    self._entry_order_list.remove(int(o['orderId']))
-                    continue
-
-                order_time = pd.to_datetime(o['timestamp'])
-                now = datetime.now(tz=order_time.tzinfo)
-                if (now - order_time).seconds > ORDER_LIMIT_TIME:
-                    cancel_ids.append(o['orderId'])
-
-        if len(cancel_ids) > 0:
-            self._api.cancel_orders(cancel_ids)
+            self._track_order(order_id, 'CLOSE', p_size)
 
     def can_entry(self):
         # クールタイム中
-        now = datetime.now()
-        if self._prev_entry_time is not None and (now - self._prev_entry_time).seconds < self.params.entry_cool_time:
+        if self._prev_entry_time is not None and \
+                (self._api.clock.exchange_now_ms() - self._prev_entry_time) / 1000 < self.params.entry_cool_time:
             return False
 
         # ポジション最大数超えてる
@@ -317,52 +434,35 @@ class GMOCoinBot:
         :return:
         """
         if self._api.status()['status'] == 'OPEN':
-            return int(self._api.account_margin()['actualProfitLoss'])
+            margin = self._api.account_margin()
+            self._risk.sync_margin(margin)
+            return int(margin['actualProfitLoss'])
         else:
             return DEFAULT_INIT_JPY
 
+    def get_cached_balance(self):
+        """
+        定期更新している残高（REST を呼ばない）
+        """
+        return self._balance
+
     def report(self, p: Position):
-        self.__logger.log("[{}]{} {} 時価評価総額: {:.0f}".format(
-            datetime.now().strftime("%m-%d %H:%M:%S"), p.execute_report(), self._analyzer.report_str(), self.get_balance())
-        )
-
-class Logger:
-    LOG_DIR = 'logs'
-    def __init__(self, filename):
-        if not os.path.exists(self.LOG_DIR):
-            os.makedirs(self.LOG_DIR)
-
-        self.__filepath = "{}/{}".format(self.LOG_DIR, filename)
-        # Create File
-        f = open(self.__filepath, "x")
-        f.close()
-
-    def log(self, output_str):
-        with open(self.__filepath, 'a') as f:
-            print(output_str, file=f)
-
-class Analyzer:
-    def __init__(self, init_jpy):
-        self.init_jpy = init_jpy
-        self.trade_num = 0
-        self.win_num = 0
-        self.loss_gain = 0
-
-    def expect_value(self):
-        return self.loss_gain / self.trade_num
-
-    def get_profit_rate(self):
-        return self.loss_gain / self.init_jpy
-
-    def get_win_rate(self):
-        return self.win_num / self.trade_num
-
-    def update(self, execute_position:Position):
-        if execute_position.lossGain >= 0:
-            self.win_num += 1
-
-        self.loss_gain += int(execute_position.lossGain)
-        self.trade_num += 1
-
-    def report_str(self):
-        return "期待値[{:.0f}] 取引数[{}/{}] 利回り[{:+.0f} {:.2%}]".format(self.expect_value(), self.win_num, self.trade_num, self.loss_gain, self.get_profit_rate())
\ No newline at end of file
+        self.__logger.log_record({
+            'time': datetime.now().isoformat(timespec='milliseconds'),
+            'bot': self._name,
+            'symbol': self._symbol,
+            'side': p.type,
+            'size': p.size,
+            'entry_price': p.price,
+            'exit_price': p.curr_price,
+            'keep_time': p.get_keep_time().total_seconds(),
+            'loss_gain': p.lossGain,
+            'trade_num': self._analyzer.trade_num,
+            'win_num': self._analyzer.win_num,
+            'total_loss_gain': self._analyzer.loss_gain,
+            'expect_value': self._analyzer.expect_value(),
+            'profit_rate': self._analyzer.get_profit_rate(),
+            'max_drawdown': self._analyzer.max_drawdown,
+            'rolling_sharpe': self._analyzer.rolling_sharpe(),
+            'balance': self.get_cached_balance(),
+        })
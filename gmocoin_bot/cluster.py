@@ -0,0 +1,469 @@
+"""
+ボットを複数のワーカープロセスに分けて動かす
+
+supervisor（メインプロセス）が Webソケットの購読とチャートを持ち、約定・ティッカー・板情報を各ワーカーに配る。
+ワーカーは bot_configs の一部を受け持ち、受け取った約定から自分のチャートを組み立ててボットを動かす。
+プライベートチャンネルのイベントはアカウント名を付けて注文を出したワーカーにだけ送り、ワーカーはそのアカウントのボットにだけ渡す。
+REST の呼び出し上限はアカウント単位なので、全プロセスで1つの制限（SharedCallLimiter）を共有する。
+
+    {"workers": 4, "bot_configs": [...]}
+
+metrics_port を指定した場合、supervisor は metrics_port、ワーカー i は metrics_port + 1 + i でメトリクスを公開する。
+"""
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import wait
+
+from chart import TechnicalChart
+from chart.orderbook import OrderBook
+from gmo.gmo import GMO, to_epoch_ms
+from gmocoin_bot import metrics, profiler, scheduler
+from gmocoin_bot.accounts import account_configs, bot_account, create_accounts, default_account
+from gmocoin_bot.bot import EBotState
+from gmocoin_bot.risk import create_risk_engines
+
+MAX_BATCH = 256
+ROUTE_TIMEOUT = 1.0  # 持ち主が分からないイベントをこの秒数待ってから全ワーカーに送る
+SWEEP_INTERVAL = 0.2
+
+MSG_TRADE = 'trades'
+MSG_TICKER = 'ticker'
+MSG_ORDERBOOKS = 'orderbooks'
+MSG_EXECUTION = 'executionEvents'
+MSG_ORDER = 'orderEvents'
+MSG_POSITION = 'positionEvents'
+MSG_RUN = 'run'
+MSG_STOP = 'stop'
+
+ORDER_METHODS = ('order', 'close_order', 'close_bulk_order')
+
+
+def create_bots(bot_configs, accounts, chart, order_book, sim_flg, risk_engines=None):
+    """
+    :param accounts: {アカウント名: API クライアント}。bot_configs の account は解決済みであること
+    :param risk_engines: {アカウント名: RiskEngine}
+    """
+    from gmocoin_bot.bot import GMOCoinBot
+    from gmocoin_bot.simulator import GMOCoinBotSimulator
+
+    bot_class = GMOCoinBotSimulator if sim_flg else GMOCoinBot
+    risk_engines = risk_engines or {}
+    return [bot_class(bc, accounts[bc['account']], chart, order_book, risk_engines.get(bc['account']))
+            for bc in bot_configs]
+
+
+def check_server_status(bots):
+    for bot in bots:
+        if bot.get_state() == EBotState.Running and bot.get_server_status() != 'OPEN':
+            bot.pause()
+        elif bot.get_state() == EBotState.Paused and bot.get_server_status() == 'OPEN':
+            bot.run()
+
+
+class SharedCallLimiter:
+    """
+    プロセス間で共有する呼び出し制限（CallLimiter と同じく wait() で1回分を消費する）
+
+    直近 limit 回の呼び出し時刻を共有メモリのリングバッファに持ち、どの1秒間にも limit 回を超えないよう待つ。
+    time.monotonic はシステム全体で共通の時計なのでプロセス間で比較できる。
+    ワーカーの起動時に引数で渡すこと。
+    """
+
+    def __init__(self, ctx, limit):
+        self._lock = ctx.Lock()
+        self._times = ctx.Array('d', [float('-inf')] * max(1, limit), lock=False)
+        self._index = ctx.Value('i', 0, lock=False)
+
+    def wait(self) -> float:
+        """
+        :return: 待った秒数
+        """
+        started = time.monotonic()
+        with self._lock:
+            index = self._index.value
+            slot = max(started, self._times[index] + 1.0)
+            self._times[index] = slot
+            self._index.value = (index + 1) % len(self._times)
+        if slot > started:
+            time.sleep(slot - started)
+        return time.monotonic() - started
+
+
+def create_shared_limiters(ctx, config) -> dict:
+    """
+    :return: {アカウント名: (GET 用, POST 用)}
+    """
+    return {a['name']: (SharedCallLimiter(ctx, a.get('call_limit', 3)), SharedCallLimiter(ctx, a.get('call_limit', 3)))
+            for a in account_configs(config)}
+
+
+# region worker
+class OwnershipReportingAPI:
+    """
+    GMO のラッパー。発注で得た注文IDを supervisor に知らせ、プライベートイベントをこのワーカーに回してもらう
+    """
+
+    def __init__(self, api: GMO, report):
+        self._api = api
+        self._report = report
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name not in ORDER_METHODS:
+            return attr
+
+        def call(*args, **kwargs):
+            order_id = attr(*args, **kwargs)
+            if order_id and not isinstance(order_id, bool):
+                self._report(int(order_id))
+            return order_id
+        return call
+
+
+def _worker_main(index, config, bot_configs, sim_flg, workers, limiters, inbox, outbox):
+    # Ctrl-C は supervisor が受けて MSG_STOP を送る
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    send_lock = threading.Lock()
+
+    def report(order_id):
+        with send_lock:
+            outbox.send(order_id)
+
+    # 呼び出し上限は supervisor・他のワーカーと共有する
+    accounts = create_accounts(config, limiters)
+    metrics.instrument_accounts(accounts)
+    api = accounts[default_account(config)]
+    chart = TechnicalChart()
+    order_book = OrderBook(config['symbol'])
+    # アカウント全体のリスク上限はワーカー数で分けて持つ（合計がアカウントの上限になる）
+    risk_engines = create_risk_engines(config, index, workers)
+    bots = create_bots(bot_configs, {name: OwnershipReportingAPI(a, report) for name, a in accounts.items()},
+                       chart, order_book, sim_flg, risk_engines)
+    if config.get('metrics_port'):
+        metrics.register_process(lambda: bots, risk_engines)
+        metrics.start_server(config['metrics_port'] + 1 + index)
+    if not sim_flg:
+        scheduler.every(60, lambda: check_server_status(bots), name='worker{}.check_server_status'.format(index))
+    scheduler.default_scheduler.start()
+    # kill -USR1 / -USR2 でワーカー毎に切り替えられる
+    tick_profiler = profiler.install(config.get('profiler'))
+    print("WORKER[{}] STARTED: {}".format(index, [bc['name'] for bc in bot_configs]))
+
+    while True:
+        try:
+            batch = inbox.recv()
+        except EOFError:
+            break
+        for kind, data in batch:
+            if kind == MSG_STOP:
+                scheduler.default_scheduler.stop()
+                tick_profiler.stop()
+                return
+            try:
+                _dispatch(kind, data, api, chart, order_book, bots)
+            except Exception:
+                print("WORKER[{}] {} FAILED".format(index, kind), file=sys.stderr)
+                traceback.print_exc()
+
+
+def _dispatch(kind, data, api, chart, order_book, bots):
+    if kind == MSG_TRADE:
+        chart.update(data)
+        for b in bots:
+            b.on_trade(data)
+    elif kind == MSG_TICKER:
+        api.clock.observe_message(to_epoch_ms(data['timestamp']))
+        for b in bots:
+            b.update_ticker(data)
+    elif kind == MSG_ORDERBOOKS:
+        order_book.apply_snapshot(data)
+    elif kind == MSG_EXECUTION:
+        account, data = data
+        for b in _account_bots(bots, account):
+            b.on_execution_events(data)
+    elif kind == MSG_ORDER:
+        account, data = data
+        for b in _account_bots(bots, account):
+            b.on_order_events(data)
+    elif kind == MSG_POSITION:
+        account, data = data
+        for b in _account_bots(bots, account):
+            b.on_position_events(data)
+    elif kind == MSG_RUN:
+        for b in [b for b in bots if b.get_state() != EBotState.Running]:
+            b.run()
+
+
+def _account_bots(bots, account):
+    """
+    account のプライベートイベントを受け取るボット（GMOWebsocketManager._account_bots と同じ）
+    """
+    return [b for b in bots if b.account is None or b.account == account]
+# endregion worker
+
+
+# region supervisor
+class WorkerHandle:
+    """
+    ワーカープロセスと送信キュー。送信スレッドがキューに溜まったメッセージをまとめて送る
+    """
+
+    def __init__(self, index, process, inbox, outbox):
+        self.index = index
+        self.process = process
+        self.outbox = outbox
+        self._inbox = inbox
+        self._queue = queue.Queue()
+        self.sent = 0
+        threading.Thread(target=self._send_loop, daemon=True).start()
+
+    def send(self, kind, data):
+        self._queue.put((kind, data))
+
+    def _send_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._inbox.send(batch)
+            except (OSError, ValueError):
+                print("WORKER[{}] DISCONNECTED".format(self.index), file=sys.stderr)
+                return
+            self.sent += len(batch)
+
+
+class ClusterRouter:
+    """
+    GMOWebsocketManager にボットとして渡し、受け取ったデータをワーカーに配る
+    プライベートイベントはアカウント毎の AccountFeed（feeds()）から受け取る
+
+    注文IDの持ち主はワーカーからの報告で、建玉IDの持ち主は新規注文の約定イベントで覚え、
+    注文の全量約定・取消・失効、建玉の決済で忘れる。
+    報告より先に届いたイベントは ROUTE_TIMEOUT 秒まで保留し、それでも分からなければ全ワーカーに送る。
+    """
+
+    # プライベートイベントは AccountFeed から受け取るので、どのアカウントとも一致しない名前にする
+    account = ''
+
+    def __init__(self, workers: list):
+        self._workers = workers
+        self._state = EBotState.Initialized
+        self._lock = threading.Lock()
+        self._order_owner = {}
+        self._position_owner = {}
+        self._unrouted = []  # (受信時刻, 種類, アカウント, データ)
+        threading.Thread(target=self._report_loop, daemon=True).start()
+
+    def get_state(self) -> EBotState:
+        return self._state
+
+    def run(self):
+        self._state = EBotState.Running
+        self._broadcast(MSG_RUN, None)
+
+    def stop(self):
+        self._broadcast(MSG_STOP, None)
+
+    def feeds(self, accounts) -> list:
+        return [AccountFeed(self, account) for account in accounts]
+
+    def _broadcast(self, kind, data):
+        for w in self._workers:
+            w.send(kind, data)
+
+    # region bot interface
+    def on_trade(self, trade):
+        self._broadcast(MSG_TRADE, trade)
+
+    def update_ticker(self, ticker):
+        self._broadcast(MSG_TICKER, ticker)
+
+    def on_orderbooks(self, data):
+        self._broadcast(MSG_ORDERBOOKS, data)
+    # endregion bot interface
+
+    def route(self, kind, account, data):
+        """
+        プライベートイベントを (アカウント, データ) にして注文を出したワーカーに送る
+        """
+        with self._lock:
+            # 同じ注文の前のイベントが保留中なら順序を保つため後ろに並べる
+            owner = None if self._is_pending(data) else self._owner(data)
+            if owner is None:
+                self._unrouted.append((time.monotonic(), kind, account, data))
+                return
+            self._remember_position(kind, data, owner)
+            self._forget_finished(kind, data)
+        owner.send(kind, (account, data))
+
+    def _owner(self, data):
+        position_id = data.get('positionId')
+        if position_id and data.get('settleType') != 'OPEN' and int(position_id) in self._position_owner:
+            return self._position_owner[int(position_id)]
+        if 'orderId' in data:
+            return self._order_owner.get(int(data['orderId']))
+        if position_id:
+            return self._position_owner.get(int(position_id))
+        return None
+
+    def _is_pending(self, data):
+        order_id = data.get('orderId')
+        position_id = data.get('positionId')
+        for _, _, _, d in self._unrouted:
+            if (order_id and d.get('orderId') == order_id) or (position_id and d.get('positionId') == position_id):
+                return True
+        return False
+
+    def _remember_position(self, kind, data, owner):
+        if kind == MSG_EXECUTION and data.get('settleType') == 'OPEN' and data.get('positionId'):
+            self._position_owner[int(data['positionId'])] = owner
+
+    def _forget_finished(self, kind, data):
+        """
+        以降イベントが来ない注文・建玉の持ち主を忘れる
+        """
+        if kind == MSG_ORDER:
+            if data.get('msgType') == 'COR' or data.get('orderStatus') in ('CANCELED', 'EXPIRED'):
+                self._order_owner.pop(int(data['orderId']), None)
+        elif kind == MSG_EXECUTION:
+            if 'orderExecutedSize' in data and float(data['orderExecutedSize']) >= float(data['orderSize']):
+                self._order_owner.pop(int(data['orderId']), None)
+        elif kind == MSG_POSITION:
+            if data.get('msgType') == 'CPR' and data.get('positionId'):
+                self._position_owner.pop(int(data['positionId']), None)
+
+    def _report_loop(self):
+        outboxes = {w.outbox: w for w in self._workers}
+        while outboxes:
+            for conn in wait(list(outboxes), timeout=SWEEP_INTERVAL):
+                try:
+                    order_id = conn.recv()
+                except EOFError:
+                    outboxes.pop(conn)
+                    continue
+                with self._lock:
+                    self._order_owner[order_id] = outboxes[conn]
+            self._flush_unrouted()
+
+    def _flush_unrouted(self):
+        with self._lock:
+            if not self._unrouted:
+                return
+            now = time.monotonic()
+            pending, self._unrouted = self._unrouted, []
+            deliveries = []
+            for received_at, kind, account, data in pending:
+                owner = None if self._is_pending(data) else self._owner(data)
+                if owner is not None:
+                    self._remember_position(kind, data, owner)
+                    self._forget_finished(kind, data)
+                    deliveries.append(([owner], kind, (account, data)))
+                elif now - received_at >= ROUTE_TIMEOUT and not self._is_pending(data):
+                    self._forget_finished(kind, data)
+                    deliveries.append((self._workers, kind, (account, data)))
+                else:
+                    self._unrouted.append((received_at, kind, account, data))
+        for targets, kind, message in deliveries:
+            for w in targets:
+                w.send(kind, message)
+
+
+class AccountFeed:
+    """
+    1アカウント分のプライベートイベントをアカウント名付きで ClusterRouter に渡す（GMOWebsocketManager にボットとして渡す）
+    """
+
+    def __init__(self, router: ClusterRouter, account):
+        self._router = router
+        self.account = account
+
+    def get_state(self) -> EBotState:
+        return self._router.get_state()
+
+    def run(self):
+        pass
+
+    def on_trade(self, trade):
+        pass
+
+    def update_ticker(self, ticker):
+        pass
+
+    def on_orderbooks(self, data):
+        pass
+
+    def on_execution_events(self, data):
+        self._router.route(MSG_EXECUTION, self.account, data)
+
+    def on_order_events(self, data):
+        self._router.route(MSG_ORDER, self.account, data)
+
+    def on_position_events(self, data):
+        self._router.route(MSG_POSITION, self.account, data)
+
+
+def start_workers(ctx, config, sim_flg, workers, limiters) -> list:
+    """
+    bot_configs を workers 個のプロセスに順番に割り振って起動する
+    """
+    bot_configs = [dict(bc, account=bot_account(config, bc)) for bc in config['bot_configs']]
+    # ボットより多いワーカーは起動しない（リスク上限は実際に起動する数で分ける）
+    workers = min(workers, len(bot_configs))
+    handles = []
+    for index in range(workers):
+        assigned = bot_configs[index::workers]
+        inbox_r, inbox_w = ctx.Pipe(duplex=False)
+        outbox_r, outbox_w = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_worker_main, name='bot-worker-{}'.format(index), daemon=True,
+                              args=(index, config, assigned, sim_flg, workers, limiters, inbox_r, outbox_w))
+        process.start()
+        handles.append(WorkerHandle(index, process, inbox_w, outbox_r))
+    return handles
+
+
+def run_cluster(config, sim_flg):
+    """
+    supervisor として Webソケットを購読し、ワーカーを起動してデータを配る。KeyboardInterrupt まで戻らない
+    """
+    from gmocoin_bot.ws import GMOWebsocketManager
+
+    ctx = multiprocessing.get_context('spawn')
+    limiters = create_shared_limiters(ctx, config)
+    workers = start_workers(ctx, config, sim_flg, config['workers'], limiters)
+    router = ClusterRouter(workers)
+    accounts = create_accounts(config, limiters)
+    metrics.instrument_accounts(accounts)
+    if config.get('metrics_port'):
+        queue_depth = metrics.gauge('gmocoin_cluster_queue_depth', 'Messages waiting to be sent to a worker.',
+                                    ('worker',))
+        sent = metrics.gauge('gmocoin_cluster_sent_messages', 'Messages sent to a worker.', ('worker',))
+        for w in workers:
+            queue_depth.labels(w.index).set_function(w._queue.qsize)
+            sent.labels(w.index).set_function(lambda w=w: w.sent)
+        metrics.default_registry.collector(metrics.scheduler_collector(scheduler.default_scheduler))
+        metrics.start_server(config['metrics_port'])
+    chart = TechnicalChart()
+    order_book = OrderBook(config['symbol'])
+    ws_manager = GMOWebsocketManager([router] + router.feeds(accounts), chart, accounts[default_account(config)],
+                                     sim_flg=sim_flg, symbol=config['symbol'], order_book=order_book, accounts=accounts)
+
+    tick_profiler = profiler.install(config.get('profiler'))
+    try:
+        scheduler.default_scheduler.run_forever()
+    except KeyboardInterrupt:
+        scheduler.default_scheduler.stop()
+        tick_profiler.stop()
+        router.stop()
+        for w in workers:
+            w.process.join(timeout=5)
+        del ws_manager
+# endregion supervisor
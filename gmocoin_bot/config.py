@@ -0,0 +1,99 @@
+"""
+設定ファイルの監視
+
+ファイルの更新時刻を定期的に確認し、変わっていたら読み込み直して前回との差分を通知する。
+読み込みに失敗した場合（書きかけの JSON など）は前回の設定のままにして次の確認で再試行する。
+再起動が必要な設定（RESTART_KEYS）が変わっていたら何も反映せず、ファイルが再び更新されるまで待つ。
+ただしアカウント毎の "risk" は実行中に反映できるので、accounts の比較には含めない。
+反映（on_change）が ValueError を投げたら設定の誤りとして同様に待ち、それ以外の例外なら次の確認で再試行する。
+self.config は反映に成功した時だけ更新する。
+"""
+import json
+import os
+import sys
+from datetime import datetime
+
+from gmocoin_bot import scheduler
+
+CHECK_INTERVAL = 2
+
+# 実行中には反映できない（再起動が必要な）トップレベルの設定
+RESTART_KEYS = ('symbol', 'accounts', 'access_key', 'secret_key', 'rest_url', 'ws_url', 'workers', 'call_limit')
+
+
+def diff_bot_configs(old_configs, new_configs):
+    """
+    bot_configs を name で突き合わせる
+    :return: (追加された設定, 削除された設定, 変更された設定)
+    """
+    old = {bc['name']: bc for bc in old_configs}
+    new = {bc['name']: bc for bc in new_configs}
+    added = [bc for name, bc in new.items() if name not in old]
+    removed = [bc for name, bc in old.items() if name not in new]
+    changed = [bc for name, bc in new.items() if name in old and old[name] != bc]
+    return added, removed, changed
+
+
+def _restart_value(config, key):
+    value = config.get(key)
+    if key == 'accounts' and value:
+        return [{k: v for k, v in account.items() if k != 'risk'} for account in value]
+    return value
+
+
+class ConfigWatcher:
+    """
+    :param on_change: on_change(old_config, new_config)。設定が変わった時に呼ばれる。
+        反映できない設定なら何も変更せずに ValueError を投げる
+    """
+
+    def __init__(self, path, config, on_change, interval=CHECK_INTERVAL):
+        self._path = path
+        self.config = config
+        self._on_change = on_change
+        self._mtime = self._stat()
+        self._job = scheduler.every(interval, self.check, name='config_watcher', jitter=0)
+
+    def _stat(self):
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self):
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return
+
+        try:
+            with open(self._path, 'r') as f:
+                new_config = json.load(f)
+        except (OSError, ValueError) as e:
+            print("[{}] CONFIG RELOAD FAILED: {}".format(datetime.now(), e), file=sys.stderr)
+            return
+
+        if new_config == self.config:
+            self._mtime = mtime
+            return
+
+        restart = [key for key in RESTART_KEYS if _restart_value(self.config, key) != _restart_value(new_config, key)]
+        if restart:
+            self._mtime = mtime
+            print("[{}] CONFIG {} CHANGED: restart required, not applied".format(datetime.now(), restart),
+                  file=sys.stderr)
+            return
+
+        try:
+            self._on_change(self.config, new_config)
+        except ValueError as e:
+            self._mtime = mtime
+            print("[{}] CONFIG REJECTED: {}".format(datetime.now(), e), file=sys.stderr)
+            return
+        except Exception as e:
+            print("[{}] CONFIG APPLY FAILED: {} (retrying)".format(datetime.now(), e), file=sys.stderr)
+            return
+        self._mtime = mtime
+        self.config = new_config
+
+    def stop(self):
+        scheduler.default_scheduler.cancel(self._job)
@@ -0,0 +1,275 @@
+"""
+シミュレーション用の約定モデル
+
+注文は発注から latency_ms 後に取引所に届いたものとして扱い、以降の約定履歴（trades）と
+板情報（あれば）に照らして約定を判定する。時刻はすべて約定履歴のタイムスタンプ（エポックミリ秒）基準。
+submit は ticker のスレッド、on_trade は trades のスレッドから呼ばれるので、注文の一覧はロックで守る。
+"""
+import itertools
+import threading
+from abc import abstractmethod
+
+from gmo.gmo import to_epoch_ms
+
+ORDER_STATUS_WAITING = 'WAITING'
+ORDER_STATUS_ORDERED = 'ORDERED'
+ORDER_STATUS_EXECUTED = 'EXECUTED'
+ORDER_STATUS_CANCELED = 'CANCELED'
+ORDER_STATUS_EXPIRED = 'EXPIRED'
+
+_order_ids = itertools.count(1)
+
+
+class SimOrder:
+    __slots__ = ('id', 'side', 'price', 'size', 'filled', 'time_in_force', 'settle_type', 'position_id',
+                 'submitted_at', 'active_at', 'expire_at', 'queue_ahead', 'status')
+
+    def __init__(self, side, price, size, settle_type='OPEN', time_in_force=None, position_id=None):
+        self.id = next(_order_ids)
+        self.side = side
+        self.price = float(price)
+        self.size = float(size)
+        self.filled = 0.0
+        self.time_in_force = time_in_force
+        self.settle_type = settle_type
+        self.position_id = position_id
+        self.submitted_at = None
+        self.active_at = None
+        self.expire_at = None
+        self.queue_ahead = 0.0
+        self.status = ORDER_STATUS_WAITING
+
+    def remaining(self):
+        return self.size - self.filled
+
+    def is_done(self):
+        return self.status in (ORDER_STATUS_EXECUTED, ORDER_STATUS_CANCELED, ORDER_STATUS_EXPIRED)
+
+
+class Fill:
+    __slots__ = ('order', 'price', 'size', 'fee', 'time', 'is_maker')
+
+    def __init__(self, order, price, size, fee, time, is_maker):
+        self.order = order
+        self.price = price
+        self.size = size
+        self.fee = fee
+        self.time = time
+        self.is_maker = is_maker
+
+
+class FillModel:
+    """
+    約定モデルの基底クラス
+    """
+    @abstractmethod
+    def submit(self, order: SimOrder, now_ms):
+        pass
+
+    @abstractmethod
+    def on_trade(self, trade) -> list:
+        """
+        約定履歴1件を反映する
+        :return: [Fill]
+        """
+        pass
+
+    @abstractmethod
+    def take_finished(self) -> list:
+        """
+        終了した注文（全量約定・失効・FOK 不成立）を取り出す
+        """
+        pass
+
+
+class InstantFillModel(FillModel):
+    """
+    到着と同時に指値で全量約定する（従来のシミュレーション相当）
+    """
+    def __init__(self, **kwargs):
+        self._lock = threading.Lock()
+        self._fills = []
+        self._finished = []
+
+    def submit(self, order: SimOrder, now_ms):
+        order.submitted_at = order.active_at = now_ms
+        order.filled = order.size
+        order.status = ORDER_STATUS_EXECUTED
+        with self._lock:
+            self._fills.append(Fill(order, order.price, order.size, 0.0, now_ms, False))
+            self._finished.append(order)
+
+    def on_trade(self, trade) -> list:
+        with self._lock:
+            fills, self._fills = self._fills, []
+        return fills
+
+    def take_finished(self) -> list:
+        with self._lock:
+            finished, self._finished = self._finished, []
+        return finished
+
+
+class QueueFillModel(FillModel):
+    """
+    約定履歴と板情報による約定モデル
+
+    - 発注は latency_ms 後に有効になる
+    - 有効になった時点で成立する価格なら、板（無ければ直近の約定価格）に対してテイカーとして約定し、
+      slippage（割合）分だけ不利な価格になる。板の厚みを超えた分は指値で板に残る
+    - FOK は有効になった時点で全量約定できなければ不成立
+    - 板に残った指値は、同値の約定で前に並んでいる数量（板の同値の数量）を消化した後に約定し、
+      指値を超えて約定が起きたら全量約定する（メイカー）
+    - order_limit_time 秒で失効する
+    """
+
+    def __init__(self, latency_ms=100, slippage=0.0, maker_fee_rate=0.0, taker_fee_rate=0.0,
+                 order_limit_time=60, order_book=None):
+        self._latency_ms = latency_ms
+        self._slippage = slippage
+        self._maker_fee_rate = maker_fee_rate
+        self._taker_fee_rate = taker_fee_rate
+        self._order_limit_ms = order_limit_time * 1000
+        self._order_book = order_book
+        self._lock = threading.Lock()
+        self._orders = []
+        self._finished = []
+
+    def submit(self, order: SimOrder, now_ms):
+        order.submitted_at = now_ms
+        order.active_at = now_ms + self._latency_ms
+        order.expire_at = now_ms + self._order_limit_ms
+        with self._lock:
+            self._orders.append(order)
+
+    def take_finished(self) -> list:
+        with self._lock:
+            finished, self._finished = self._finished, []
+        return finished
+
+    def on_trade(self, trade) -> list:
+        now = to_epoch_ms(trade['timestamp'])
+        price = float(trade['price'])
+        size = float(trade['size'])
+        fills = []
+
+        with self._lock:
+            for order in self._orders:
+                if order.status == ORDER_STATUS_WAITING:
+                    if now < order.active_at:
+                        continue
+                    self._activate(order, price, now, fills)
+                elif order.status == ORDER_STATUS_ORDERED:
+                    if now >= order.expire_at:
+                        order.status = ORDER_STATUS_EXPIRED
+                    else:
+                        size = self._match_resting(order, price, size, now, fills)
+
+            self._finished.extend(o for o in self._orders if o.is_done())
+            self._orders = [o for o in self._orders if not o.is_done()]
+        return fills
+
+    def _activate(self, order: SimOrder, last_price, now, fills):
+        levels = self._take_levels(order, last_price)
+        available = sum(s for _, s in levels)
+
+        if order.time_in_force == 'FOK' and available < order.remaining():
+            order.status = ORDER_STATUS_CANCELED
+            return
+
+        for level_price, level_size in levels:
+            if order.remaining() <= 0:
+                break
+            fill_size = min(level_size, order.remaining())
+            self._fill(order, self._slipped(order.side, level_price), fill_size, now, False, fills)
+
+        if order.remaining() <= 0:
+            order.status = ORDER_STATUS_EXECUTED
+        elif order.time_in_force in ('FAK', 'FOK'):
+            order.status = ORDER_STATUS_CANCELED
+        else:
+            order.status = ORDER_STATUS_ORDERED
+            order.queue_ahead = self._queue_size(order)
+
+    def _take_levels(self, order: SimOrder, last_price):
+        """
+        到着時点で指値以下（売りなら以上）で約定できる [(価格, 数量)]
+        """
+        book = self._order_book
+        if book is not None and book.is_fresh():
+            levels = []
+            for p, s in book.levels(order.side):
+                if not _crosses(order.side, p, order.price):
+                    break
+                levels.append((p, s))
+            return levels
+
+        # 板が無い場合は直近の約定価格で全量約定できたものとする
+        if _crosses(order.side, last_price, order.price):
+            return [(last_price, order.remaining())]
+        return []
+
+    def _queue_size(self, order: SimOrder):
+        book = self._order_book
+        if book is None or not book.is_fresh():
+            return 0.0
+        return book.resting_size(order.side, order.price)
+
+    def _match_resting(self, order: SimOrder, price, size, now, fills):
+        """
+        :return: この注文で消費しなかった約定数量
+        """
+        if _crosses(order.side, price, order.price) and price != order.price:
+            # 指値を超えて約定 = 自分の指値まで板が食われた
+            self._fill(order, order.price, order.remaining(), now, True, fills)
+            order.status = ORDER_STATUS_EXECUTED
+            return size
+
+        if price != order.price:
+            return size
+
+        consumed = min(order.queue_ahead, size)
+        order.queue_ahead -= consumed
+        size -= consumed
+        if size <= 0:
+            return 0.0
+
+        fill_size = min(size, order.remaining())
+        self._fill(order, order.price, fill_size, now, True, fills)
+        if order.remaining() <= 0:
+            order.status = ORDER_STATUS_EXECUTED
+        return size - fill_size
+
+    def _slipped(self, side, price):
+        return price * (1 + self._slippage) if side == 'BUY' else price * (1 - self._slippage)
+
+    def _fill(self, order: SimOrder, price, size, now, is_maker, fills):
+        fee_rate = self._maker_fee_rate if is_maker else self._taker_fee_rate
+        order.filled += size
+        fills.append(Fill(order, price, size, price * size * fee_rate, now, is_maker))
+
+
+def _crosses(side, market_price, limit_price):
+    if side == 'BUY':
+        return market_price <= limit_price
+    return market_price >= limit_price
+
+
+FILL_MODELS = {
+    'instant': InstantFillModel,
+    'queue': QueueFillModel,
+}
+
+
+def create_fill_model(config, order_book=None, order_limit_time=60) -> FillModel:
+    """
+    :param config: {"type": "queue", "latency_ms": 100, ...}
+    """
+    config = dict(config or {})
+    model_type = config.pop('type', 'queue')
+    if model_type not in FILL_MODELS:
+        raise ValueError("unknown fill model '{}'".format(model_type))
+    if model_type == 'queue':
+        config.setdefault('order_limit_time', order_limit_time)
+        config.setdefault('order_book', order_book)
+    return FILL_MODELS[model_type](**config)
@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+import time
+
+
+class StateJournal:
+    """
+    追記型の状態ジャーナル
+
+    状態（キーと値の辞書）の変更を1行1レコードで追記し、fsync は batch_size 件または
+    sync_interval 秒毎にまとめて行う。レコード数が compact_threshold を超えたら
+    状態全体をスナップショットに書き出して（一時ファイル + rename）ジャーナルを空にする。
+
+    各レコードには通し番号を振り、スナップショットには反映済みの番号を保存するため、
+    スナップショット書き出し後・ジャーナル切り詰め前にクラッシュしても二重に適用されない。
+    書き込み途中でクラッシュした最終行は起動時に切り捨ててから追記を再開する。
+
+    ws のスレッドとスケジューラのスレッドから書き込まれるため、書き込みはロックで直列化する。
+    """
+
+    def __init__(self, path, batch_size=16, sync_interval=1.0, compact_threshold=10000):
+        self._path = path
+        self._snapshot_path = path + '.snapshot'
+        self._batch_size = batch_size
+        self._sync_interval = sync_interval
+        self._compact_threshold = compact_threshold
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self._lock = threading.Lock()
+        self.state = {}
+        self._seq = 0
+        self._records = 0
+        self._restore()
+
+        self._file = open(self._path, 'a', encoding='utf-8')
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _restore(self):
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self.state = snapshot['state']
+            self._seq = snapshot['seq']
+
+        if not os.path.exists(self._path):
+            return
+
+        good = 0  # 最後に読めたレコードの終わりのバイト位置
+        with open(self._path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 書き込み途中でクラッシュした最終行
+                    break
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                good += len(line)
+                self._records += 1
+                if record['seq'] <= self._seq:
+                    continue
+                self._apply(record)
+                self._seq = record['seq']
+
+        if good < os.path.getsize(self._path):
+            # 壊れた行の続きに追記しないよう切り捨てる
+            print("JOURNAL TRUNCATED: {} at {} bytes".format(self._path, good))
+            with open(self._path, 'r+b') as f:
+                f.truncate(good)
+
+    def _apply(self, record):
+        op = record['op']
+        if op == 'set':
+            self.state[record['k']] = record['v']
+        elif op == 'add':
+            self.state[record['k']] = self.state.get(record['k'], 0) + record['v']
+        elif op == 'del':
+            self.state.pop(record['k'], None)
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, key, value, sync=False):
+        self._append({'op': 'set', 'k': key, 'v': value}, sync)
+
+    def add(self, key, amount, sync=False):
+        self._append({'op': 'add', 'k': key, 'v': amount}, sync)
+
+    def delete(self, key, sync=False):
+        self._append({'op': 'del', 'k': key}, sync)
+
+    def _append(self, record, sync):
+        with self._lock:
+            self._seq += 1
+            record['seq'] = self._seq
+            self._apply(record)
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            # プロセスのクラッシュに備えて OS には毎回渡し、fsync だけまとめる
+            self._file.flush()
+            self._records += 1
+            self._unsynced += 1
+
+            if sync or self._unsynced >= self._batch_size or time.monotonic() - self._last_sync >= self._sync_interval:
+                self._sync()
+
+            if self._records >= self._compact_threshold:
+                self._compact()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def compact(self):
+        """
+        現在の状態をスナップショットに書き出し、ジャーナルを空にする
+        """
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        self._sync()
+        tmp_path = self._snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'seq': self._seq, 'state': self.state}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+
+        self._file.close()
+        self._file = open(self._path, 'w', encoding='utf-8')
+        self._records = 0
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
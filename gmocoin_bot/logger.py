@@ -0,0 +1,114 @@
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+_STOP = object()
+
+
+class Logger:
+    """
+    取引ログ
+
+    呼び出し側はキューに積むだけで、書き込みは専用スレッドが開きっぱなしのバッファ付きファイルに行う。
+    キューが溢れた場合は呼び出し側を待たせずに破棄し、件数を dropped に数える。
+    ファイルサイズ（max_bytes）または経過時間（rotate_interval 秒）でローテーションする。
+    """
+    LOG_DIR = 'logs'
+    QUEUE_SIZE = 10000
+    FLUSH_INTERVAL = 1.0
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, rotate_interval=None, backup_count=5):
+        if not os.path.exists(self.LOG_DIR):
+            os.makedirs(self.LOG_DIR)
+
+        self.__filepath = "{}/{}".format(self.LOG_DIR, filename)
+        # Create File
+        f = open(self.__filepath, "x")
+        f.close()
+
+        self._max_bytes = max_bytes
+        self._rotate_interval = rotate_interval
+        self._backup_count = backup_count
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, output_str):
+        self._put(output_str)
+
+    def log_record(self, record: dict):
+        """
+        構造化ログ（JSONL）。シリアライズも書き込みスレッドで行う
+        """
+        self._put(record)
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _open(self):
+        return open(self.__filepath, 'a', buffering=self.BUFFER_SIZE, encoding='utf-8')
+
+    def _write_loop(self):
+        f = self._open()
+        # 書いたバイト数は自分で数える（テキストファイルの tell() はバッファを書き出してしまう）
+        written = f.tell()
+        opened_at = time.monotonic()
+        last_flush = opened_at
+        while True:
+            try:
+                item = self._queue.get(timeout=self.FLUSH_INTERVAL)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                break
+
+            if item is not None:
+                try:
+                    line = item if isinstance(item, str) else json.dumps(item, ensure_ascii=False, default=str)
+                    f.write(line)
+                    f.write('\n')
+                    written += len(line.encode('utf-8')) + 1
+                except (TypeError, ValueError, OSError) as e:
+                    print("LOG WRITE FAILED:", e, file=sys.stderr)
+
+            now = time.monotonic()
+            if self._queue.empty() or now - last_flush >= self.FLUSH_INTERVAL:
+                f.flush()
+                last_flush = now
+
+            if (self._max_bytes and written >= self._max_bytes) or \
+                    (self._rotate_interval and now - opened_at >= self._rotate_interval and written > 0):
+                f.close()
+                self._rotate()
+                f = self._open()
+                written = 0
+                opened_at = now
+
+        f.close()
+
+    def _rotate(self):
+        for i in range(self._backup_count - 1, 0, -1):
+            src = "{}.{}".format(self.__filepath, i)
+            if os.path.exists(src):
+                os.replace(src, "{}.{}".format(self.__filepath, i + 1))
+        if self._backup_count > 0:
+            os.replace(self.__filepath, "{}.1".format(self.__filepath))
+        else:
+            os.remove(self.__filepath)
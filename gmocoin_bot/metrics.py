@@ -0,0 +1,426 @@
+"""
+実行時のメトリクス
+
+カウンター・ゲージ・ヒストグラムを登録し、Prometheus のテキスト形式で HTTP 公開する。
+
+    "metrics_port": 9100   # http://127.0.0.1:9100/metrics
+
+記録する側（ティックの処理など）はロックを取らない。カウンターとヒストグラムはスレッド毎の値を持ち、
+各スレッドは自分の値だけを更新する。合計は取得時（スクレイプ時）に行う。
+ポジション数や損益のように元のオブジェクトが持っている値は、取得時に関数で読む（collector）。
+"""
+import bisect
+import math
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: dict):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items()) + '}'
+
+
+# region metric
+class _CounterChild:
+    __slots__ = ('_shards',)
+
+    def __init__(self):
+        self._shards = {}  # スレッドID -> 値
+
+    def inc(self, amount=1):
+        tid = threading.get_ident()
+        shards = self._shards
+        shards[tid] = shards.get(tid, 0) + amount
+
+    def get(self):
+        return sum(list(self._shards.values()))
+
+
+class _GaugeChild:
+    __slots__ = ('value', '_function')
+
+    def __init__(self):
+        self.value = 0
+        self._function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """
+        取得時に function() の値を返す
+        """
+        self._function = function
+
+    def get(self):
+        if self._function is not None:
+            return self._function()
+        return self.value
+
+
+class _HistogramChild:
+    __slots__ = ('_bounds', '_shards')
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._shards = {}  # スレッドID -> [バケット毎の件数..., 合計]
+
+    def observe(self, value):
+        tid = threading.get_ident()
+        shard = self._shards.get(tid)
+        if shard is None:
+            shard = self._shards[tid] = [0] * (len(self._bounds) + 2)
+        shard[bisect.bisect_left(self._bounds, value)] += 1
+        shard[-1] += value
+
+    def get(self):
+        """
+        :return: (累積件数のリスト（最後が +Inf）, 合計)
+        """
+        n = len(self._bounds) + 1
+        counts = [0] * n
+        total = 0.0
+        for shard in list(self._shards.values()):
+            for i in range(n):
+                counts[i] += shard[i]
+            total += shard[-1]
+        for i in range(1, n):
+            counts[i] += counts[i - 1]
+        return counts, total
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        ラベルの値に対応する子。ティックの処理で使う場合は取得した子を保持しておくこと
+        """
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("{}: expected labels {}".format(self.name, self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(tuple(str(v) for v in values), None)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield dict(zip(self.labelnames, values)), child
+
+    def render(self, lines):
+        lines.append('# HELP {} {}'.format(self.name, self.documentation))
+        lines.append('# TYPE {} {}'.format(self.name, self.TYPE))
+        for labels, child in self._samples():
+            try:
+                value = child.get()
+            except Exception:
+                continue
+            if value is not None:
+                lines.append('{}{} {}'.format(self.name, _format_labels(labels), _format_value(value)))
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self._bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self._bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def render(self, lines):
+        lines.append('# HELP {} {}'.format(self.name, self.documentation))
+        lines.append('# TYPE {} histogram'.format(self.name))
+        for labels, child in self._samples():
+            counts, total = child.get()
+            for bound, count in zip(self._bounds + (math.inf,), counts):
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(dict(labels, le=_format_value(float(bound)))), count))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(labels), _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(labels), counts[-1]))
+# endregion metric
+
+
+class Registry:
+    """
+    メトリクスの登録先。同じ名前で登録すると既存のものを返す
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError("metric {} already registered with different type or labels".format(name))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def collector(self, function):
+        """
+        取得時に呼ぶ関数を登録する
+        :param function: function() -> [(名前, 種類, 説明, [(ラベルの dict, 値)])]
+        """
+        with self._lock:
+            self._collectors.append(function)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for metric in metrics:
+            metric.render(lines)
+        for function in collectors:
+            try:
+                families = function()
+            except Exception as e:
+                print("METRICS COLLECTOR FAILED: {}".format(e), file=sys.stderr)
+                continue
+            for name, kind, documentation, samples in families:
+                lines.append('# HELP {} {}'.format(name, documentation))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+default_registry = Registry()
+
+
+def counter(name, documentation, labelnames=()) -> Counter:
+    return default_registry.counter(name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()) -> Gauge:
+    return default_registry.gauge(name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return default_registry.histogram(name, documentation, labelnames, buckets)
+
+
+# region collectors
+def rest_observer(account):
+    """
+    GMO.on_request に設定する。エンドポイント毎の呼び出し数・応答時間・呼び出し制限の待ち時間
+    """
+    requests = counter('gmocoin_rest_requests_total', 'REST API calls.', ('account', 'method', 'endpoint'))
+    seconds = histogram('gmocoin_rest_request_seconds', 'REST API response time.', ('account', 'endpoint'))
+    throttle = counter('gmocoin_rest_throttle_wait_seconds_total', 'Seconds spent waiting for the call limiter.',
+                       ('account', 'endpoint'))
+
+    def observe(method, endpoint, elapsed, throttle_wait):
+        requests.labels(account, method, endpoint).inc()
+        seconds.labels(account, endpoint).observe(elapsed)
+        if throttle_wait > 0.001:
+            throttle.labels(account, endpoint).inc(throttle_wait)
+    return observe
+
+
+def instrument_accounts(accounts: dict):
+    """
+    :param accounts: {アカウント名: GMO}
+    """
+    for name, api in accounts.items():
+        api.on_request = rest_observer(name)
+
+
+def bot_collector(get_bots):
+    """
+    ボット毎のポジション数・注文数・損益
+    :param get_bots: 現在のボットのリストを返す関数（ホットリロードで入れ替わるため）
+    """
+    def collect():
+        bots = list(get_bots())
+        families = [
+            ('gmocoin_bot_positions', 'gauge', 'Open positions.', lambda b: len(b._position_list)),
+            ('gmocoin_bot_pending_orders', 'gauge', 'Entry orders waiting for execution.',
+             lambda b: len(b._entry_order_list)),
+            ('gmocoin_bot_expired_orders_total', 'counter', 'Orders cancelled after order_limit_time.',
+             lambda b: b._orders.cancelled),
+            ('gmocoin_bot_running', 'gauge', '1 if the bot is running.', lambda b: int(b.get_state().name == 'Running')),
+            ('gmocoin_bot_trades_total', 'counter', 'Closed trades.', lambda b: b._analyzer.trade_num),
+            ('gmocoin_bot_wins_total', 'counter', 'Closed trades with profit.', lambda b: b._analyzer.win_num),
+            ('gmocoin_bot_loss_gain_jpy', 'gauge', 'Realized profit and loss.', lambda b: b._analyzer.loss_gain),
+            ('gmocoin_bot_max_drawdown_jpy', 'gauge', 'Maximum drawdown.', lambda b: b._analyzer.max_drawdown),
+        ]
+        return [(name, kind, documentation, [({'bot': b.name}, value(b)) for b in bots])
+                for name, kind, documentation, value in families]
+    return collect
+
+
+def risk_collector(risk_engines: dict):
+    """
+    アカウント毎のリスクエンジンの状態
+    """
+    def collect():
+        items = list(risk_engines.items())
+        families = [
+            ('gmocoin_risk_available_margin_jpy', 'gauge', 'Estimated available margin.', lambda e: e.available),
+            ('gmocoin_risk_exposure_jpy', 'gauge', 'Gross exposure at entry price.', lambda e: e.exposure),
+            ('gmocoin_risk_realized_jpy', 'gauge', 'Realized profit and loss today.', lambda e: e.realized),
+            ('gmocoin_risk_unrealized_jpy', 'gauge', 'Unrealized profit and loss.', lambda e: e.unrealized),
+            ('gmocoin_risk_kill_switch', 'gauge', '1 if the kill switch is tripped.', lambda e: int(e.is_killed())),
+        ]
+        result = [(name, kind, documentation, [({'account': a}, value(e)) for a, e in items])
+                  for name, kind, documentation, value in families]
+        result.append(('gmocoin_risk_rejects_total', 'counter', 'Rejected entry orders.',
+                       [({'account': a, 'reason': r}, n) for a, e in items for r, n in list(e.rejects.items())]))
+        return result
+    return collect
+
+
+def scheduler_collector(scheduler):
+    """
+    定期実行ジョブの遅延と実行できなかった回数
+    """
+    def collect():
+        stats = scheduler.stats()
+        return [
+            ('gmocoin_scheduler_runs_total', 'counter', 'Job runs.', [({'job': s['name']}, s['runs']) for s in stats]),
+            ('gmocoin_scheduler_skipped_total', 'counter', 'Job runs skipped because the previous run was still running.',
+             [({'job': s['name']}, s['skipped']) for s in stats]),
+            ('gmocoin_scheduler_lateness_seconds', 'gauge', 'Lateness of the last run.',
+             [({'job': s['name']}, s['last_lateness']) for s in stats]),
+            ('gmocoin_scheduler_max_lateness_seconds', 'gauge', 'Maximum lateness.',
+             [({'job': s['name']}, s['max_lateness']) for s in stats]),
+        ]
+    return collect
+
+
+def register_process(get_bots, risk_engines, registry=default_registry):
+    """
+    ボットを動かすプロセスの標準のメトリクスをまとめて登録する
+    """
+    from gmocoin_bot.scheduler import default_scheduler
+
+    registry.collector(bot_collector(get_bots))
+    registry.collector(risk_collector(risk_engines))
+    registry.collector(scheduler_collector(default_scheduler))
+# endregion collectors
+
+
+# region server
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = default_registry
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    def __init__(self, port, host='127.0.0.1', registry=default_registry):
+        handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        print("METRICS: http://{}:{}/metrics".format(*self._server.server_address[:2]))
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def start_server(port, host='127.0.0.1', registry=default_registry) -> MetricsServer:
+    return MetricsServer(port, host, registry).start()
+# endregion server
@@ -0,0 +1,259 @@
+"""
+注文のライフサイクル管理
+
+発注した注文を注文IDで管理し、注文・約定イベントで状態を進める。有効期限はタイマーホイールで管理し、
+order_limit_time 秒を過ぎた注文をまとめて cancel_orders で取り消す（REST での定期的な確認は不要）。
+
+    ORDERED --(約定)--> 完了
+       |  \\--(取消・失効イベント)--> 完了
+       \\--(期限切れ)--> CANCELLING --(取消イベント・約定)--> 完了
+                            |--(取消失敗: 既に完了)--> 完了
+                            \\--(取消失敗)--> RETRY_MS 後に再度取消
+"""
+import sys
+import threading
+from collections import deque
+from datetime import datetime
+
+ORDER_LIMIT_TIME = 60
+
+ORDER_STATUS_ORDERED = 'ORDERED'
+ORDER_STATUS_CANCELLING = 'CANCELLING'
+
+TICK_MS = 100
+WHEEL_SLOTS = 1024
+CANCEL_BATCH = 10  # cancelOrders で一度に指定できる注文数
+RETRY_MS = 5000
+EARLY_ORDERS = 1000
+
+# 取消できなかった注文のうち、既に約定・取消済みのもの
+ERR_ALREADY_DONE = ('ERR-5122',)
+
+
+class TimerWheel:
+    """
+    ハッシュ化タイマーホイール
+
+    期限を TICK_MS 単位のティックに丸めて slots 個のスロットに振り分ける。追加・削除は O(1)、
+    advance は経過したティック数分のスロットだけを見る。1周より先の期限はスロットに残り、該当する周で取り出される。
+    """
+
+    def __init__(self, tick_ms=TICK_MS, slots=WHEEL_SLOTS):
+        self._tick_ms = tick_ms
+        self._slots = [dict() for _ in range(slots)]
+        self._timers = {}  # キー -> 期限のティック
+        self._current = None
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def add(self, key, deadline_ms):
+        self.remove(key)
+        tick = -(-int(deadline_ms) // self._tick_ms)  # 切り上げ（期限より早く発火しない）
+        if self._current is not None and tick <= self._current:
+            tick = self._current + 1
+        self._timers[key] = tick
+        self._slots[tick % len(self._slots)][key] = tick
+
+    def remove(self, key):
+        tick = self._timers.pop(key, None)
+        if tick is not None:
+            self._slots[tick % len(self._slots)].pop(key, None)
+
+    def advance(self, now_ms) -> list:
+        """
+        now_ms までに期限が来たキーを取り出す
+        """
+        now = int(now_ms) // self._tick_ms
+        if self._current is None:
+            self._current = min(now, min(self._timers.values(), default=now)) - 1
+        if now <= self._current:
+            return []
+
+        expired = []
+        # 1周以上進んだ場合は全スロットを1回ずつ見れば足りる
+        start = max(self._current + 1, now - len(self._slots) + 1)
+        for tick in range(start, now + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if not slot:
+                continue
+            for key, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[key]
+                    del self._timers[key]
+                    expired.append(key)
+        self._current = now
+        return expired
+
+
+class TrackedOrder:
+    __slots__ = ('id', 'settle_type', 'size', 'executed', 'status', 'ordered_at')
+
+    def __init__(self, order_id, settle_type, size, ordered_at):
+        self.id = order_id
+        self.settle_type = settle_type
+        self.size = float(size)
+        self.executed = 0.0
+        self.status = ORDER_STATUS_ORDERED
+        self.ordered_at = ordered_at
+
+
+class OrderTracker:
+    """
+    ボットが出した注文を管理する。expire() を TICK_MS 間隔で呼ぶこと
+
+    発注 API の応答より先に約定・取消イベントが届くことがあるので、未登録の注文のイベントは
+    EARLY_ORDERS 件まで覚えておき、track() の時に反映する。
+
+    :param on_finish: on_finish(TrackedOrder)。約定・取消で注文が無くなった時に呼ばれる
+    """
+
+    def __init__(self, api, order_limit_time=ORDER_LIMIT_TIME, on_finish=None, name='orders'):
+        self._api = api
+        self.order_limit_ms = int(order_limit_time * 1000)
+        self._on_finish = on_finish
+        self._name = name
+        self._lock = threading.Lock()
+        self._orders = {}
+        self._wheel = TimerWheel()
+        self._early = {}  # 注文ID -> [約定数量, 完了したか]
+        self._early_order = deque()
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return int(order_id) in self._orders
+
+    def ids(self, settle_type=None) -> list:
+        with self._lock:
+            return [o.id for o in self._orders.values() if settle_type is None or o.settle_type == settle_type]
+
+    def set_order_limit_time(self, order_limit_time):
+        """
+        以降に登録する注文の有効期限を変える
+        """
+        self.order_limit_ms = int(order_limit_time * 1000)
+
+    def track(self, order_id, settle_type, size, ordered_at=None):
+        """
+        :param ordered_at: 注文時刻（取引所時刻のエポックミリ秒）。省略時は現在
+        """
+        order_id = int(order_id)
+        if ordered_at is None:
+            ordered_at = self._api.clock.exchange_now_ms()
+        with self._lock:
+            if order_id in self._orders:
+                return self._orders[order_id]
+            order = TrackedOrder(order_id, settle_type, size, ordered_at)
+            early = self._early.pop(order_id, None)
+            if early is not None:
+                order.executed = early[0]
+                if early[1] or order.executed >= order.size - 1e-12:
+                    return None
+            self._orders[order_id] = order
+            self._wheel.add(order_id, ordered_at + self.order_limit_ms)
+            return order
+
+    def forget(self, order_id):
+        """
+        イベントを取りこぼした注文を管理から外す（on_finish は呼ばない）
+        """
+        with self._lock:
+            self._wheel.remove(int(order_id))
+            return self._orders.pop(int(order_id), None)
+
+    # region events
+    def on_order_event(self, data):
+        if data['msgType'] == 'COR' or data.get('orderStatus') in ('CANCELED', 'EXPIRED'):
+            self._finish(int(data['orderId']))
+
+    def on_execution(self, data):
+        order_id = int(data['orderId'])
+        with self._lock:
+            order = self._orders.get(order_id)
+            if order is None:
+                early = self._early_entry(order_id)
+                early[0] += float(data['executionSize'])
+                if 'orderExecutedSize' in data and float(data['orderExecutedSize']) >= float(data['orderSize']):
+                    early[1] = True
+                return
+            order.executed += float(data['executionSize'])
+            if 'orderExecutedSize' in data:
+                order.executed = max(order.executed, float(data['orderExecutedSize']))
+            done = order.executed >= order.size - 1e-12
+        if done:
+            self._finish(order_id)
+
+    def _finish(self, order_id):
+        with self._lock:
+            order = self._orders.pop(order_id, None)
+            if order is None:
+                self._early_entry(order_id)[1] = True
+                return
+            self._wheel.remove(order_id)
+        if self._on_finish:
+            self._on_finish(order)
+
+    def _early_entry(self, order_id):
+        early = self._early.get(order_id)
+        if early is None:
+            early = self._early[order_id] = [0.0, False]
+            # 他のボットの注文のイベントも来るので古いものから捨てる
+            self._early_order.append(order_id)
+            if len(self._early_order) > EARLY_ORDERS:
+                self._early.pop(self._early_order.popleft(), None)
+        return early
+    # endregion events
+
+    def expire(self):
+        """
+        期限を過ぎた注文をまとめて取り消す
+        """
+        now = self._api.clock.exchange_now_ms()
+        with self._lock:
+            expired = [self._orders[i] for i in self._wheel.advance(now) if i in self._orders]
+            for order in expired:
+                order.status = ORDER_STATUS_CANCELLING
+                # 取消イベントが来なければ再度取り消す
+                self._wheel.add(order.id, now + RETRY_MS)
+        if not expired:
+            return
+
+        ids = [o.id for o in expired]
+        for i in range(0, len(ids), CANCEL_BATCH):
+            self._cancel(ids[i:i + CANCEL_BATCH])
+
+    def _cancel(self, order_ids):
+        res = self._api.cancel_orders(order_ids)
+        if not res:
+            return
+        self.cancelled += len(res.get('success', []))
+        for failed in res.get('failed', []):
+            if failed.get('message_code') in ERR_ALREADY_DONE:
+                # 約定・取消のイベントを取りこぼしている
+                order = self.forget(failed['orderId'])
+                if order is not None and self._on_finish:
+                    self._on_finish(order)
+            else:
+                print("[{}] [{}] CANCEL FAILED: {} {}".format(
+                    datetime.now(), self._name, failed.get('orderId'), failed.get('message_string')), file=sys.stderr)
+
+    def sync(self, active_orders):
+        """
+        activeOrders の結果と突き合わせ、既に無くなった注文を管理から外す
+        :param active_orders: activeOrders() の list
+        """
+        active = {int(o['orderId']) for o in active_orders}
+        # 発注直後でまだ一覧に出ていない注文は外さない
+        since = self._api.clock.exchange_now_ms() - RETRY_MS
+        with self._lock:
+            gone = [o.id for o in self._orders.values() if o.id not in active and o.ordered_at < since]
+        for order_id in gone:
+            order = self.forget(order_id)
+            if order is not None and self._on_finish:
+                self._on_finish(order)
@@ -0,0 +1,257 @@
+"""
+ティック処理のプロファイラ
+
+2つのモードを実行中に切り替えられる（オフの時は何もしないので負荷はない）。
+
+- サンプリング: タイマーシグナル毎に全スレッドのスタックを記録し、停止時に collapsed 形式
+  （flamegraph.pl・speedscope で読める "スレッド;関数;関数 回数" の行）でファイルに書き出す
+- 関数計測: TIMED_FUNCTIONS の関数を計測用のラッパーに差し替え、処理時間を
+  メトリクス（gmocoin_function_seconds）に記録する。停止時に元の関数に戻して集計を表示する
+
+    "profiler": {
+        "rate": 100,            # 1秒あたりのサンプル数
+        "clock": "wall",        # wall: 経過時間（REST 待ちも含む） / cpu: CPU 時間
+        "output_dir": "profile",
+        "threads": null,        # 記録するスレッド名の前方一致（省略時は全スレッド）
+        "sampling": false,      # 起動時からサンプリングする
+        "timing": false         # 起動時から関数を計測する
+    }
+
+kill -USR1 <pid> でサンプリング、kill -USR2 <pid> で関数計測の開始・停止を切り替える。
+"""
+import functools
+import importlib
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from gmocoin_bot import metrics
+
+DEFAULT_RATE = 100
+OUTPUT_DIR = 'profile'
+
+# 記録しない待機中のスタック（一番上のフレームで判定）
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('queue.py', 'get'),
+    ('selectors.py', 'select'),
+    ('connection.py', 'wait'),
+    ('socketserver.py', 'serve_forever'),
+}
+
+# (モジュール, クラス, 関数)
+TIMED_FUNCTIONS = [
+    ('chart.chart', 'TechnicalChart', 'update'),
+    ('chart.trend', 'TrendChecker', 'check_trend'),
+    ('gmocoin_bot.bot', 'GMOCoinBot', 'update_ticker'),
+    ('gmo.gmo', 'GMO', '_send_private_get'),
+    ('gmo.gmo', 'GMO', '_send_private_post'),
+]
+
+FUNCTION_SECONDS = metrics.histogram('gmocoin_function_seconds', 'Time spent in profiled functions.', ('function',),
+                                     buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                                              0.1, 0.25, 0.5, 1.0))
+
+
+class SamplingProfiler:
+    """
+    シグナルハンドラはメインスレッドで実行されるため、start / stop もメインスレッドから呼ぶこと
+    （シグナルでの切り替えはハンドラ内なので問題ない）
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, clock='wall', output_dir=OUTPUT_DIR, threads=None):
+        self._clock = clock
+        self._signal = self._timer = None
+        self._interval = 1.0 / rate
+        self._output_dir = output_dir
+        self._threads = tuple(threads) if threads else None
+        self._counts = Counter()
+        self._labels = {}  # コードオブジェクト -> 表示名
+        self._previous_handler = None
+        self.samples = 0
+        self.running = False
+        self._started_at = None
+
+    def start(self):
+        if self.running:
+            return
+        self._counts.clear()
+        self.samples = 0
+        self._started_at = datetime.now()
+        if self._clock == 'cpu':
+            self._signal, self._timer = signal.SIGPROF, signal.ITIMER_PROF
+        else:
+            self._signal, self._timer = signal.SIGALRM, signal.ITIMER_REAL
+        self._previous_handler = signal.signal(self._signal, self._sample)
+        signal.setitimer(self._timer, self._interval, self._interval)
+        self.running = True
+        print("[{}] PROFILER SAMPLING STARTED ({:.0f} Hz)".format(datetime.now(), 1 / self._interval))
+
+    def stop(self) -> str or None:
+        """
+        :return: 書き出したファイルのパス
+        """
+        if not self.running:
+            return None
+        signal.setitimer(self._timer, 0)
+        signal.signal(self._signal, self._previous_handler or signal.SIG_DFL)
+        self.running = False
+        path = self.write()
+        print("[{}] PROFILER SAMPLING STOPPED: {} samples -> {}".format(datetime.now(), self.samples, path))
+        return path
+
+    def write(self) -> str:
+        if not os.path.exists(self._output_dir):
+            os.makedirs(self._output_dir)
+        path = os.path.join(self._output_dir, "profile.{}.{}.collapsed".format(
+            os.getpid(), self._started_at.strftime("%Y%m%d%H%M%S")))
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self._counts.most_common():
+                f.write("{} {}\n".format(stack, count))
+        return path
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            name = getattr(code, 'co_qualname', code.co_name)
+            label = self._labels[code] = "{} ({}:{})".format(name, os.path.basename(code.co_filename),
+                                                             code.co_firstlineno)
+        return label
+
+    def _sample(self, signum, frame):
+        self.samples += 1
+        names = {t.ident: t.name for t in threading.enumerate()}
+        main = threading.main_thread().ident
+        for ident, top in sys._current_frames().items():
+            name = names.get(ident, str(ident))
+            if self._threads and not name.startswith(self._threads):
+                continue
+            if ident == main:
+                # メインスレッドの一番上はこのハンドラなので、割り込まれたフレームから辿る
+                top = frame
+            if top is None:
+                continue
+            code = top.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+
+            stack = []
+            f = top
+            while f is not None:
+                stack.append(self._label(f.f_code))
+                f = f.f_back
+            stack.append(name.replace(' ', '_'))
+            self._counts[';'.join(reversed(stack))] += 1
+
+
+class FunctionTimer:
+    def __init__(self, functions=None):
+        self._functions = functions or TIMED_FUNCTIONS
+        self._originals = []  # (クラス, 関数名, 元の関数)
+        self._children = {}
+        self.running = False
+
+    def _targets(self):
+        for module_name, class_name, function_name in self._functions:
+            cls = getattr(importlib.import_module(module_name), class_name)
+            yield cls, function_name
+            # トレンド判定は実際の計算（_check_trend）もサブクラス毎に計測する
+            if function_name == 'check_trend':
+                for sub in _subclasses(cls):
+                    if '_check_trend' in sub.__dict__:
+                        yield sub, '_check_trend'
+
+    def start(self):
+        if self.running:
+            return
+        for cls, function_name in self._targets():
+            original = cls.__dict__[function_name]
+            label = "{}.{}".format(cls.__name__, function_name)
+            setattr(cls, function_name, self._wrap(original, label))
+            self._originals.append((cls, function_name, original))
+        self.running = True
+        print("[{}] PROFILER TIMING STARTED: {}".format(datetime.now(), [c.__name__ + '.' + n for c, n, _ in self._originals]))
+
+    def stop(self):
+        if not self.running:
+            return
+        for cls, function_name, original in reversed(self._originals):
+            setattr(cls, function_name, original)
+        self._originals = []
+        self.running = False
+        print("[{}] PROFILER TIMING STOPPED".format(datetime.now()))
+        self.report()
+
+    def _wrap(self, function, label):
+        child = self._children.get(label)
+        if child is None:
+            child = self._children[label] = FUNCTION_SECONDS.labels(label)
+        observe = child.observe
+        perf_counter = time.perf_counter
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(perf_counter() - started)
+        return timed
+
+    def report(self):
+        for label, child in sorted(self._children.items()):
+            counts, total = child.get()
+            if counts[-1]:
+                print("  {:<40} calls: {:>8}  total: {:>9.3f}s  avg: {:>9.3f}ms".format(
+                    label, counts[-1], total, total / counts[-1] * 1000))
+
+
+def _subclasses(cls):
+    for sub in cls.__subclasses__():
+        yield sub
+        yield from _subclasses(sub)
+
+
+class Profiler:
+    def __init__(self, config=None):
+        config = config or {}
+        self.sampling = SamplingProfiler(config.get('rate', DEFAULT_RATE), config.get('clock', 'wall'),
+                                         config.get('output_dir', OUTPUT_DIR), config.get('threads'))
+        self.timing = FunctionTimer()
+
+    def toggle_sampling(self, *_):
+        if self.sampling.running:
+            self.sampling.stop()
+        else:
+            self.sampling.start()
+
+    def toggle_timing(self, *_):
+        if self.timing.running:
+            self.timing.stop()
+        else:
+            self.timing.start()
+
+    def stop(self):
+        self.sampling.stop()
+        self.timing.stop()
+
+
+def install(config=None) -> Profiler:
+    """
+    SIGUSR1 / SIGUSR2 で切り替えられるようにする。メインスレッドから呼ぶこと
+    """
+    config = config or {}
+    profiler = Profiler(config)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profiler.toggle_sampling)
+        signal.signal(signal.SIGUSR2, profiler.toggle_timing)
+    if config.get('sampling'):
+        profiler.sampling.start()
+    if config.get('timing'):
+        profiler.timing.start()
+    return profiler
@@ -0,0 +1,395 @@
+"""
+発注前のリスクチェック
+
+アカウント毎に1つ作り、そのアカウントのボットで共有する。証拠金・建玉・損益はイベントから差分で更新し、
+発注可否の判定では REST を呼ばない。取引余力は定期的な account_margin の結果で補正する。
+
+    "risk": {
+        "max_exposure_jpy": 2000000,      # アカウント全体の建玉（絶対値）の上限
+        "max_bot_exposure_jpy": 500000,   # ボット毎の建玉の上限
+        "max_orders_per_minute": 30,      # アカウント全体の新規注文数/分
+        "max_daily_loss_jpy": 20000,      # 日次損失（確定＋含み）の上限。超えたらキルスイッチ
+        "margin_buffer_rate": 0.0         # 取引余力のうち使わずに残す割合
+    }
+
+cluster でワーカーが複数ある場合はワーカー毎にリスクエンジンを作り、アカウント全体の上限
+（max_exposure_jpy・max_orders_per_minute・max_daily_loss_jpy）と取引余力をワーカー数で分けて持たせる。
+各ワーカーの上限の合計がアカウントの上限になり、キルスイッチはワーカー毎に自分の取り分で判定する
+（どのワーカーも取り分を超えないので、合計がアカウントの上限を超えることはない）。
+ボット毎の上限と margin_buffer_rate は分けない。
+"""
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from gmo.clock import default_clock
+from gmocoin_bot.accounts import account_configs
+
+LEVERAGE_RATE = 4
+DAY_MS = 24 * 60 * 60 * 1000
+JST_OFFSET_MS = 9 * 60 * 60 * 1000
+SEEN_EXECUTIONS = 10000
+EARLY_ORDERS = 1000
+
+REJECT_KILL_SWITCH = 'kill_switch'
+REJECT_MARGIN = 'margin'
+REJECT_MARGIN_UNKNOWN = 'margin_unknown'
+REJECT_EXPOSURE = 'exposure'
+REJECT_BOT_EXPOSURE = 'bot_exposure'
+REJECT_ORDER_RATE = 'order_rate'
+
+
+class RiskLimits:
+    def __init__(self, config=None, worker=0, workers=1):
+        """
+        :param worker: ワーカー番号
+        :param workers: ワーカー数。アカウント全体の上限はこの数で分ける
+        """
+        config = config or {}
+        self.max_exposure_jpy = _share(config.get('max_exposure_jpy'), workers)
+        self.max_bot_exposure_jpy = config.get('max_bot_exposure_jpy')
+        self.max_orders_per_minute = _share_count(config.get('max_orders_per_minute'), worker, workers)
+        self.max_daily_loss_jpy = _share(config.get('max_daily_loss_jpy'), workers)
+        self.margin_buffer_rate = config.get('margin_buffer_rate', 0.0)
+
+
+def _share(limit, workers):
+    return None if limit is None else limit / workers
+
+
+def _share_count(limit, worker, workers):
+    # 余りは先頭のワーカーに1つずつ配る（合計が limit になる）
+    if limit is None:
+        return None
+    return limit // workers + (1 if worker < limit % workers else 0)
+
+
+class Ticket:
+    """
+    承認済みの発注。発注結果に応じて confirm か cancel する
+    """
+    __slots__ = ('bot', 'side', 'price', 'size', 'margin')
+
+    def __init__(self, bot, side, price, size, margin):
+        self.bot = bot
+        self.side = side
+        self.price = price
+        self.size = size
+        self.margin = margin
+
+
+class RiskEngine:
+    """
+    取引余力は「直近の account_margin の値 - 発注中の証拠金 - 以降に建てた建玉の証拠金 + 決済で戻った分」で見積もる。
+    建玉は符号付き数量と符号付き建値合計で持つので、含み損益は ticker 毎に O(1) で求まる。
+    同じイベントを複数のボットから受け取っても二重に数えないよう、約定IDと注文IDで判定する。
+    """
+
+    def __init__(self, config=None, leverage=LEVERAGE_RATE, clock=default_clock, worker=0, workers=1):
+        self._worker = worker
+        self._workers = workers
+        self.limits = RiskLimits(config, worker, workers)
+        self._leverage = leverage
+        self._clock = clock
+        self._lock = threading.Lock()
+
+        self.available = None
+        self.rejects = {}
+        self._orders = {}  # 注文ID -> [ボット名, 売買, 未約定の数量, 1単位あたりの証拠金]
+        self._positions = {}  # 建玉ID -> [ボット名, 符号付き数量, 建値]
+        self._seen_executions = set()
+        self._seen_order = deque()
+        # 発注 API の応答より先に届いた約定・取消 注文ID -> [約定数量, [建玉ID], 取消済みか]
+        self._early = {}
+        self._early_order = deque()
+
+        # 建玉（符号付き数量・符号付き建値合計・建値ベースの絶対値）
+        self._net_size = 0.0
+        self._net_cost = 0.0
+        self.exposure = 0.0
+        self.bot_exposure = {}
+        self.last_price = None
+
+        self._day = None
+        self._day_base = 0.0  # 日替わり時点の含み損益（前日までの分なので今日の損益に含めない）
+        self.realized = 0.0
+        self._order_times = deque()
+
+        self.kill_reason = None
+
+    @property
+    def unrealized(self):
+        if self.last_price is None:
+            return 0.0
+        return self.last_price * self._net_size - self._net_cost
+
+    @property
+    def daily_pnl(self):
+        # 持ち越した建玉を決済すると建値からの損益が realized に入るが、その分 unrealized が減るので _day_base はそのままでよい
+        return self.realized + self.unrealized - self._day_base
+
+    def set_limits(self, config):
+        self.limits = RiskLimits(config, self._worker, self._workers)
+
+    def is_killed(self):
+        return self.kill_reason is not None
+
+    def trip(self, reason):
+        if self.kill_reason is None:
+            self.kill_reason = reason
+            print("[{}] RISK KILL SWITCH: {}".format(datetime.now(), reason))
+
+    def reset(self):
+        self.kill_reason = None
+
+    # region pre-trade
+    def approve_entry(self, bot, side, price, size) -> (Ticket or None, str or None):
+        """
+        新規注文の可否を判定し、承認した場合は証拠金を確保する
+        :return: (Ticket, None) または (None, 拒否理由)
+        """
+        price = float(price)
+        size = float(size)
+        notional = price * size
+        margin = notional / self._leverage
+        limits = self.limits
+        now = time.monotonic()
+
+        with self._lock:
+            self._roll_day()
+            reason = None
+            if self.kill_reason is not None:
+                reason = REJECT_KILL_SWITCH
+            elif self.available is None:
+                reason = REJECT_MARGIN_UNKNOWN
+            elif self.available * (1 - limits.margin_buffer_rate) < margin:
+                reason = REJECT_MARGIN
+            elif limits.max_exposure_jpy is not None and self.exposure + notional > limits.max_exposure_jpy:
+                reason = REJECT_EXPOSURE
+            elif limits.max_bot_exposure_jpy is not None and \
+                    self.bot_exposure.get(bot, 0.0) + notional > limits.max_bot_exposure_jpy:
+                reason = REJECT_BOT_EXPOSURE
+            elif limits.max_orders_per_minute is not None:
+                while self._order_times and now - self._order_times[0] > 60:
+                    self._order_times.popleft()
+                if len(self._order_times) >= limits.max_orders_per_minute:
+                    reason = REJECT_ORDER_RATE
+                else:
+                    self._order_times.append(now)
+
+            if reason is not None:
+                self.rejects[reason] = self.rejects.get(reason, 0) + 1
+                return None, reason
+            self.available -= margin
+            return Ticket(bot, side, price, size, margin), None
+
+    def confirm(self, ticket: Ticket, order_id):
+        order_id = int(order_id)
+        unit_margin = ticket.margin / ticket.size
+        with self._lock:
+            remaining = ticket.size
+            early = self._early.pop(order_id, None)
+            if early is not None:
+                filled, position_ids, cancelled = early
+                remaining = 0 if cancelled else max(0.0, ticket.size - filled)
+                self.available += (ticket.size - remaining) * unit_margin
+                for position_id in position_ids:
+                    self._assign_position(position_id, ticket.bot)
+            if remaining > 1e-12:
+                self._orders[order_id] = [ticket.bot, ticket.side, remaining, unit_margin]
+
+    def cancel(self, ticket: Ticket):
+        """
+        発注に失敗した場合に確保した証拠金を戻す
+        """
+        with self._lock:
+            self.available += ticket.margin
+    # endregion pre-trade
+
+    # region events
+    def sync_margin(self, margin):
+        """
+        :param margin: account_margin() の結果
+        """
+        with self._lock:
+            # cluster では他のワーカーと分け合う
+            self.available = float(margin['availableAmount']) / self._workers
+
+    def sync_positions(self, positions):
+        """
+        REST で取得した建玉一覧で建玉を置き換える（イベントの取りこぼしや起動前からの建玉を反映する）
+        :param positions: get_positions() の list
+        """
+        with self._lock:
+            old = self._positions
+            self._positions = {}
+            self._net_size = self._net_cost = self.exposure = 0.0
+            self.bot_exposure = {}
+            for p in positions:
+                position_id = int(p['positionId'])
+                size = float(p['size'])
+                signed = size if p['side'] == 'BUY' else -size
+                bot = old[position_id][0] if position_id in old else None
+                self._positions[position_id] = [bot, signed, float(p['price'])]
+                self._add_exposure(bot, signed, float(p['price']))
+
+    def on_ticker(self, last_price):
+        with self._lock:
+            # 日替わり時点の含み損益は日替わり前の価格で測る
+            self._roll_day()
+            self.last_price = float(last_price)
+        limit = self.limits.max_daily_loss_jpy
+        if limit is not None and self.kill_reason is None:
+            if self.daily_pnl <= -limit:
+                self.trip("daily loss {:.0f} exceeds {}".format(self.daily_pnl, limit))
+
+    def release(self, order_id):
+        """
+        イベントを取りこぼして管理から外した注文の証拠金を戻す（約定していた分は次の sync_margin で補正される）
+        """
+        with self._lock:
+            order = self._orders.pop(int(order_id), None)
+            if order is not None:
+                self.available += order[2] * order[3]
+
+    def on_order_event(self, data):
+        """
+        取消・失効した注文の証拠金を戻す
+        """
+        if data.get('msgType') == 'NOR':
+            return
+        order_id = int(data['orderId'])
+        with self._lock:
+            order = self._orders.pop(order_id, None)
+            if order is not None:
+                self.available += order[2] * order[3]
+            else:
+                self._early_entry(order_id)[2] = True
+
+    def on_execution(self, data):
+        execution_id = data.get('executionId')
+        with self._lock:
+            if execution_id is not None:
+                if execution_id in self._seen_executions:
+                    return
+                self._remember_execution(execution_id)
+
+            size = float(data['executionSize'])
+            price = float(data['executionPrice'])
+            if data['settleType'] == 'OPEN':
+                self._on_open(data, price, size)
+            else:
+                self._on_close(data, price, size)
+
+    def _on_open(self, data, price, size):
+        order_id = int(data['orderId'])
+        order = self._orders.get(order_id)
+        bot = order[0] if order else None
+        position_id = int(data['positionId'])
+        if order:
+            # 確保していた証拠金を実際の約定価格の証拠金に置き換える
+            self.available += order[3] * size
+            order[2] -= size
+            if order[2] <= 1e-12:
+                self._orders.pop(order_id)
+        else:
+            # 確認前なら confirm で証拠金とボットを反映する
+            early = self._early_entry(order_id)
+            early[0] += size
+            early[1].append(position_id)
+        self._adjust_available(-price * size / self._leverage)
+
+        signed = size if data['side'] == 'BUY' else -size
+        self._positions[position_id] = [bot, signed, price]
+        self._add_exposure(bot, signed, price)
+
+    def _assign_position(self, position_id, bot):
+        position = self._positions.get(position_id)
+        if position is None or position[0] is not None:
+            return
+        position[0] = bot
+        self.bot_exposure[bot] = self.bot_exposure.get(bot, 0.0) + abs(position[1]) * position[2]
+
+    def _early_entry(self, order_id):
+        early = self._early.get(order_id)
+        if early is None:
+            early = self._early[order_id] = [0.0, [], False]
+            # 他のプロセスや手動の注文のイベントも来るので古いものから捨てる
+            self._early_order.append(order_id)
+            if len(self._early_order) > EARLY_ORDERS:
+                self._early.pop(self._early_order.popleft(), None)
+        return early
+
+    def _on_close(self, data, price, size):
+        self._roll_day()
+        loss_gain = float(data.get('lossGain', 0))
+        self.realized += loss_gain
+        position = self._positions.get(int(data['positionId']))
+        if position is None:
+            # 管理外の建玉（起動前から持っていたもの）は損益だけ反映する
+            self._adjust_available(loss_gain)
+            return
+
+        bot, signed, entry = position
+        closed = min(size, abs(signed))
+        closed_signed = closed if signed > 0 else -closed
+        self._add_exposure(bot, -closed_signed, entry, closing=True)
+        self._adjust_available(closed * entry / self._leverage + loss_gain)
+        position[1] = signed - closed_signed
+        if abs(position[1]) <= 1e-12:
+            self._positions.pop(int(data['positionId']))
+
+    def _adjust_available(self, delta):
+        # 最初の sync_margin より前のイベントは取引余力に反映しない（sync_margin の値に含まれる）
+        if self.available is not None:
+            self.available += delta
+
+    def _add_exposure(self, bot, signed, price, closing=False):
+        self._net_size += signed
+        self._net_cost += signed * price
+        delta = -abs(signed) * price if closing else abs(signed) * price
+        self.exposure += delta
+        if bot is not None:
+            self.bot_exposure[bot] = self.bot_exposure.get(bot, 0.0) + delta
+
+    def _remember_execution(self, execution_id):
+        self._seen_executions.add(execution_id)
+        self._seen_order.append(execution_id)
+        if len(self._seen_order) > SEEN_EXECUTIONS:
+            self._seen_executions.discard(self._seen_order.popleft())
+
+    def _roll_day(self):
+        day = (self._clock.exchange_now_ms() + JST_OFFSET_MS) // DAY_MS
+        if day != self._day:
+            if self._day is not None:
+                self.realized = 0.0
+                self._day_base = self.unrealized
+                if self.kill_reason and self.kill_reason.startswith('daily loss'):
+                    self.kill_reason = None
+            self._day = day
+    # endregion events
+
+    def to_dict(self):
+        return {
+            'available': self.available,
+            'exposure': self.exposure,
+            'bot_exposure': dict(self.bot_exposure),
+            'realized': self.realized,
+            'unrealized': self.unrealized,
+            'open_orders': len(self._orders),
+            'positions': len(self._positions),
+            'kill_reason': self.kill_reason,
+            'rejects': dict(self.rejects),
+        }
+
+
+def create_risk_engines(config, worker=0, workers=1) -> dict:
+    """
+    アカウント毎のリスクエンジン。アカウントの "risk" があればトップレベルの "risk" より優先する
+    :param worker: cluster のワーカー番号
+    :param workers: cluster のワーカー数。アカウント全体の上限をワーカー数で分ける
+    :return: {アカウント名: RiskEngine}
+    """
+    return {a['name']: RiskEngine(a.get('risk', config.get('risk')), worker=worker, workers=workers)
+            for a in account_configs(config)}
@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import math
+import random
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """
+    定期実行ジョブ
+
+    実行予定時刻は前回の予定時刻 + interval で決めるため、処理時間によってずれていかない。
+    前回の実行がまだ終わっていなければその回は実行せず skipped を数える。
+    """
+    __slots__ = ('name', 'func', 'interval', 'deadline', 'running', 'cancelled',
+                 'runs', 'skipped', 'last_lateness', 'max_lateness', 'total_lateness')
+
+    def __init__(self, name, func, interval, deadline):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.deadline = deadline
+        self.running = False
+        self.cancelled = False
+        self.runs = 0
+        self.skipped = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'interval': self.interval,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'last_lateness': self.last_lateness,
+            'max_lateness': self.max_lateness,
+            'average_lateness': self.total_lateness / self.runs if self.runs else 0.0,
+        }
+
+
+class Scheduler:
+    """
+    単調時計の期限をヒープで管理するスケジューラ
+
+    ジョブはワーカースレッドプールで実行するため、遅い REST 呼び出しが他のジョブを遅らせない。
+    初回実行に interval * jitter 以内のランダムな遅れを入れ、複数ボットの同じジョブが同時に走らないようにする。
+    遅延（予定時刻から実際にディスパッチされるまでの秒数）はジョブ毎に記録する。
+    """
+
+    def __init__(self, max_workers=8):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scheduler')
+        self._jobs = []
+        self._running = False
+
+    def every(self, interval, func, name=None, jitter=0.1, first_delay=None) -> Job:
+        """
+        :param interval: 実行間隔（秒）
+        :param jitter: 初回実行をずらす幅（interval に対する割合）
+        :param first_delay: 初回実行までの秒数。省略時は interval
+        """
+        delay = interval if first_delay is None else first_delay
+        deadline = time.monotonic() + delay + random.uniform(0, interval * jitter)
+        job = Job(name or getattr(func, '__qualname__', repr(func)), func, interval, deadline)
+        with self._cond:
+            self._jobs.append(job)
+            heapq.heappush(self._heap, (deadline, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def cancel(self, job: Job):
+        with self._cond:
+            job.cancelled = True
+            if job in self._jobs:
+                self._jobs.remove(job)
+
+    def jobs(self):
+        with self._cond:
+            return list(self._jobs)
+
+    def stats(self):
+        return [job.stats() for job in self.jobs()]
+
+    def start(self):
+        thread = threading.Thread(target=self.run_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def run_forever(self):
+        self._running = True
+        while True:
+            with self._cond:
+                while self._running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+                if job.cancelled:
+                    continue
+
+                now = time.monotonic()
+                self._dispatch(job, now)
+
+                # 前回の予定時刻から次回を決める。大きく遅れた場合は過ぎた回を飛ばす
+                job.deadline += job.interval
+                if job.deadline < now:
+                    job.deadline += math.ceil((now - job.deadline) / job.interval) * job.interval
+                heapq.heappush(self._heap, (job.deadline, next(self._seq), job))
+
+    def _dispatch(self, job: Job, now):
+        if job.running:
+            job.skipped += 1
+            return
+
+        lateness = now - job.deadline
+        job.last_lateness = lateness
+        job.max_lateness = max(job.max_lateness, lateness)
+        job.total_lateness += lateness
+        job.runs += 1
+        job.running = True
+        self._executor.submit(self._run, job)
+
+    @staticmethod
+    def _run(job: Job):
+        try:
+            job.func()
+        except Exception:
+            print("JOB [{}] FAILED".format(job.name), file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            job.running = False
+
+
+default_scheduler = Scheduler()
+
+
+def every(interval, func, name=None, jitter=0.1, first_delay=None) -> Job:
+    return default_scheduler.every(interval, func, name, jitter, first_delay)
@@ -1,52 +1,124 @@
-import random
-from gmocoin_bot.bot import *
+import itertools
+from gmocoin_bot.bot import GMOCoinBot, Position, LEVERAGE_RATE, POSITION_TYPE_BUY, POSITION_TYPE_SELL
+from gmocoin_bot.fill_model import SimOrder, create_fill_model
+
+# シミュレーションの建玉ID（全ボットで重複しない）
+_position_ids = itertools.count(1)
 
 class GMOCoinBotSimulator(GMOCoinBot):
     LEVERAGE_RATE = 4
     SAVE_PATH = 'simulator_save.json'
-    def __init__(self, config_path, api, chart):
-        super().__init__(config_path, api, chart)
+    def __init__(self, config_path, api, chart, order_book=None, risk=None):
+        # 証拠金は curr_jpy で管理するのでリスクエンジンはボット専用（risk は使わない）
+        super().__init__(config_path, api, chart, order_book)
         self.curr_jpy = self._analyzer.init_jpy
+        # 約定モデル（bot_config の fill_model、既定は約定履歴・板情報による判定）
+        self._fill_model = create_fill_model(config_path.get('fill_model'), order_book, self.params.order_limit_time)
+        self._closing = set()
+        self._settled = {}  # 一部決済中のポジションID -> [確定損益, 決済した数量, 決済代金]
 
     def _setup_timer(self):
-        pass
+        self._jobs = []
+
+    def _open_journal(self, bot_config):
+        return None
 
     def _init_position_list(self):
         pass
 
     def entry_position(self, side, price, size):
+        self._prev_entry_time = self._api.clock.exchange_now_ms()
+        if self.curr_jpy < float(size) * float(price) / LEVERAGE_RATE:
+            return
+
+        order = SimOrder(side, int(price), size)
+        self._fill_model.submit(order, self._api.clock.exchange_now_ms())
+        self._entry_order_list.append(order.id)
+
+    def close_position(self, position:Position):
+        if position.id in self._closing:
+            return
+
+        side = POSITION_TYPE_SELL if position.type == POSITION_TYPE_BUY else POSITION_TYPE_BUY
+        price = self.get_order_price(side, position.size, position.curr_price)
+        order = SimOrder(side, int(price), position.size, settle_type='CLOSE', time_in_force='FOK', position_id=position.id)
+        self._fill_model.submit(order, self._api.clock.exchange_now_ms())
+        self._closing.add(position.id)
+
+    def on_trade(self, trade):
+        for fill in self._fill_model.on_trade(trade):
+            if fill.order.settle_type == 'OPEN':
+                self.__open_position(fill)
+            else:
+                self.__settle_position(fill)
+
+        for order in self._fill_model.take_finished():
+            if order.settle_type == 'OPEN':
+                if order.id in self._entry_order_list:
+                    self._entry_order_list.remove(order.id)
+            else:
+                # FOK 不成立なら次のティックで再度決済を試みる
+                self._closing.discard(order.position_id)
+
+    def __open_position(self, fill):
         p = Position({
-            'positionId': random.randint(100000, 999999),
+            'positionId': next(_position_ids),
             'symbol': self._symbol,
-            'price': price,
-            'side': side,
-            'size': size,
+            'price': fill.price,
+            'side': fill.order.side,
+            'size': fill.size,
             'orderdSize': "0",
             "lossGain": "0",
             "leverage": LEVERAGE_RATE,
             "losscutPrice": "0",
-            'timestamp': datetime.now()
-        })
-
-        if self.curr_jpy < p.size * p.price / LEVERAGE_RATE:
-            return
+            'timestamp': fill.time
+        }, self._api.clock)
 
         self._position_list.append(p)
-        self.curr_jpy -= (p.price * p.size) / LEVERAGE_RATE
+        self.curr_jpy -= (p.price * p.size) / LEVERAGE_RATE + fill.fee
         p.entry_report()
-        self._prev_entry_time = datetime.now()
 
-    def close_position(self, position:Position):
+    def __settle_position(self, fill):
+        """
+        板の複数の価格で約定した決済は価格毎に Fill が来るので、約定数量ずつ決済し、全量決済したら集計する
+        """
+        position = next((p for p in self._position_list if p.id == fill.order.position_id), None)
+        if position is None:
+            return
+
+        size = min(fill.size, position.size)
+        if position.type == POSITION_TYPE_BUY:
+            loss_gain = (fill.price - position.price) * size - fill.fee
+        else:
+            loss_gain = (position.price - fill.price) * size - fill.fee
+        self.curr_jpy += loss_gain + (position.price * size) / position.leverage
+        position.size -= size
+
+        # [確定損益, 決済した数量, 決済代金]
+        settled = self._settled.setdefault(position.id, [0.0, 0.0, 0.0])
+        settled[0] += loss_gain
+        settled[1] += size
+        settled[2] += fill.price * size
+        if position.size > 1e-12:
+            return
+
+        del self._settled[position.id]
+        position.size = settled[1]
+        position.lossGain = settled[0]
+        position.curr_price = settled[2] / settled[1]
         self._analyzer.update(position)
         self.report(position)
-        self.curr_jpy += position.lossGain + (position.price * position.size) / position.leverage
         self._position_list.remove(position)
+        self._closing.discard(position.id)
         self._prev_entry_time = None
 
     def close_positions(self, p_type):
         for p in [p for p in self._position_list if p.type == p_type]:
             self.close_position(p)
 
+    def get_cached_balance(self):
+        return self.get_balance()
+
     def get_balance(self):
         position_sum = 0
         for p in self._position_list:
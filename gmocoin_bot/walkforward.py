@@ -0,0 +1,297 @@
+"""
+ウォークフォワード検証
+
+記録した約定履歴（1行1件の JSON: price, size, side, timestamp。mock_server --replay と同じ形式）を
+ローソク足にまとめ、学習期間でパラメータを探索して最良のものを直後の検証期間で評価する、を期間をずらしながら繰り返す。
+検証期間の成績（アウトオブサンプル）を Analyzer に集計して表示する。
+
+ローソク足・平均足・トレンド判定は最初に1回だけ計算して History に持ち、全ての期間・候補パラメータで共有する。
+ワーカープロセスにも起動時に1回だけ渡すので、探索中はボットの判定処理だけを実行する。
+
+    {
+        "trades": "trades.jsonl",
+        "candle_period": "T",
+        "train": 1440,              # 学習期間（足の本数）
+        "test": 360,                # 検証期間（足の本数）
+        "step": 360,                # 期間をずらす本数（省略時は test）
+        "init_jpy": 100000,
+        "fee_rate": 0.0,
+        "objective": "loss_gain",   # 最良を選ぶ指標（Analyzer.to_dict のキー）
+        "workers": null,            # 省略時は CPU 数
+        "base": {...},              # bot_configs の1件（探索しない値）
+        "grid": {"profit_rate": [0.001, 0.002],
+                 "trend_checker": [{"type": "Simple1"}, {"type": "RSI", "params": [14, 40, 60]}]}
+    }
+
+python -m gmocoin_bot.walkforward <config_path>
+
+判定は足単位で、足の確定時の終値でボットと同じ決済・エントリー判定を行い、その価格で約定したものとする。
+約定モデルを使うシミュレータより粗いので、パラメータ同士の比較に使うこと。
+"""
+import argparse
+import itertools
+import json
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from chart import ETrendType
+from chart.chart import TechnicalChart, heikin_ashi, parse_period, round_time
+from chart.trend import RuleTrendChecker, create_trend_checker
+from gmo.gmo import to_epoch_ms
+from gmocoin_bot.analyzer import Analyzer
+from gmocoin_bot.bot import BotParams, LEVERAGE_RATE, POSITION_TYPE_BUY, POSITION_TYPE_SELL
+
+TREND_UP = ETrendType.UP.value
+TREND_DOWN = ETrendType.DOWN.value
+
+# ワーカープロセスの History（_init_worker で設定）
+_history = None
+
+
+def load_trades(path) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def trend_key(trend_checker_config) -> str:
+    return json.dumps(trend_checker_config, sort_keys=True)
+
+
+class History:
+    """
+    約定履歴から計算した足毎の値
+
+    :ivar times: 足の時刻（エポックミリ秒）
+    :ivar closes: 足の終値
+    :ivar avg_dirs: 平均足の向き（1: 陽線 / -1: 陰線 / 0）
+    :ivar columns: 平均足の (open, high, low, close, rsi)。rsi は各足の確定時の値
+    :ivar raw: 普通のローソク足の (open, high, low, close)
+    :ivar trends: trend_key -> 各足の確定時のトレンド（ETrendType.value）
+    """
+
+    def __init__(self, trades, candle_period='T', trend_checkers=()):
+        self.period_ms = parse_period(candle_period)
+        self.times = array('q')
+        self.raw = (array('d'), array('d'), array('d'), array('d'))
+        self.rsi = array('d')
+        self.trends = {}
+
+        # ルールは配列全体に対して判定できるので、それ以外の判定器だけ足の確定毎に判定する
+        checkers = {trend_key(c): create_trend_checker(c) for c in trend_checkers}
+        replayed = {k: c for k, c in checkers.items() if not isinstance(c, RuleTrendChecker)}
+        for key in replayed:
+            self.trends[key] = array('b')
+
+        chart = TechnicalChart(candle_period)
+        current = None
+        for trade in trades:
+            t = round_time(to_epoch_ms(trade['timestamp']), self.period_ms)
+            if current is not None and t != current:
+                self._close_candle(chart, current, replayed)
+            current = t
+            chart.update(trade)
+        if current is not None:
+            self._close_candle(chart, current, replayed)
+
+        # 平均足は四本値から一括で計算する（チャートの平均足と同じ値）
+        self.closes = self.raw[3]
+        self.columns = tuple(array('d', c) for c in heikin_ashi(*self.raw)) + (self.rsi,)
+        self.avg_dirs = array('b', [1 if c > o else -1 if c < o else 0
+                                    for o, c in zip(self.columns[0], self.columns[3])])
+        for key, checker in checkers.items():
+            if key not in replayed:
+                self.trends[key] = array('b', [t.value for t in checker.evaluate_history(self.columns)])
+
+    def __len__(self):
+        return len(self.times)
+
+    def _close_candle(self, chart, t, checkers):
+        candle = chart.basic_candles[t]
+        self.times.append(t)
+        for column, value in zip(self.raw, (candle.open, candle.high, candle.low, candle.close)):
+            column.append(value)
+        self.rsi.append(chart.rsi.value)
+        for key, checker in checkers.items():
+            self.trends[key].append(checker._check_trend(chart).value)
+
+
+def simulate(history: History, bot_config, start, end, fee_rate=0.0, init_jpy=0) -> list:
+    """
+    [start, end) の足でボットの売買を再現する。期間の終わりに残ったポジションは最後の終値で決済する
+
+    :return: 決済の [(決済時刻(エポックミリ秒), 売買, 損益, 保有時間(ミリ秒))]
+    """
+    params = BotParams(bot_config)
+    trends = history.trends[trend_key(bot_config['trend_checker'])]
+    times, closes, avg_dirs = history.times, history.closes, history.avg_dirs
+    period_ms = history.period_ms
+    size = float(params.position_unit)
+    max_keep_ms = params.max_keep_time * 1000
+    cool_ms = params.entry_cool_time * 1000
+
+    positions = []  # [売買, 価格, 数量, 建玉時刻]
+    results = []
+    jpy = init_jpy
+    prev_entry = None
+
+    def settle(p, price, now):
+        nonlocal jpy, prev_entry
+        gain = (price - p[1]) * p[2] if p[0] == POSITION_TYPE_BUY else (p[1] - price) * p[2]
+        gain -= (p[1] + price) * p[2] * fee_rate
+        jpy += gain
+        results.append((now, p[0], gain, now - p[3]))
+        prev_entry = None
+
+    for i in range(start, min(end, len(times))):
+        price = closes[i]
+        now = times[i] + period_ms
+
+        remaining = []
+        for p in positions:
+            profit_rate = (price - p[1]) / p[1] if p[0] == POSITION_TYPE_BUY else (p[1] - price) / p[1]
+            if profit_rate > params.profit_rate or profit_rate < -params.loss_cut_rate:
+                settle(p, price, now)
+            elif (p[0] == POSITION_TYPE_BUY and avg_dirs[i] < 0) or (p[0] == POSITION_TYPE_SELL and avg_dirs[i] > 0):
+                if profit_rate > params.second_profit_rate:
+                    settle(p, price, now)
+                else:
+                    remaining.append(p)
+            elif now - p[3] > max_keep_ms:
+                settle(p, price, now)
+            else:
+                remaining.append(p)
+        positions = remaining
+
+        trend = trends[i]
+        if trend != TREND_UP and trend != TREND_DOWN:
+            continue
+        side, opposite = (POSITION_TYPE_BUY, POSITION_TYPE_SELL) if trend == TREND_UP else \
+            (POSITION_TYPE_SELL, POSITION_TYPE_BUY)
+        if (prev_entry is None or now - prev_entry >= cool_ms) and len(positions) < params.max_positions:
+            prev_entry = now
+            if init_jpy <= 0 or jpy >= size * price / LEVERAGE_RATE:
+                positions.append([side, price, size, now])
+        for p in [p for p in positions if p[0] == opposite]:
+            positions.remove(p)
+            settle(p, price, now)
+
+    if positions:
+        last = min(end, len(times)) - 1
+        for p in positions:
+            settle(p, closes[last], times[last] + period_ms)
+    return results
+
+
+def analyze(results, init_jpy, analyzer: Analyzer = None) -> Analyzer:
+    analyzer = analyzer or Analyzer(init_jpy)
+    for close_time, side, gain, hold_ms in results:
+        analyzer.record(gain, side=side, hold_ms=hold_ms, close_time_ms=close_time)
+    return analyzer
+
+
+def _init_worker(history):
+    global _history
+    _history = history
+
+
+def _score(task):
+    """
+    ワーカーで候補1件を学習期間で評価する
+    """
+    bot_config, start, end, fee_rate, init_jpy, objective = task
+    results = simulate(_history, bot_config, start, end, fee_rate, init_jpy)
+    return analyze(results, init_jpy).to_dict()[objective]
+
+
+def windows(length, train, test, step=None) -> list:
+    """
+    :return: [(学習開始, 検証開始, 検証終了)]（足のインデックス）。検証期間が test 本に満たない末尾は使わない
+    """
+    step = step or test
+    if step < test:
+        raise ValueError("step must not be shorter than test (test windows would overlap)")
+    return [(s, s + train, s + train + test) for s in range(0, length - train - test + 1, step)]
+
+
+def candidates(base, grid) -> list:
+    keys = sorted(grid)
+    return [dict(base, **dict(zip(keys, values))) for values in itertools.product(*[grid[k] for k in keys])]
+
+
+class WalkForward:
+    def __init__(self, config):
+        self.config = config
+        self.candidates = candidates(config['base'], config.get('grid', {}))
+        self.init_jpy = config.get('init_jpy', 100000)
+        self.fee_rate = config.get('fee_rate', 0.0)
+        self.objective = config.get('objective', 'loss_gain')
+        self.workers = config.get('workers') or os.cpu_count() or 1
+        self.history = None
+
+    def load(self, trades=None):
+        trades = trades if trades is not None else load_trades(self.config['trades'])
+        checkers = {trend_key(c['trend_checker']): c['trend_checker'] for c in self.candidates}
+        self.history = History(trades, self.config.get('candle_period', 'T'), checkers.values())
+        print("[{}] HISTORY LOADED: {} trades -> {} candles, {} trend checkers".format(
+            datetime.now(), len(trades), len(self.history), len(checkers)))
+
+    def run(self) -> dict:
+        if self.history is None:
+            self.load()
+        spans = windows(len(self.history), self.config['train'], self.config['test'], self.config.get('step'))
+        if not spans:
+            raise ValueError("history ({} candles) is shorter than train + test".format(len(self.history)))
+
+        tasks = [(c, s, t, self.fee_rate, self.init_jpy, self.objective) for s, t, _ in spans for c in self.candidates]
+        if self.workers > 1:
+            with ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.history,)) as executor:
+                scores = list(executor.map(_score, tasks, chunksize=max(1, len(tasks) // (self.workers * 4))))
+        else:
+            _init_worker(self.history)
+            scores = [_score(task) for task in tasks]
+
+        oos = Analyzer(self.init_jpy)
+        reports = []
+        n = len(self.candidates)
+        for w, (train_start, test_start, test_end) in enumerate(spans):
+            window_scores = scores[w * n:(w + 1) * n]
+            best = max(range(n), key=window_scores.__getitem__)
+            bot_config = self.candidates[best]
+            results = simulate(self.history, bot_config, test_start, test_end, self.fee_rate, self.init_jpy)
+            test = analyze(results, self.init_jpy)
+            analyze(results, self.init_jpy, oos)
+
+            params = {k: bot_config[k] for k in self.config.get('grid', {})}
+            reports.append({
+                'train_from': self._time(train_start), 'test_from': self._time(test_start),
+                'test_to': self._time(test_end - 1), 'params': params,
+                'train_score': window_scores[best], 'test': test.to_dict(),
+            })
+            print("[{}] WINDOW {} test[{} - {}] train_{}[{:.4g}] {} {}".format(
+                datetime.now(), w, reports[-1]['test_from'], reports[-1]['test_to'], self.objective,
+                window_scores[best], test.report_str(), json.dumps(params)))
+
+        print("OUT OF SAMPLE:", oos.report_str())
+        return {'windows': reports, 'out_of_sample': oos.to_dict()}
+
+    def _time(self, index):
+        return datetime.fromtimestamp(self.history.times[index] / 1000).isoformat()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='walk-forward validation of bot parameters')
+    parser.add_argument('config_path')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    args = parser.parse_args()
+
+    config = json.load(open(args.config_path))
+    if args.workers:
+        config['workers'] = args.workers
+    result = WalkForward(config).run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    print(json.dumps(result['out_of_sample'], indent=2))
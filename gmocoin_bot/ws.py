@@ -1,46 +1,117 @@
 import json
+import queue
+import random
+import threading
+import time
+from collections import Counter
 from datetime import datetime
 from time import sleep
 
-import schedule as schedule
-import websocket
-
-from gmo.gmo import GMO
+from chart.orderbook import OrderBook
+from gmo.gmo import GMO, to_epoch_ms
+from gmocoin_bot import metrics, scheduler
+from gmocoin_bot.accounts import DEFAULT_ACCOUNT
 from gmocoin_bot.bot import GMOCoinBot, EBotState
 
 WEBSOCKET_CALL_WAIT_TIME = 3
+SUBSCRIBE_INTERVAL = 1.0  # 一秒間1回しか購読できないため
+RECONNECT_BACKOFF_BASE = 1.0
+RECONNECT_BACKOFF_MAX = 60.0
+TOKEN_REFRESH_RETRY = 3  # プライベートチャンネルがこの回数失敗したらトークンを再取得
+HEALTH_CHECK_INTERVAL = 5
+BACKFILL_MAX_PAGES = 10
 CHANNEL_NAME_TICKER = 'ticker'
 CHANNEL_NAME_TRADES = 'trades'
 CHANNEL_NAME_EXECUTION = 'executionEvents'
 CHANNEL_NAME_ORDER = 'orderEvents'
 CHANNEL_NAME_POSITION = 'positionEvents'
+CHANNEL_NAME_ORDERBOOKS = 'orderbooks'
+PUBLIC_CHANNELS = [CHANNEL_NAME_TICKER, CHANNEL_NAME_TRADES, CHANNEL_NAME_ORDERBOOKS]
+PRIVATE_CHANNELS = [CHANNEL_NAME_EXECUTION, CHANNEL_NAME_ORDER, CHANNEL_NAME_POSITION]
+
+WS_MESSAGES = metrics.counter('gmocoin_ws_messages_total', 'Websocket messages received.', ('channel', 'account'))
+WS_HANDLER_SECONDS = metrics.histogram('gmocoin_ws_handler_seconds', 'Time spent handling a websocket message.',
+                                       ('channel',))
+WS_LAG_SECONDS = metrics.histogram('gmocoin_ws_lag_seconds', 'Delay from the exchange timestamp to dispatch.',
+                                   ('channel',))
+WS_RECONNECTS = metrics.counter('gmocoin_ws_reconnects_total', 'Websocket reconnections.', ('channel', 'account'))
 
 class GMOWebsocketManager:
-    _ws_list: dict[str, websocket.WebSocketApp or None]
+    """
+    Webソケットの購読と再接続を管理する
+
+    切断はコールバックで即座に検知し、監視スレッドがジッター付きバックオフで再購読する。
+    trades チャンネル再接続後は最初の約定が届くまでバッファし、その約定の時刻までに取りこぼした約定を REST で取得して
+    チャートに反映してからバッファを流す（REST の取得と購読開始の間の約定も欠けない）。
+
+    パブリックチャンネルは全アカウントで1本を共有し、プライベートチャンネルはアカウント毎にトークンを取って購読する。
+    購読は (チャンネル名, アカウント名) で管理する（パブリックのアカウント名は None）。
+    """
+    # websocket-client は購読時に GMO が読み込む（起動時の import を軽くする）
+    _ws_list: 'dict[tuple, websocket.WebSocketApp or None]'
     _bots: list[GMOCoinBot]
 
-    def __init__(self, bots, chart, api: GMO, sim_flg=True, symbol='BTC_JPY'):
+    def __init__(self, bots, chart, api: GMO, sim_flg=True, symbol='BTC_JPY', order_book: OrderBook = None,
+                 accounts: dict = None):
+        """
+        :param api: パブリックチャンネル・約定の補完に使うクライアント
+        :param accounts: {アカウント名: GMO}。省略時は api だけのアカウント
+        """
         self._bots = bots
         self._chart = chart
+        self._order_book = order_book
         self._api = api
+        self._accounts = accounts or {DEFAULT_ACCOUNT: api}
         self._sim_flg = sim_flg
         self._symbol = symbol
-        self.__token = api.get_ws_access_token()
-        self._ws_list = {
-            CHANNEL_NAME_TICKER: None,
-            CHANNEL_NAME_TRADES: None,
-            CHANNEL_NAME_EXECUTION: None,
-            CHANNEL_NAME_ORDER: None,
-            CHANNEL_NAME_POSITION: None,
+        self.__tokens = {name: None for name in self._accounts}
+        public_channels = [CHANNEL_NAME_TICKER, CHANNEL_NAME_TRADES]
+        if order_book is not None:
+            public_channels.append(CHANNEL_NAME_ORDERBOOKS)
+        self._ws_list = {(channel, None): None for channel in public_channels}
+        for name in self._accounts:
+            self._ws_list.update({(channel, name): None for channel in PRIVATE_CHANNELS})
+        self._handlers = {
+            CHANNEL_NAME_TICKER: self.__on_ticker,
+            CHANNEL_NAME_TRADES: self.__update_trades,
+            CHANNEL_NAME_EXECUTION: self.__on_execution_events,
+            CHANNEL_NAME_ORDER: self.__on_order_events,
+            CHANNEL_NAME_POSITION: self.__on_position_events,
+            CHANNEL_NAME_ORDERBOOKS: self.__on_orderbooks,
         }
 
-        self._connect()
+        # 再接続管理
+        self._running = True
+        self._reconnect_queue = queue.Queue()
+        self._pending = set()
+        self._pending_lock = threading.Lock()  # Timer・on_close・監視スレッドから触る
+        self._retry_count = {key: 0 for key in self._ws_list}
+        self._last_subscribe_time = 0.0
+        self._disconnected_at = None
+        self._resuming = False  # 全チャンネルの再購読後、最初のメッセージを待っている
+        self.last_reconnect_time = None  # 切断検知から再接続後の最初のメッセージまでの秒数
+
+        self._ticker_lag = WS_LAG_SECONDS.labels(CHANNEL_NAME_TICKER)
+        self._trades_lag = WS_LAG_SECONDS.labels(CHANNEL_NAME_TRADES)
+
+        # 約定の補完用
+        self._trade_lock = threading.Lock()
+        self._trade_buffer = None
+        self._trade_generation = 0  # trades の再購読毎に増やす（古い補完の結果を捨てる）
+        self._last_trade_time = None
+        self._boundary_trades = Counter()  # _last_trade_time と同じミリ秒に反映した約定
+
+        for key in self._active_channels():
+            self._request_reconnect(key, 0)
+
+        threading.Thread(target=self._supervise, daemon=True).start()
         self.__setup_timer()
 
     def __del__(self):
-        for channel, ws in self._ws_list.items():
+        self._running = False
+        for (channel, _), ws in self._ws_list.items():
             if ws and ws.keep_running:
-                if channel in [CHANNEL_NAME_TICKER, CHANNEL_NAME_TRADES]:
+                if channel in PUBLIC_CHANNELS:
                     ws.send(json.dumps({"command": "unsubscribe", "channel": channel, "symbol": self._symbol}))
                 else:
                     ws.send(json.dumps({"command": "unsubscribe", "channel": channel}))
@@ -48,68 +119,310 @@ class GMOWebsocketManager:
                 sleep(WEBSOCKET_CALL_WAIT_TIME)
 
     def __setup_timer(self):
-        # 5秒ごとにwebソケットの状態を確認
-        schedule.every(5).seconds.do(self._connect)
         # 50分ごとにトークンの延長
-        schedule.every(50).minutes.do(self._extend_token)
+        scheduler.every(50 * 60, self._extend_token, name='extend_ws_token', jitter=0)
 
     def _extend_token(self):
-        if self._api.status() != 'OPEN' or not self.__token:
+        if self._api.status()['status'] != 'OPEN':
             return
 
-        self._api.extend_ws_access_token(self.__token)
-        print("[{}] TOKEN EXTENDED".format(datetime.now()))
+        for name, api in self._accounts.items():
+            token = self.__tokens[name]
+            if not token:
+                continue
+            try:
+                api.extend_ws_access_token(token)
+                print("[{}] TOKEN EXTENDED [{}]".format(datetime.now(), name))
+            except Exception as e:
+                print("[{}] TOKEN EXTEND FAILED [{}]: {}".format(datetime.now(), name, e))
+
+    def add_bot(self, bot: GMOCoinBot):
+        """
+        実行中にボットを追加する。購読済みであればすぐに動かす
+        """
+        # 配信中のループがリストを走査しているので、差し替えで更新する
+        self._bots = self._bots + [bot]
+        if not self._has_pending() and bot.get_state() != EBotState.Running:
+            bot.run()
+
+    def remove_bot(self, bot: GMOCoinBot):
+        self._bots = [b for b in self._bots if b is not bot]
+
+    def _active_channels(self):
+        if self._sim_flg:
+            return [key for key in self._ws_list if key[1] is None]
+        return list(self._ws_list)
+
+    # region reconnect supervisor
+    def _on_disconnected(self, key, ws):
+        if not self._running or self._ws_list[key] is not ws:
+            return
 
-    def _connect(self):
-        for channel, ws in self._ws_list.items():
-            if channel in [CHANNEL_NAME_EXECUTION, CHANNEL_NAME_ORDER, CHANNEL_NAME_POSITION] and self._sim_flg:
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+        self._resuming = False
+        print("[{}] Disconnected [{}]".format(datetime.now(), _key_str(key)))
+        WS_RECONNECTS.labels(key[0], key[1] or '').inc()
+        self._request_reconnect(key, self._backoff(key))
+
+    def _backoff(self, key):
+        retry = self._retry_count[key]
+        self._retry_count[key] = retry + 1
+        return min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_BASE * 2 ** retry) * random.uniform(0.5, 1.0)
+
+    def _has_pending(self):
+        with self._pending_lock:
+            return bool(self._pending)
+
+    def _request_reconnect(self, key, delay):
+        with self._pending_lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+
+        if delay > 0:
+            timer = threading.Timer(delay, self._reconnect_queue.put, (key,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._reconnect_queue.put(key)
+
+    def _supervise(self):
+        while self._running:
+            try:
+                key = self._reconnect_queue.get(timeout=HEALTH_CHECK_INTERVAL)
+            except queue.Empty:
+                self._health_check()
                 continue
 
-            if not ws or not ws.keep_running:
-                try:
-                    self._ws_list[channel] = self.__ws_subscribe(channel)
-                except TimeoutError or ConnectionError:
-                    if self._ws_list[channel] and not self._ws_list[channel].sock.closed():
-                        self._ws_list[channel].close()
+            self._reconnect(key)
+            if not self._has_pending():
+                self._on_all_connected()
+
+    def _health_check(self):
+        # コールバックが呼ばれずに落ちた場合の保険
+        for key in self._active_channels():
+            ws = self._ws_list[key]
+            with self._pending_lock:
+                pending = key in self._pending
+            if not pending and (not ws or not ws.keep_running):
+                if self._disconnected_at is None:
+                    self._disconnected_at = time.monotonic()
+                self._resuming = False
+                self._request_reconnect(key, self._backoff(key))
+
+    def _reconnect(self, key):
+        wait = self._last_subscribe_time + SUBSCRIBE_INTERVAL - time.monotonic()
+        if wait > 0:
+            sleep(wait)
+        self._last_subscribe_time = time.monotonic()
+
+        channel, account = key
+        old_ws = self._ws_list[key]
+        self._ws_list[key] = None
+        if old_ws and old_ws.keep_running:
+            old_ws.close()
+
+        if account is not None and (not self.__tokens[account] or self._retry_count[key] >= TOKEN_REFRESH_RETRY):
+            try:
+                self.__tokens[account] = self._accounts[account].get_ws_access_token()
+            except Exception as e:
+                print("[{}] TOKEN REFRESH FAILED [{}]: {}".format(datetime.now(), account, e))
+
+        if channel == CHANNEL_NAME_TRADES:
+            # 最初の約定が届いたら _backfill_trades でバッファを流す
+            with self._trade_lock:
+                self._trade_buffer = []
+                self._trade_generation += 1
+
+        try:
+            self._ws_list[key] = self.__ws_subscribe(key)
+        except (TimeoutError, ConnectionError) as e:
+            print("[{}] Subscribe [{}] failed: {}".format(datetime.now(), _key_str(key), e))
+            with self._pending_lock:
+                self._pending.discard(key)
+            self._request_reconnect(key, self._backoff(key))
+            return
 
-                    self._ws_list[channel] = None
+        with self._pending_lock:
+            self._pending.discard(key)
 
+    def _on_all_connected(self):
         for b in [b for b in self._bots if b.get_state() != EBotState.Running]:
             b.run()
 
-    def __ws_subscribe(self, channel) -> websocket.WebSocketApp or None:
-        if channel == CHANNEL_NAME_TICKER:
-            ws = self._api.subscribe_public_ws(CHANNEL_NAME_TICKER, self._symbol, lambda _, message: self.__on_ticker(json.loads(message)))
-        elif channel == CHANNEL_NAME_TRADES:
-            ws = self._api.subscribe_public_ws(CHANNEL_NAME_TRADES, self._symbol, lambda _, message: self.__update_trades(json.loads(message)))
-        elif channel == CHANNEL_NAME_EXECUTION:
-            ws = self._api.subscribe_private_ws(self.__token, CHANNEL_NAME_EXECUTION, lambda _, message: self.__on_execution_events(json.loads(message)))
-        elif channel == CHANNEL_NAME_ORDER:
-            ws = self._api.subscribe_private_ws(self.__token, CHANNEL_NAME_ORDER, lambda _, message: self.__on_order_events(json.loads(message)))
-        elif channel == CHANNEL_NAME_POSITION:
-            ws = self._api.subscribe_private_ws(self.__token, CHANNEL_NAME_POSITION, lambda _, message: self.__on_position_events(json.loads(message)))
-        else:
+        if self._disconnected_at is not None:
+            # 所要時間は再接続後の最初のメッセージで記録する（_on_message_after_reconnect）
+            self._resuming = True
+
+    def _on_message_after_reconnect(self):
+        with self._pending_lock:
+            if not self._resuming or self._disconnected_at is None:
+                return
+            self.last_reconnect_time = time.monotonic() - self._disconnected_at
+            self._disconnected_at = None
+            self._resuming = False
+        print("[{}] Reconnected, first message in {:.3f}s".format(datetime.now(), self.last_reconnect_time))
+    # endregion reconnect supervisor
+
+    def _backfill_trades(self, generation, until_ms):
+        """
+        切断中に取りこぼした until_ms（再接続後の最初の約定の時刻）までの約定を REST で取得し、
+        再接続後にバッファした約定と合わせて時系列順にチャートへ反映する
+        """
+        missed = []
+        last = self._last_trade_time
+        if last is not None:
+            try:
+                for page in range(1, BACKFILL_MAX_PAGES + 1):
+                    trades = self._api.trades(self._symbol, page=page)['list']
+                    if not trades:
+                        break
+                    # 最後に反映した約定と同じミリ秒の約定も取得し、_filter_new で重複を除く
+                    missed.extend(t for t in trades if last <= to_epoch_ms(t['timestamp']) <= until_ms)
+                    if to_epoch_ms(trades[-1]['timestamp']) < last:
+                        break
+            except Exception as e:
+                print("[{}] Backfill failed: {}".format(datetime.now(), e))
+
+        with self._trade_lock:
+            if generation != self._trade_generation:
+                # 補完中に再購読した。次の補完で取り直す
+                return
+            # until_ms と同じミリ秒の約定は REST とバッファの両方にあり得るので、_filter_new で重複を除く
+            missed = self._filter_new(list(reversed(missed)))
+            for t in missed:
+                self._apply_trade(t)
+
+            for t in self._filter_new(self._trade_buffer):
+                self._apply_trade(t)
+            self._trade_buffer = None
+
+        if missed:
+            print("[{}] Backfilled {} trades".format(datetime.now(), len(missed)))
+
+    def _filter_new(self, trades) -> list:
+        """
+        時系列順の trades から反映済みの約定を除く
+        最後に反映した約定と同じミリ秒の約定は (時刻, 価格, 数量, 売買) が同じものを反映済みの件数分だけ除く
+        """
+        last = self._last_trade_time
+        if last is None:
+            return list(trades)
+
+        seen = Counter(self._boundary_trades)
+        new = []
+        for t in trades:
+            timestamp = to_epoch_ms(t['timestamp'])
+            if timestamp < last:
+                continue
+            if timestamp == last:
+                key = _trade_key(t)
+                if seen[key] > 0:
+                    seen[key] -= 1
+                    continue
+            new.append(t)
+        return new
+
+    def _apply_trade(self, trade):
+        self._chart.update(trade)
+        for b in self._bots:
+            b.on_trade(trade)
+        timestamp = to_epoch_ms(trade['timestamp'])
+        if timestamp != self._last_trade_time:
+            self._boundary_trades = Counter()
+        self._boundary_trades[_trade_key(trade)] += 1
+        self._last_trade_time = timestamp
+        if self._trade_buffer is None:
+            self._api.clock.observe_message(self._last_trade_time)
+            self._trades_lag.observe(max(0, self._api.clock.exchange_now_ms() - self._last_trade_time) / 1000)
+
+    def __ws_subscribe(self, key) -> 'websocket.WebSocketApp or None':
+        channel, account = key
+        handler = self._handlers.get(channel)
+        if not handler:
             return None
 
-        print("[{}] Subscribe [{}]".format(datetime.now(), channel))
-        sleep(WEBSOCKET_CALL_WAIT_TIME)  # 一秒間1回しか購読できないため
+        messages = WS_MESSAGES.labels(channel, account or '')
+        handling = WS_HANDLER_SECONDS.labels(channel)
+        if account is None:
+            def on_message(_, message):
+                started = time.perf_counter()
+                messages.inc()
+                self._retry_count[key] = 0
+                if self._resuming:
+                    self._on_message_after_reconnect()
+                handler(json.loads(message))
+                handling.observe(time.perf_counter() - started)
+        else:
+            def on_message(_, message):
+                started = time.perf_counter()
+                messages.inc()
+                self._retry_count[key] = 0
+                if self._resuming:
+                    self._on_message_after_reconnect()
+                handler(account, json.loads(message))
+                handling.observe(time.perf_counter() - started)
+
+        def on_close(ws):
+            self._on_disconnected(key, ws)
+
+        if account is None:
+            ws = self._api.subscribe_public_ws(channel, self._symbol, on_message, on_close)
+        else:
+            ws = self._accounts[account].subscribe_private_ws(self.__tokens[account], channel, on_message, on_close)
+
+        print("[{}] Subscribe [{}]".format(datetime.now(), _key_str(key)))
         return ws
 
+    def _account_bots(self, account):
+        """
+        account のプライベートイベントを受け取るボット。account が None のボットは全アカウント分を受け取る
+        """
+        return [b for b in self._bots if b.account is None or b.account == account]
+
     def __update_trades(self, trade):
-        self._chart.update(trade)
+        with self._trade_lock:
+            if self._trade_buffer is None:
+                self._apply_trade(trade)
+                return
+            self._trade_buffer.append(trade)
+            if len(self._trade_buffer) > 1:
+                return
+            generation = self._trade_generation
+        # 再購読後の最初の約定。REST の呼び出しで受信を止めないよう別スレッドで補完する
+        threading.Thread(target=self._backfill_trades, args=(generation, to_epoch_ms(trade['timestamp'])),
+                         daemon=True).start()
 
-    def __on_execution_events(self, data):
+    def __on_orderbooks(self, data):
+        self._order_book.apply_snapshot(data)
         for b in self._bots:
+            b.on_orderbooks(data)
+
+    def __on_execution_events(self, account, data):
+        for b in self._account_bots(account):
             b.on_execution_events(data)
 
-    def __on_order_events(self, data):
-        for b in self._bots:
+    def __on_order_events(self, account, data):
+        for b in self._account_bots(account):
             b.on_order_events(data)
 
-    def __on_position_events(self, data):
-        for b in self._bots:
+    def __on_position_events(self, account, data):
+        for b in self._account_bots(account):
             b.on_position_events(data)
 
     def __on_ticker(self, data):
+        timestamp = to_epoch_ms(data['timestamp'])
+        self._api.clock.observe_message(timestamp)
+        self._ticker_lag.observe(max(0, self._api.clock.exchange_now_ms() - timestamp) / 1000)
         for b in self._bots:
             b.update_ticker(data)
+
+
+def _trade_key(trade):
+    return to_epoch_ms(trade['timestamp']), str(trade['price']), str(trade['size']), trade['side']
+
+
+def _key_str(key):
+    channel, account = key
+    return channel if account is None else "{}@{}".format(channel, account)
@@ -1,31 +1,76 @@
 import json
 import os
 import sys
-from datetime import timedelta
-from time import sleep
-
-import schedule
-from  timeloop import Timeloop
 
 from chart import TechnicalChart
-from gmo.gmo import GMO
+from chart.orderbook import OrderBook
+from gmocoin_bot import metrics, profiler, scheduler
+from gmocoin_bot.accounts import account_configs, bot_account, create_accounts, default_account
 from gmocoin_bot.bot import GMOCoinBot, EBotState
+from gmocoin_bot.config import ConfigWatcher, diff_bot_configs
+from gmocoin_bot.risk import create_risk_engines
 from gmocoin_bot.simulator import GMOCoinBotSimulator
 from gmocoin_bot.ws import GMOWebsocketManager
 
 bots: list[GMOCoinBot]
-tl = Timeloop()
 
-@tl.job(interval=timedelta(minutes=1))
+def create_bot(bc):
+    bc = dict(bc, account=bot_account(config, bc))
+    if SIMULATION_FLG:
+        return GMOCoinBotSimulator(bc, accounts[bc['account']], chart, order_book)
+    return GMOCoinBot(bc, accounts[bc['account']], chart, order_book, risk_engines[bc['account']])
+
+def remove_bot(bot):
+    ws_manager.remove_bot(bot)
+    bots.remove(bot)
+    bot.stop()
+    print("BOT REMOVED:", bot.name)
+
+def add_bot(bc):
+    bot = create_bot(bc)
+    bots.append(bot)
+    ws_manager.add_bot(bot)
+    print("BOT ADDED:", bot.name)
+
+def apply_bot_config(bc, by_name):
+    bot = by_name.get(bc['name'])
+    if bot is None:
+        add_bot(bc)
+    elif not bot.apply_config(dict(bc, account=bot_account(config, bc))):
+        remove_bot(bot)
+        add_bot(bc)
+
+def on_config_change(old_config, new_config):
+    """
+    bot_configs の変更を接続・チャートを維持したまま反映する
+    存在しないアカウントを使うボットがあれば何も変更せずに ValueError を投げる。
+    途中で失敗した場合は次の確認で同じ差分を再適用するので、既に反映済みのボットがあっても続けられるようにする
+    """
+    global config
+    for bc in new_config['bot_configs']:
+        account = bot_account(new_config, bc)
+        if account not in accounts or account not in risk_engines:
+            raise ValueError("bot '{}': account '{}' is not running (restart required)".format(bc['name'], account))
+
+    config = new_config
+    for account in account_configs(config):
+        risk_engines[account['name']].set_limits(account.get('risk', config.get('risk')))
+    added, removed, changed = diff_bot_configs(old_config['bot_configs'], new_config['bot_configs'])
+    by_name = {b.name: b for b in bots}
+    for bc in removed:
+        if bc['name'] in by_name:
+            remove_bot(by_name[bc['name']])
+    for bc in changed + added:
+        apply_bot_config(bc, by_name)
+
 def check_server_status():
     if not SIMULATION_FLG:
-        for bot in bots:
+        for bot in list(bots):
             if bot.get_state() == EBotState.Running and bot.get_server_status() != 'OPEN':
                 bot.pause()
             elif bot.get_state() == EBotState.Paused and bot.get_server_status() == 'OPEN':
                 bot.run()
 
-# @tl.job(interval=timedelta(minutes=1))
 # def monitoring():
 #     chart.print_candles_by_index(-20)
 
@@ -45,35 +90,43 @@ if __name__ == '__main__':
         exit(-1)
 
     config = json.load(open(config_path, 'r'))
-    access_key = config['access_key']
-    secret_key = config['secret_key']
+    if config.get('workers', 1) > 1:
+        # ボットを複数プロセスに分けて動かす
+        from gmocoin_bot import cluster
+        print("Cluster Start. workers:", config['workers'])
+        cluster.run_cluster(config, SIMULATION_FLG)
+        exit(0)
+
     symbol = config['symbol']
-    api = GMO(access_key, secret_key)
+    accounts = create_accounts(config)
+    risk_engines = create_risk_engines(config)
+    metrics.instrument_accounts(accounts)
+    api = accounts[default_account(config)]
     chart = TechnicalChart()
-    bot_configs = config['bot_configs']
+    order_book = OrderBook(symbol)
 
-    bots = []
     if SIMULATION_FLG:
         print("Bot Simulation Start.")
-        bots = [GMOCoinBotSimulator(bc, api, chart) for bc in bot_configs]
     else:
         print("****REAL BOT START*****")
-        bots = [GMOCoinBot(bc, api, chart) for bc in bot_configs]
+    bots = [create_bot(bc) for bc in config['bot_configs']]
+
+    ws_manager = GMOWebsocketManager(list(bots), chart, api, sim_flg=SIMULATION_FLG, symbol=symbol,
+                                     order_book=order_book, accounts=accounts)
+    config_watcher = ConfigWatcher(config_path, config, on_config_change)
 
-    ws_manager = GMOWebsocketManager(bots, chart, api, sim_flg=SIMULATION_FLG)
+    if config.get('metrics_port'):
+        metrics.register_process(lambda: bots, risk_engines)
+        metrics.start_server(config['metrics_port'])
 
-    tl.start(block=False)
+    scheduler.every(60, check_server_status, name='check_server_status')
+    tick_profiler = profiler.install(config.get('profiler'))
 
     try:
-        while True:
-            wait_time = schedule.idle_seconds()
-            if wait_time is None:
-                raise Exception("There should be some tasks waiting to execute")
-            elif wait_time > 0:
-                sleep(wait_time)
-            schedule.run_pending()
+        scheduler.default_scheduler.run_forever()
     except KeyboardInterrupt:
-        schedule.clear()
+        scheduler.default_scheduler.stop()
+        tick_profiler.stop()
         del ws_manager
         del bots
 
@@ -0,0 +1,26 @@
+import unittest
+
+from benchmark import _import_times
+
+# コンテナの再起動から1秒以内に購読・取引を始めたいので、import はその一部に収める
+IMPORT_BUDGET_MS = 500
+# 起動時に読み込まない重い依存（必要になった時に読み込む）
+LAZY_MODULES = ('pandas', 'websocket', 'requests')
+
+
+class ImportTimeTest(unittest.TestCase):
+    def assert_light_import(self, module):
+        times = _import_times(module)
+        for lazy in LAZY_MODULES:
+            self.assertNotIn(lazy, times, "{} imports {}".format(module, lazy))
+        self.assertLess(times[module][1] / 1000, IMPORT_BUDGET_MS)
+
+    def test_gmo(self):
+        self.assert_light_import('gmo.gmo')
+
+    def test_main(self):
+        self.assert_light_import('main')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import unittest
+
+from gmocoin_bot.orders import ORDER_STATUS_CANCELLING, RETRY_MS, OrderTracker, TimerWheel
+
+
+class FakeClock:
+    def __init__(self, now_ms=0):
+        self.now_ms = now_ms
+
+    def exchange_now_ms(self):
+        return self.now_ms
+
+
+class FakeAPI:
+    """
+    cancel_orders の結果を順番に返す（無くなったら全て成功）
+    """
+
+    def __init__(self, responses=()):
+        self.clock = FakeClock()
+        self.responses = list(responses)
+        self.cancel_calls = []
+
+    def cancel_orders(self, order_ids):
+        self.cancel_calls.append(list(order_ids))
+        if self.responses:
+            return self.responses.pop(0)
+        return {'success': list(order_ids), 'failed': []}
+
+
+def failed(order_id, code):
+    return {'success': [], 'failed': [{'message_code': code, 'message_string': 'error', 'orderId': order_id}]}
+
+
+def execution(order_id, size, executed, order_size):
+    return {'orderId': order_id, 'executionSize': str(size), 'orderExecutedSize': str(executed),
+            'orderSize': str(order_size)}
+
+
+class TimerWheelTest(unittest.TestCase):
+    def test_later_revolution_stays_in_slot(self):
+        wheel = TimerWheel(tick_ms=100, slots=8)
+        wheel.add('a', 300)
+        wheel.add('b', 300 + 8 * 100)  # 同じスロットの次の周
+        self.assertEqual(wheel.advance(1000), ['a'])
+        self.assertIn('b', wheel)
+        self.assertEqual(wheel.advance(1100), ['b'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_advance_over_several_revolutions(self):
+        wheel = TimerWheel(tick_ms=100, slots=8)
+        wheel.add('a', 300)
+        self.assertEqual(wheel.advance(300), ['a'])
+        wheel.add('b', 1900)
+        wheel.add('c', 2500)
+        wheel.add('d', 9000)
+        # 1回の advance で数周分進めても、期限の来たものは全て取り出し、来ていないものは残す
+        self.assertEqual(sorted(wheel.advance(5000)), ['b', 'c'])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(9000), ['d'])
+
+    def test_deadline_is_rounded_up(self):
+        wheel = TimerWheel(tick_ms=100, slots=8)
+        wheel.add('a', 150)
+        self.assertEqual(wheel.advance(100), [])
+        self.assertEqual(wheel.advance(200), ['a'])
+
+    def test_past_deadline_fires_on_next_tick(self):
+        wheel = TimerWheel(tick_ms=100, slots=8)
+        self.assertEqual(wheel.advance(1000), [])
+        wheel.add('a', 500)
+        self.assertEqual(wheel.advance(1000), [])
+        self.assertEqual(wheel.advance(1100), ['a'])
+
+    def test_remove_and_readd(self):
+        wheel = TimerWheel(tick_ms=100, slots=8)
+        wheel.add('a', 300)
+        wheel.add('a', 700)
+        self.assertEqual(wheel.advance(500), [])
+        wheel.remove('a')
+        self.assertEqual(wheel.advance(2000), [])
+        self.assertEqual(len(wheel), 0)
+
+
+class OrderTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeAPI()
+        self.finished = []
+        self.tracker = OrderTracker(self.api, order_limit_time=1, on_finish=self.finished.append)
+
+    def test_fill_finishes_order(self):
+        self.tracker.track(1, 'OPEN', 2)
+        self.tracker.on_execution(execution(1, 1, 1, 2))
+        self.assertIn(1, self.tracker)
+        self.tracker.on_execution(execution(1, 1, 2, 2))
+        self.assertNotIn(1, self.tracker)
+        self.assertEqual([o.id for o in self.finished], [1])
+
+    def test_full_fill_before_track(self):
+        self.tracker.on_execution(execution(1, 2, 2, 2))
+        self.assertIsNone(self.tracker.track(1, 'OPEN', 2))
+        self.assertEqual(len(self.tracker), 0)
+        self.assertEqual(self.finished, [])
+
+    def test_partial_fill_before_track(self):
+        self.tracker.on_execution(execution(1, 0.5, 0.5, 2))
+        order = self.tracker.track(1, 'OPEN', 2)
+        self.assertEqual(order.executed, 0.5)
+        self.tracker.on_execution(execution(1, 1.5, 2, 2))
+        self.assertEqual([o.id for o in self.finished], [1])
+
+    def test_cancel_before_track(self):
+        self.tracker.on_order_event({'orderId': 1, 'msgType': 'COR', 'orderStatus': 'CANCELED'})
+        self.assertIsNone(self.tracker.track(1, 'OPEN', 2))
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_expired_order_is_cancelled(self):
+        self.tracker.track(1, 'OPEN', 1)
+        self.api.clock.now_ms = 999
+        self.tracker.expire()
+        self.assertEqual(self.api.cancel_calls, [])
+        self.api.clock.now_ms = 1000
+        self.tracker.expire()
+        self.assertEqual(self.api.cancel_calls, [[1]])
+        self.assertEqual(self.tracker.cancelled, 1)
+        # 取消イベントで完了する
+        self.tracker.on_order_event({'orderId': 1, 'msgType': 'COR', 'orderStatus': 'CANCELED'})
+        self.assertEqual([o.id for o in self.finished], [1])
+
+    def test_retry_after_failed_cancel(self):
+        self.api.responses = [failed(1, 'ERR-5003')]
+        order = self.tracker.track(1, 'OPEN', 1)
+        self.api.clock.now_ms = 1000
+        self.tracker.expire()
+        self.assertEqual(order.status, ORDER_STATUS_CANCELLING)
+        self.assertIn(1, self.tracker)
+
+        self.api.clock.now_ms = 1000 + RETRY_MS - 100
+        self.tracker.expire()
+        self.assertEqual(len(self.api.cancel_calls), 1)
+        self.api.clock.now_ms = 1000 + RETRY_MS
+        self.tracker.expire()
+        self.assertEqual(self.api.cancel_calls, [[1], [1]])
+
+    def test_already_done_cancel_finishes_order(self):
+        self.api.responses = [failed(1, 'ERR-5122')]
+        self.tracker.track(1, 'OPEN', 1)
+        self.api.clock.now_ms = 1000
+        self.tracker.expire()
+        self.assertNotIn(1, self.tracker)
+        self.assertEqual([o.id for o in self.finished], [1])
+        self.api.clock.now_ms = 1000 + RETRY_MS
+        self.tracker.expire()
+        self.assertEqual(len(self.api.cancel_calls), 1)
+
+    def test_sync_finishes_missing_orders(self):
+        self.tracker.track(1, 'OPEN', 1)
+        self.tracker.track(2, 'OPEN', 1)
+        self.api.clock.now_ms = RETRY_MS + 1
+        self.tracker.track(3, 'OPEN', 1)
+        self.tracker.sync([{'orderId': 2}])
+        self.assertEqual([o.id for o in self.finished], [1])
+        self.assertEqual(sorted(self.tracker.ids()), [2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import unittest
+
+from gmocoin_bot.risk import (DAY_MS, REJECT_BOT_EXPOSURE, REJECT_EXPOSURE, REJECT_KILL_SWITCH, REJECT_MARGIN,
+                              REJECT_MARGIN_UNKNOWN, REJECT_ORDER_RATE, RiskEngine, RiskLimits)
+
+
+class FakeClock:
+    def __init__(self, now_ms=0):
+        self.now_ms = now_ms
+
+    def exchange_now_ms(self):
+        return self.now_ms
+
+
+def execution(execution_id, order_id, position_id, side, size, price, settle_type='OPEN', loss_gain='0'):
+    return {'executionId': execution_id, 'orderId': order_id, 'positionId': position_id, 'side': side,
+            'settleType': settle_type, 'executionSize': str(size), 'executionPrice': str(price),
+            'lossGain': loss_gain}
+
+
+def order_event(order_id, msg_type='COR'):
+    return {'orderId': order_id, 'msgType': msg_type, 'orderStatus': 'CANCELED'}
+
+
+class RiskEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def engine(self, config=None, available=1000000, **kwargs):
+        engine = RiskEngine(config, clock=self.clock, **kwargs)
+        if available is not None:
+            engine.sync_margin({'availableAmount': str(available)})
+        return engine
+
+    def test_confirm_then_fill_replaces_reserved_margin(self):
+        engine = self.engine()
+        ticket, reason = engine.approve_entry('bot', 'BUY', 1000, 2)
+        self.assertIsNone(reason)
+        self.assertEqual(engine.available, 1000000 - 500)
+
+        engine.confirm(ticket, 1)
+        engine.on_execution(execution(10, 1, 100, 'BUY', 2, 1200))
+        self.assertEqual(engine.available, 1000000 - 600)
+        self.assertEqual(engine.exposure, 2400)
+        self.assertEqual(engine.bot_exposure, {'bot': 2400})
+        self.assertEqual(engine.to_dict()['open_orders'], 0)
+
+    def test_fill_before_confirm(self):
+        engine = self.engine()
+        ticket, _ = engine.approve_entry('bot', 'BUY', 1000, 2)
+        engine.on_execution(execution(10, 1, 100, 'BUY', 1, 1000))
+        self.assertEqual(engine.bot_exposure, {})
+
+        engine.confirm(ticket, 1)
+        # 約定した 1 の証拠金は約定で、残りの 1 は発注中として確保されている
+        self.assertEqual(engine.available, 1000000 - 500)
+        self.assertEqual(engine.bot_exposure, {'bot': 1000})
+        engine.on_order_event(order_event(1))
+        self.assertEqual(engine.available, 1000000 - 250)
+
+    def test_cancel_before_confirm(self):
+        engine = self.engine()
+        ticket, _ = engine.approve_entry('bot', 'BUY', 1000, 2)
+        engine.on_order_event(order_event(1))
+        engine.confirm(ticket, 1)
+        self.assertEqual(engine.available, 1000000)
+        self.assertEqual(engine.to_dict()['open_orders'], 0)
+
+    def test_failed_order_returns_margin(self):
+        engine = self.engine()
+        ticket, _ = engine.approve_entry('bot', 'BUY', 1000, 2)
+        engine.cancel(ticket)
+        self.assertEqual(engine.available, 1000000)
+
+    def test_release_returns_unfilled_margin(self):
+        engine = self.engine()
+        ticket, _ = engine.approve_entry('bot', 'BUY', 1000, 2)
+        engine.confirm(ticket, 1)
+        engine.release(1)
+        engine.release(1)
+        self.assertEqual(engine.available, 1000000)
+
+    def test_duplicate_execution_is_counted_once(self):
+        engine = self.engine()
+        ticket, _ = engine.approve_entry('bot', 'SELL', 1000, 1)
+        engine.confirm(ticket, 1)
+        engine.on_execution(execution(10, 1, 100, 'SELL', 1, 1000))
+        engine.on_execution(execution(10, 1, 100, 'SELL', 1, 1000))
+        self.assertEqual(engine.exposure, 1000)
+        self.assertEqual(engine.available, 1000000 - 250)
+
+        close = execution(11, 2, 100, 'BUY', 1, 900, settle_type='CLOSE', loss_gain='100')
+        engine.on_execution(close)
+        engine.on_execution(close)
+        self.assertEqual(engine.realized, 100)
+        self.assertEqual(engine.exposure, 0)
+
+    def test_partial_close(self):
+        engine = self.engine()
+        ticket, _ = engine.approve_entry('bot', 'BUY', 1000, 2)
+        engine.confirm(ticket, 1)
+        engine.on_execution(execution(10, 1, 100, 'BUY', 2, 1000))
+
+        engine.on_execution(execution(11, 2, 100, 'SELL', 0.5, 1100, settle_type='CLOSE', loss_gain='50'))
+        self.assertEqual(engine.exposure, 1500)
+        self.assertEqual(engine.bot_exposure, {'bot': 1500})
+        self.assertEqual(engine.available, 1000000 - 500 + 125 + 50)
+        self.assertEqual(engine.to_dict()['positions'], 1)
+
+        engine.on_ticker(1100)
+        self.assertEqual(engine.unrealized, 150)
+
+        engine.on_execution(execution(12, 3, 100, 'SELL', 1.5, 1100, settle_type='CLOSE', loss_gain='150'))
+        self.assertEqual(engine.exposure, 0)
+        self.assertEqual(engine.to_dict()['positions'], 0)
+        self.assertEqual(engine.realized, 200)
+        self.assertEqual(engine.unrealized, 0)
+        self.assertEqual(engine.available, 1000000 + 200)
+
+    def test_rejects(self):
+        engine = self.engine(available=None)
+        self.assertEqual(engine.approve_entry('bot', 'BUY', 1000, 1), (None, REJECT_MARGIN_UNKNOWN))
+
+        engine = self.engine({'max_exposure_jpy': 3000, 'max_bot_exposure_jpy': 2000, 'max_orders_per_minute': 3},
+                             available=1000)
+        self.assertEqual(engine.approve_entry('bot', 'BUY', 5000, 1), (None, REJECT_MARGIN))
+        self.assertEqual(engine.approve_entry('bot', 'BUY', 1000, 2.5), (None, REJECT_BOT_EXPOSURE))
+        ticket, _ = engine.approve_entry('bot', 'BUY', 1000, 2)
+        engine.confirm(ticket, 1)
+        engine.on_execution(execution(10, 1, 100, 'BUY', 2, 1000))
+        self.assertEqual(engine.approve_entry('other', 'BUY', 1000, 1.5), (None, REJECT_EXPOSURE))
+        self.assertIsNotNone(engine.approve_entry('other', 'BUY', 100, 1)[0])
+        self.assertIsNotNone(engine.approve_entry('other', 'BUY', 100, 1)[0])
+        self.assertEqual(engine.approve_entry('other', 'BUY', 100, 1), (None, REJECT_ORDER_RATE))
+        self.assertEqual(engine.rejects, {REJECT_MARGIN: 1, REJECT_BOT_EXPOSURE: 1, REJECT_EXPOSURE: 1,
+                                          REJECT_ORDER_RATE: 1})
+
+    def test_daily_loss_trips_kill_switch(self):
+        engine = self.engine({'max_daily_loss_jpy': 100})
+        ticket, _ = engine.approve_entry('bot', 'BUY', 1000, 1)
+        engine.confirm(ticket, 1)
+        engine.on_execution(execution(10, 1, 100, 'BUY', 1, 1000))
+        engine.on_ticker(950)
+        self.assertFalse(engine.is_killed())
+        engine.on_ticker(900)
+        self.assertTrue(engine.is_killed())
+        self.assertEqual(engine.approve_entry('bot', 'BUY', 900, 1), (None, REJECT_KILL_SWITCH))
+
+    def test_day_rollover_excludes_carried_unrealized(self):
+        engine = self.engine({'max_daily_loss_jpy': 150})
+        ticket, _ = engine.approve_entry('bot', 'BUY', 1000, 1)
+        engine.confirm(ticket, 1)
+        engine.on_execution(execution(10, 1, 100, 'BUY', 1, 1000))
+        engine.on_execution(execution(11, 2, 101, 'BUY', 1, 1000))
+        engine.on_execution(execution(12, 3, 101, 'SELL', 1, 900, settle_type='CLOSE', loss_gain='-100'))
+        engine.on_ticker(900)
+        self.assertEqual(engine.daily_pnl, -200)
+        self.assertTrue(engine.is_killed())
+
+        self.clock.now_ms += DAY_MS
+        engine.on_ticker(880)
+        self.assertEqual(engine.realized, 0)
+        self.assertEqual(engine.daily_pnl, -20)
+        self.assertFalse(engine.is_killed())
+
+        # 持ち越した建玉の決済は、前日までの含み損を今日の損益に含めない
+        engine.on_execution(execution(13, 4, 100, 'SELL', 1, 880, settle_type='CLOSE', loss_gain='-120'))
+        self.assertEqual(engine.daily_pnl, -20)
+
+    def test_set_limits_keeps_worker_share(self):
+        engine = self.engine({'max_exposure_jpy': 900}, worker=1, workers=3)
+        self.assertEqual(engine.limits.max_exposure_jpy, 300)
+        engine.set_limits({'max_exposure_jpy': 1200})
+        self.assertEqual(engine.limits.max_exposure_jpy, 400)
+
+    def test_worker_margin_share(self):
+        engine = self.engine(available=900, workers=3)
+        self.assertEqual(engine.available, 300)
+
+
+class RiskLimitsTest(unittest.TestCase):
+    def test_worker_shares_sum_to_account_limits(self):
+        config = {'max_exposure_jpy': 1000, 'max_orders_per_minute': 10, 'max_daily_loss_jpy': 300,
+                  'max_bot_exposure_jpy': 50, 'margin_buffer_rate': 0.1}
+        shares = [RiskLimits(config, worker, 3) for worker in range(3)]
+        self.assertEqual([s.max_orders_per_minute for s in shares], [4, 3, 3])
+        self.assertAlmostEqual(sum(s.max_exposure_jpy for s in shares), 1000)
+        self.assertAlmostEqual(sum(s.max_daily_loss_jpy for s in shares), 300)
+        self.assertTrue(all(s.max_bot_exposure_jpy == 50 and s.margin_buffer_rate == 0.1 for s in shares))
+
+    def test_unset_limits_stay_unset(self):
+        limits = RiskLimits({}, 0, 4)
+        self.assertIsNone(limits.max_exposure_jpy)
+        self.assertIsNone(limits.max_orders_per_minute)
+        self.assertIsNone(limits.max_daily_loss_jpy)
+
+
+if __name__ == '__main__':
+    unittest.main()
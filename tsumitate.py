@@ -1,12 +1,126 @@
 import asyncio
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import schedule
 from gmo import gmo
 from datetime import datetime
 
+from gmocoin_bot import scheduler
+from gmocoin_bot.journal import StateJournal
+
+TIME_UNIT_SECONDS = {
+    'minutes': 60,
+    'hours': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+class TwapExecution:
+    """
+    TWAP 分割発注
+
+    購入数量を slices 個に分けて window 秒かけて発注する。各スライスは最良買い気配に指値
+    （post_only なら SOK）で出し、reprice_after 秒経っても約定しなければ取り消して
+    その時点の最良買い気配で出し直す。スライスの期限までに約定しなかった分は次のスライスに繰り越す。
+    約定は executions で確認し、到着時価格（開始時の売り気配）と平均約定価格を記録する。
+    注文毎に約定を集計したら on_fill(self) を呼ぶ（使った金額をその都度記録するため）。
+    """
+    POLL_INTERVAL = 5
+
+    def __init__(self, api: gmo.GMO, symbol, size, arrival_price, slices=4, window=600, reprice_after=60,
+                 post_only=True, size_precision=4, on_fill=None):
+        self._api = api
+        self.symbol = symbol
+        self.size = size
+        self.arrival_price = arrival_price
+        self._slices = max(int(slices), 1)
+        self._window = window
+        self._reprice_after = reprice_after
+        self._post_only = post_only
+        self._size_precision = size_precision
+        self._min_size = 10 ** -size_precision
+        self._on_fill = on_fill
+
+        self.filled_size = 0.0
+        self.filled_notional = 0.0
+        self.recorded_jpy = 0  # filled_notional のうち記録済みの金額
+        self.order_num = 0
+
+    def average_price(self):
+        if self.filled_size <= 0:
+            return None
+        return self.filled_notional / self.filled_size
+
+    def slippage_bps(self):
+        """
+        到着時価格に対する平均約定価格の差（bps、プラスが不利）
+        """
+        avg = self.average_price()
+        if avg is None:
+            return None
+        return (avg - self.arrival_price) / self.arrival_price * 10000
+
+    def run(self):
+        start = time.monotonic()
+        slice_size = self.size / self._slices
+        for k in range(self._slices):
+            deadline = start + self._window * (k + 1) / self._slices
+            target = min(slice_size * (k + 1), self.size)
+            self._execute_until(target, deadline)
+        return self
+
+    def _execute_until(self, target, deadline):
+        while target - self.filled_size >= self._min_size and time.monotonic() < deadline:
+            remaining = round(target - self.filled_size, self._size_precision)
+            bid = self._api.tickcer(self.symbol)[0]['bid']
+            order_id = self._api.order(self.symbol, 'BUY', 'LIMIT', "{:.{}f}".format(remaining, self._size_precision), bid,
+                                       time_in_force='SOK' if self._post_only else None)
+            if not order_id:
+                # post only で即時約定しそうな場合など。少し待って出し直す
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            self.order_num += 1
+
+            reprice_at = min(time.monotonic() + self._reprice_after, deadline)
+            filled = 0.0
+            while time.monotonic() < reprice_at:
+                time.sleep(min(self.POLL_INTERVAL, max(reprice_at - time.monotonic(), 0)))
+                filled, _ = self._order_fills(order_id)
+                if remaining - filled < self._min_size:
+                    break
+
+            if remaining - filled >= self._min_size:
+                self._api.cancel_order(int(order_id))
+
+            # キャンセルまでの間に約定した分も含めて集計
+            filled, notional = self._order_fills(order_id)
+            self.filled_size += filled
+            self.filled_notional += notional
+            if notional > 0 and self._on_fill is not None:
+                self._on_fill(self)
+
+    def _order_fills(self, order_id):
+        executions = self._api.executions(orderId=order_id)
+        if not executions:
+            return 0.0, 0.0
+        fills = [(float(e['size']), float(e['price'])) for e in executions['list']]
+        return sum(size for size, _ in fills), sum(size * price for size, price in fills)
+
+    def report_str(self):
+        avg = self.average_price()
+        if avg is None:
+            return "TWAP {} 約定なし（{}件発注）".format(self.symbol, self.order_num)
+        return "TWAP {} 約定[{:g}/{:g}] 平均[{:.3f}] 到着時[{:.3f}] スリッページ[{:+.1f}bps] 発注数[{}]".format(
+            self.symbol, self.filled_size, self.size, avg, self.arrival_price, self.slippage_bps(), self.order_num)
+
 class AutoBuyer:
+    # 旧形式の保存ファイル（ジャーナルが空の場合のみ読み込む）
     SAVE_FILE_PATH = 'save/tsumitate-jpy-used.json'
+    JOURNAL_PATH = 'save/tsumitate.journal'
+    # 同時に発注する数（実際の送信間隔は GMO クラスの CallLimiter が制御する）
+    ORDER_CONCURRENCY = 3
 
     def __init__(self, config_path):
         config = json.load(open(config_path, 'r'))
@@ -15,50 +129,117 @@ class AutoBuyer:
         secret_key = config['secret_key']
         self._time_unit = config['time_unit']
         self._frequency = int(config['frequency'])
-        self.__gmo = gmo.GMO(access_key, secret_key)
+        self.__gmo = gmo.GMO(access_key, secret_key, rest_url=config.get('rest_url'), ws_url=config.get('ws_url'))
         self._trade_setting_path = config['settings']
+        self._executor = ThreadPoolExecutor(max_workers=self.ORDER_CONCURRENCY)
+        self._twap_executor = ThreadPoolExecutor()
+        self._active_twaps = set()
+        self._journal_lock = threading.Lock()
 
-        with open(self.SAVE_FILE_PATH, 'r') as f:
-            self.__jpy_used = json.load(f)
+        self.__journal = StateJournal(self.JOURNAL_PATH)
+        if not self.__journal.state and os.path.exists(self.SAVE_FILE_PATH):
+            with open(self.SAVE_FILE_PATH, 'r') as f:
+                for symbol, jpy in json.load(f).items():
+                    self.__journal.set(symbol, jpy)
+            self.__journal.compact()
+
+    @property
+    def jpy_used(self) -> dict:
+        return self.__journal.state
 
     def buy(self):
+        """
+        残高と全銘柄のレートを1回ずつ取得し、注文はまとめて並行に送信する
+        """
         print("==================================================")
         print(datetime.now())
         with open(self._trade_setting_path) as f:
             trades = json.load(f)
 
-            for t in trades:
-                symbol = t['symbol']
-                size = t['size']
-                balance = int(self.__gmo.account_margin()['availableAmount'])
-                price = float(self.__gmo.tickcer(symbol)[0]['ask'])
-                if balance < size * price:
+        balance_future = self._executor.submit(self.__gmo.account_margin)
+        tickers = self.__gmo.tickers()
+        balance = int(balance_future.result()['availableAmount'])
+
+        orders = []
+        for t in trades:
+            symbol = t['symbol']
+            size = t['size']
+            if symbol not in tickers:
+                print("NO TICKER FOR {}".format(symbol))
+                continue
+
+            price = float(tickers[symbol]['ask'])
+            if balance < size * price:
+                continue
+
+            execution = t.get('execution', {})
+            if execution.get('mode') == 'twap':
+                if symbol in self._active_twaps:
+                    print("TWAP {} STILL RUNNING, SKIP".format(symbol))
                     continue
+                balance -= size * price
+                self._start_twap(symbol, size, price, execution)
+                continue
 
-                self.__gmo.order(symbol, 'BUY', 'LIMIT', size, price)
-                print("BUY {} * {} at rate[{}]".format(symbol, size, price))
-                if self.__jpy_used[symbol]:
-                    self.__jpy_used[symbol] += int(price * size)
-                else:
-                    self.__jpy_used[symbol] = int(price * size)
+            balance -= size * price
+            orders.append((symbol, size, price, self._executor.submit(self.__gmo.order, symbol, 'BUY', 'LIMIT', size, price)))
 
-                with open(self.SAVE_FILE_PATH, 'w') as f_save:
-                    f_save.write(json.dumps(self.__jpy_used))
+        for symbol, size, price, future in orders:
+            try:
+                if not future.result():
+                    continue
+            except Exception as e:
+                print("BUY {} FAILED: {}".format(symbol, e))
+                continue
 
+            print("BUY {} * {} at rate[{}]".format(symbol, size, price))
+            self._record_spend(symbol, price * size)
+
+        with self._journal_lock:
+            self.__journal.sync()
         print("==================================================")
 
+    def _record_spend(self, symbol, jpy, sync=False):
+        with self._journal_lock:
+            self.__journal.add(symbol, int(jpy), sync=sync)
+
+    def _start_twap(self, symbol, size, arrival_price, setting):
+        twap = TwapExecution(self.__gmo, symbol, size, arrival_price,
+                             slices=setting.get('slices', 4),
+                             window=setting.get('window', 600),
+                             reprice_after=setting.get('reprice_after', 60),
+                             post_only=setting.get('post_only', True),
+                             size_precision=setting.get('size_precision', 4),
+                             on_fill=self._record_twap_fill)
+        self._active_twaps.add(symbol)
+        print("TWAP {} * {} START (arrival rate[{}])".format(symbol, size, arrival_price))
+        self._twap_executor.submit(self._run_twap, twap)
+
+    def _run_twap(self, twap: TwapExecution):
+        try:
+            twap.run()
+        except Exception as e:
+            print("TWAP {} FAILED: {}".format(twap.symbol, e))
+        finally:
+            self._active_twaps.discard(twap.symbol)
+            # 記録に失敗していた分があれば残りを記録する
+            self._record_twap_fill(twap)
+            print(twap.report_str())
+
+    def _record_twap_fill(self, twap: TwapExecution):
+        """
+        約定のたびに呼ばれ、まだ記録していない金額だけ記録する（途中で落ちても約定済みの分は残る）
+        """
+        jpy = int(twap.filled_notional) - twap.recorded_jpy
+        if jpy > 0:
+            self._record_spend(twap.symbol, jpy, sync=True)
+            twap.recorded_jpy += jpy
+
     async def run(self):
         self.buy()
-        if self._time_unit == 'hours':
-            schedule.every(self._frequency).hours.do(self.buy)
-        elif self._time_unit == 'minutes':
-            schedule.every(self._frequency).minutes.do(self.buy)
-        elif self._time_unit == 'day':
-            schedule.every(self._frequency).days.do(self.buy)
-
-        while True:
-            schedule.run_pending()
-            await asyncio.sleep(0)
+        scheduler.every(self._frequency * TIME_UNIT_SECONDS[self._time_unit], self.buy, name='tsumitate.buy', jitter=0)
+
+        await asyncio.to_thread(scheduler.default_scheduler.run_forever)
 
 if __name__ == '__main__':
     buyer = AutoBuyer('configs/tsumitate.json')